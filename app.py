@@ -1,16 +1,53 @@
+import math
 import os
-from flask import Flask, request, abort, jsonify
+from contextlib import ExitStack
+from functools import partial
+from flask import Flask, Response, request, abort, jsonify, stream_with_context
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy.orm import load_only
 from flask_cors import CORS
 from models import db, Movie, Actor
 from flask_migrate import Migrate
-from auth.auth import AuthError, requires_auth
+from auth.auth import AuthError, requires_auth, check_permissions
+from auth.token_cache import token_cache
+from pagination import paginate, filter_actors, filter_movies, parse_include, \
+  include_related, included_tables, parse_fields, cursor_fields, parse_limit, \
+  encode_cursor, decode_cursor
+from export import export_response, wants_ndjson
+from bulk import bulk_create, batch_update, batch_delete
+from validation import validate_actor, validate_movie, parse_release_date
+from cache import response_cache
+from conditional import conditional
+from serializer import get_serializer, json_response
+from search import SEARCHABLE, search_index
+from stats import read_stats
+from pool import init_pool, pool_metrics
+from routing import replica_router
+from profiling import profiler, request_metrics
+from writebehind import write_behind, format_operation
+from idempotency import idempotency
+from changes import CHANGE_TYPES, change_feed
+from ratelimit import RateLimitError, rate_limiter
+from formats import list_response, negotiate_list_format
+from compression import compression
 
 def create_app(test_config=None):
   # create and configure the app
   app = Flask(__name__)
   app.config.from_object('config')
+  if test_config is not None:
+    app.config.update(test_config)
+  init_pool(app)
+  replica_router.init_app(app)
   db.init_app(app)
+  response_cache.init_app(app)
+  search_index.init_app(app)
+  profiler.init_app(app)
+  write_behind.init_app(app)
+  idempotency.init_app(app)
+  change_feed.init_app(app)
+  rate_limiter.init_app(app)
+  compression.init_app(app)
   migrate = Migrate(app, db)
   CORS(app)
 
@@ -18,32 +55,142 @@ def create_app(test_config=None):
   def index():
     return "Welcome to Casting Agency API"
 
-  
+  @app.route('/metrics/pool', methods=['GET'])
+  def get_pool_metrics():
+    '''
+    This function handles reporting the database connection pool metrics,
+    when enabled through METRICS_ENABLED
+    '''
+    if not app.config['METRICS_ENABLED']:
+      abort(404)
+    return jsonify({
+      'success': True,
+      'pool': pool_metrics.snapshot(),
+      'reads': replica_router.reads
+    })
+
+  @app.route('/metrics', methods=['GET'])
+  def get_metrics():
+    '''
+    This function handles reporting the request latency histograms and
+    database query totals per route, plus the pool, cache and token
+    counters, in the Prometheus text format, when enabled through
+    METRICS_ENABLED
+    '''
+    if not app.config['METRICS_ENABLED']:
+      abort(404)
+    pool = pool_metrics.snapshot()
+    tokens = token_cache.stats()
+    gauges = [
+      ('db_pool_checkouts_total', 'Connections checked out of the pool', 'counter', pool['checkouts']),
+      ('db_pool_timeouts_total', 'Checkouts that timed out', 'counter', pool['timeouts']),
+      ('db_pool_invalidations_total', 'Connections invalidated', 'counter', pool['invalidations']),
+      ('db_pool_wait_seconds_total', 'Time spent waiting for a connection', 'counter', pool['wait_seconds_total']),
+      ('db_pool_checked_out', 'Connections currently checked out', 'gauge',
+       sum(stats['checked_out'] for stats in pool['pools'])),
+      ('db_replica_reads_total', 'Reads sent to a replica', 'counter', replica_router.reads['replica']),
+      ('response_cache_hits_total', 'Responses served from the cache', 'counter', response_cache.hits),
+      ('response_cache_misses_total', 'Responses missing from the cache', 'counter', response_cache.misses),
+      ('token_cache_hits_total', 'Tokens served from the verified token cache', 'counter', tokens['hits']),
+      ('token_cache_misses_total', 'Tokens verified from scratch', 'counter', tokens['misses']),
+      ('idempotent_replays_total', 'Responses replayed for a retried Idempotency-Key', 'counter', idempotency.replays),
+      ('rate_limited_total', 'Requests rejected by the rate limits', 'counter', rate_limiter.limited)
+    ]
+    return Response(request_metrics.render(gauges), mimetype='text/plain; version=0.0.4')
+
+  def accept_write(payload, model, action, entity_id=None, validator=None):
+    '''
+    Journals a write sent with "Prefer: respond-async" for the write-behind
+    worker and answers 202 with the operation to poll
+    '''
+    values = None
+    if validator is not None:
+      try:
+        values = validator(request.get_json(silent=True))
+      except ValueError:
+        abort(400)
+    operation = write_behind.submit(model, action, entity_id, values, payload.get('sub'))
+    response = jsonify({
+      'success': True,
+      'operation': operation.id
+    })
+    response.status_code = 202
+    response.headers['Location'] = f'/operations/{operation.id}'
+    response.headers['Preference-Applied'] = 'respond-async'
+    return response
+
   '''
     Actors endpoints
   '''
 
   @app.route('/actors', methods=['GET'])
   @requires_auth('get:actors')
+  @conditional(Actor.__tablename__, partial(included_tables, Actor))
+  @response_cache.cached(Actor.__tablename__, partial(included_tables, Actor))
   def get_actors(payload):
     '''
-    This function handles requesting all available actors 
+    This function handles requesting a page of actors, optionally filtered
+    by gender, min_age, max_age and name prefix, and sorted by sort.
+    include=movies adds the movies each actor is cast in, and fields
+    selects the returned columns. The Accept header selects MessagePack or
+    columnar encodings.
     Permission: get:actors
     '''
-    actors = Actor.query.all()
-    formatted_actors = [actor.format() for actor in actors]
-    return jsonify({
+    fields = parse_fields(Actor, request.args)
+    if wants_ndjson():
+      serializer = get_serializer(Actor, fields)
+      query = filter_actors(serializer.query(), request.args)
+      return export_response('actors', serializer, query)
+    serializer = get_serializer(Actor, fields, cursor_fields(Actor, request.args))
+    include = parse_include(Actor, request.args)
+    if include:
+      query = Actor.query.options(load_only(*serializer.columns))
+      query = include_related(Actor, filter_actors(query, request.args), include)
+      actors, next_cursor = paginate(Actor, query, request.args)
+      formatted_actors = [actor.format(include, fields) for actor in actors]
+      list_format = negotiate_list_format()
+      if list_format is not None:
+        return list_response(list_format, 'actors', formatted_actors, next_cursor)
+      return jsonify({
+        'success': True,
+        'actors': formatted_actors,
+        'next': next_cursor
+      })
+    query = filter_actors(serializer.query(), request.args)
+    actors, next_cursor = paginate(Actor, query, request.args)
+    list_format = negotiate_list_format()
+    if list_format is not None:
+      return list_response(list_format, 'actors', actors, next_cursor, serializer)
+    return json_response({
       'success': True,
-      'actors': formatted_actors
+      'actors': serializer.rows(actors),
+      'next': next_cursor
     })
 
+  @app.route('/actors/export', methods=['GET'])
+  @requires_auth('get:actors')
+  @conditional(Actor.__tablename__)
+  def export_actors(payload):
+    '''
+    This function handles streaming every actor matching the list filters,
+    as NDJSON when requested through the Accept header
+    Permission: get:actors
+    '''
+    serializer = get_serializer(Actor, parse_fields(Actor, request.args))
+    query = filter_actors(serializer.query(), request.args)
+    return export_response('actors', serializer, query)
+
   @app.route('/actors', methods=['POST'])
   @requires_auth('post:actors')
+  @idempotency.idempotent
   def add_actor(payload):
     '''
-    This function handles inserting a new actor 
+    This function handles inserting a new actor, later when sent with
+    "Prefer: respond-async" and write-behind is enabled
     Permission: post:actors
     '''
+    if write_behind.accepts():
+      return accept_write(payload, Actor, 'create', validator=validate_actor)
     try:
       name = request.get_json()['name']
       age = request.get_json()['age']
@@ -59,14 +206,49 @@ def create_app(test_config=None):
       'success': True
     })
 
+  @app.route('/actors/bulk', methods=['POST'])
+  @requires_auth('post:actors')
+  @idempotency.idempotent
+  def add_actors(payload):
+    '''
+    This function handles inserting many actors at once, sent as a JSON
+    array or as NDJSON. Valid actors are inserted in one transaction.
+    Permission: post:actors
+    '''
+    return jsonify(bulk_create(Actor, validate_actor))
+
+  @app.route('/actors/batch', methods=['PATCH'])
+  @requires_auth('patch:actors')
+  @idempotency.idempotent
+  def update_actors(payload):
+    '''
+    This function handles updating many actors in one transaction and
+    reports the ids that don't exist
+    Permission: patch:actors
+    '''
+    return jsonify(batch_update(Actor, validate_actor))
+
+  @app.route('/actors/batch', methods=['DELETE'])
+  @requires_auth('delete:actors')
+  def delete_actors(payload):
+    '''
+    This function handles deleting many actors in one transaction and
+    reports the ids that don't exist
+    Permission: delete:actors
+    '''
+    return jsonify(batch_delete(Actor))
+
   @app.route('/actors/<int:actor_id>', methods=['DELETE'])
   @requires_auth('delete:actors')
   def delete_actor(payload, actor_id):
     '''
-    This function handles deleting an existing actor. 
+    This function handles deleting an existing actor, later when sent with
+    "Prefer: respond-async" and write-behind is enabled
     Permission: delete:actors
     '''
     actor = Actor.query.get_or_404(actor_id)
+    if write_behind.accepts():
+      return accept_write(payload, Actor, 'delete', actor_id)
 
     actor.delete()
 
@@ -76,12 +258,16 @@ def create_app(test_config=None):
   
   @app.route('/actors/<int:actor_id>', methods=['PATCH'])
   @requires_auth('patch:actors')
+  @idempotency.idempotent
   def update_actor(payload, actor_id):
     '''
-    This function handles updating an existing actor. 
+    This function handles updating an existing actor, later when sent with
+    "Prefer: respond-async" and write-behind is enabled
     Permission: patch:actors
     '''
     actor = Actor.query.get_or_404(actor_id)
+    if write_behind.accepts():
+      return accept_write(payload, Actor, 'update', actor_id, validate_actor)
     try:
       name = request.get_json()['name']
       age = request.get_json()['age']
@@ -101,28 +287,75 @@ def create_app(test_config=None):
 
   @app.route('/movies', methods=['GET'])
   @requires_auth('get:movies')
+  @conditional(Movie.__tablename__, partial(included_tables, Movie))
+  @response_cache.cached(Movie.__tablename__, partial(included_tables, Movie))
   def get_movies(payload):
     '''
-    This function handles requesting all available movies 
+    This function handles requesting a page of movies, optionally filtered
+    by released_after, released_before and title prefix, and sorted by sort.
+    include=actors adds the cast of each movie, and fields selects the
+    returned columns. The Accept header selects MessagePack or columnar
+    encodings.
     Permission: get:movies
     '''
-    movies = Movie.query.all()
-    formatted_movies = [movie.format() for movie in movies]
-    return jsonify({
+    fields = parse_fields(Movie, request.args)
+    if wants_ndjson():
+      serializer = get_serializer(Movie, fields)
+      query = filter_movies(serializer.query(), request.args)
+      return export_response('movies', serializer, query)
+    serializer = get_serializer(Movie, fields, cursor_fields(Movie, request.args))
+    include = parse_include(Movie, request.args)
+    if include:
+      query = Movie.query.options(load_only(*serializer.columns))
+      query = include_related(Movie, filter_movies(query, request.args), include)
+      movies, next_cursor = paginate(Movie, query, request.args)
+      formatted_movies = [movie.format(include, fields) for movie in movies]
+      list_format = negotiate_list_format()
+      if list_format is not None:
+        return list_response(list_format, 'movies', formatted_movies, next_cursor)
+      return jsonify({
+        'success': True,
+        'movies': formatted_movies,
+        'next': next_cursor
+      })
+    query = filter_movies(serializer.query(), request.args)
+    movies, next_cursor = paginate(Movie, query, request.args)
+    list_format = negotiate_list_format()
+    if list_format is not None:
+      return list_response(list_format, 'movies', movies, next_cursor, serializer)
+    return json_response({
       'success': True,
-      'movies': formatted_movies
+      'movies': serializer.rows(movies),
+      'next': next_cursor
     })
 
+  @app.route('/movies/export', methods=['GET'])
+  @requires_auth('get:movies')
+  @conditional(Movie.__tablename__)
+  def export_movies(payload):
+    '''
+    This function handles streaming every movie matching the list filters,
+    as NDJSON when requested through the Accept header
+    Permission: get:movies
+    '''
+    serializer = get_serializer(Movie, parse_fields(Movie, request.args))
+    query = filter_movies(serializer.query(), request.args)
+    return export_response('movies', serializer, query)
+
   @app.route('/movies', methods=['POST'])
   @requires_auth('post:movies')
+  @idempotency.idempotent
   def add_movie(payload):
     '''
-    This function handles inserting a new movie 
+    This function handles inserting a new movie, later when sent with
+    "Prefer: respond-async" and write-behind is enabled
     Permission: post:movies
     '''
+    if write_behind.accepts():
+      return accept_write(payload, Movie, 'create', validator=validate_movie)
     try:
       title = request.get_json()['title']
-      release_date = request.get_json()['release_date']
+      release_date = parse_release_date(request.get_json()['release_date'])
 
       movie = Movie(title, release_date)
       movie.insert()
@@ -132,14 +365,49 @@ def create_app(test_config=None):
       'success': True
     })
 
+  @app.route('/movies/bulk', methods=['POST'])
+  @requires_auth('post:movies')
+  @idempotency.idempotent
+  def add_movies(payload):
+    '''
+    This function handles inserting many movies at once, sent as a JSON
+    array or as NDJSON. Valid movies are inserted in one transaction.
+    Permission: post:movies
+    '''
+    return jsonify(bulk_create(Movie, validate_movie))
+
+  @app.route('/movies/batch', methods=['PATCH'])
+  @requires_auth('patch:movies')
+  @idempotency.idempotent
+  def update_movies(payload):
+    '''
+    This function handles updating many movies in one transaction and
+    reports the ids that don't exist
+    Permission: patch:movies
+    '''
+    return jsonify(batch_update(Movie, validate_movie))
+
+  @app.route('/movies/batch', methods=['DELETE'])
+  @requires_auth('delete:movies')
+  def delete_movies(payload):
+    '''
+    This function handles deleting many movies in one transaction and
+    reports the ids that don't exist
+    Permission: delete:movies
+    '''
+    return jsonify(batch_delete(Movie))
+
   @app.route('/movies/<int:movie_id>', methods=['DELETE'])
   @requires_auth('delete:movies')
   def delete_movie(payload, movie_id):
     '''
-    This function handles deleting an existing movie. 
+    This function handles deleting an existing movie, later when sent with
+    "Prefer: respond-async" and write-behind is enabled
     Permission: delete:movies
     '''
     movie = Movie.query.get_or_404(movie_id)
+    if write_behind.accepts():
+      return accept_write(payload, Movie, 'delete', movie_id)
 
     movie.delete()
 
@@ -147,18 +415,61 @@ def create_app(test_config=None):
       'success': True
       })
   
+  @app.route('/movies/<int:movie_id>/actors', methods=['POST'])
+  @requires_auth('patch:movies')
+  @idempotency.idempotent
+  def add_movie_actors(payload, movie_id):
+    '''
+    This function handles casting actors in an existing movie. 
+    Permission: patch:movies
+    '''
+    movie = Movie.query.get_or_404(movie_id)
+    body = request.get_json(silent=True)
+    if not isinstance(body, dict) or not isinstance(body.get('actor_ids'), list):
+      abort(400)
+    actor_ids = body['actor_ids']
+    if not all(isinstance(actor_id, int) and not isinstance(actor_id, bool)
+               for actor_id in actor_ids):
+      abort(400)
+
+    cast, missing = movie.add_actors(actor_ids)
+    return jsonify({
+      'success': True,
+      'cast': cast,
+      'missing': missing
+    })
+
+  @app.route('/movies/<int:movie_id>/actors/<int:actor_id>', methods=['DELETE'])
+  @requires_auth('patch:movies')
+  def delete_movie_actor(payload, movie_id, actor_id):
+    '''
+    This function handles removing an actor from a movie's cast. 
+    Permission: patch:movies
+    '''
+    movie = Movie.query.get_or_404(movie_id)
+    if not movie.remove_actor(actor_id):
+      abort(404)
+
+    return jsonify({
+      'success': True
+    })
+
   @app.route('/movies/<int:movie_id>', methods=['PATCH'])
   @requires_auth('patch:movies')
+  @idempotency.idempotent
   def update_movie(payload, movie_id):
     '''
-    This function handles updating an existing movie. 
+    This function handles updating an existing movie, later when sent with
+    "Prefer: respond-async" and write-behind is enabled
     Permission: patch:movies
     '''
     movie = Movie.query.get_or_404(movie_id)
+    if write_behind.accepts():
+      return accept_write(payload, Movie, 'update', movie_id, validate_movie)
     
     try:
       title = request.get_json()['title']
-      release_date = request.get_json()['release_date']
+      release_date = parse_release_date(request.get_json()['release_date'])
     except:
       abort(400)
 
@@ -169,6 +480,139 @@ def create_app(test_config=None):
       'movie': movie.format()
     })
 
+  '''
+    Stats endpoint
+  '''
+
+  @app.route('/stats', methods=['GET'])
+  @requires_auth()
+  def get_stats(payload):
+    '''
+    This function handles reporting the number of actors by gender and age
+    decade and of movies by release year, read from counters kept up to
+    date by every write
+    Permission: get:actors and get:movies
+    '''
+    check_permissions('get:actors', payload)
+    check_permissions('get:movies', payload)
+    return json_response({
+      'success': True,
+      'stats': read_stats()
+    })
+
+  '''
+    Change feed endpoint
+  '''
+
+  @app.route('/changes', methods=['GET'])
+  @requires_auth()
+  def get_changes(payload):
+    '''
+    This function handles reading the inserts, updates and deletes of actors
+    and movies after the since sequence number, in commit order, each with
+    the current row. wait holds the request up to that many seconds until a
+    change comes, and Accept: text/event-stream streams the changes as
+    Server-Sent Events, resuming after Last-Event-ID. type restricts the
+    feed to actor or movie.
+    Permission: get:actors for actor changes, get:movies for movie changes
+    '''
+    types = [type_ for type_ in request.args.get('type', 'actor,movie').split(',') if type_]
+    if not types or any(type_ not in CHANGE_TYPES for type_ in types):
+      abort(400)
+    for type_ in types:
+      check_permissions(f'get:{type_}s', payload)
+
+    accept = request.accept_mimetypes
+    stream = accept['text/event-stream'] > accept['application/json']
+    since = request.args.get('since', 0)
+    if stream and 'Last-Event-ID' in request.headers:
+      since = request.headers['Last-Event-ID']
+    try:
+      since = int(since)
+      wait = float(request.args.get('wait', 0))
+    except ValueError:
+      abort(400)
+    if since < 0 or not math.isfinite(wait) or wait < 0:
+      abort(400)
+    limit = parse_limit(request.args.get('limit'))
+
+    # Held until the response is sent, see CHANGES_MAX_WAITING
+    waiting = ExitStack()
+    if stream or wait > 0:
+      waiting.enter_context(rate_limiter.waiting(payload))
+    if stream:
+      response = Response(stream_with_context(change_feed.stream(since, types, limit)),
+                          mimetype='text/event-stream',
+                          headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+      response.call_on_close(waiting.close)
+      return response
+    with waiting:
+      changes, next_since = change_feed.poll(since, types, limit,
+                                             min(wait, app.config['CHANGES_MAX_WAIT']))
+    return json_response({
+      'success': True,
+      'changes': changes,
+      'next': next_since
+    })
+
+  '''
+    Write-behind operations endpoint
+  '''
+
+  @app.route('/operations/<operation_id>', methods=['GET'])
+  @requires_auth()
+  def get_operation(payload, operation_id):
+    '''
+    This function handles reporting the status of a write accepted with
+    "Prefer: respond-async": pending, applied, or failed with the error
+    Permission: any, for the writes of the caller
+    '''
+    operation = write_behind.status(operation_id, payload.get('sub'))
+    if operation is None:
+      abort(404)
+    return jsonify({
+      'success': True,
+      'operation': format_operation(operation)
+    })
+
+  '''
+    Search endpoint
+  '''
+
+  @app.route('/search', methods=['GET'])
+  @requires_auth()
+  def search(payload):
+    '''
+    This function handles searching actors by name and movies by title,
+    ranked by relevance and paginated with a cursor. type restricts the
+    search to actor or movie.
+    Permission: get:actors to search actors, get:movies to search movies
+    '''
+    q = request.args.get('q', '').strip()
+    types = [type_ for type_ in request.args.get('type', 'actor,movie').split(',') if type_]
+    if not q or not types or any(type_ not in SEARCHABLE for type_ in types):
+      abort(400)
+    for type_ in types:
+      check_permissions(f'get:{type_}s', payload)
+
+    limit = parse_limit(request.args.get('limit'))
+    offset = 0
+    cursor = request.args.get('cursor')
+    if cursor:
+      cursor_q, _, offset = decode_cursor(cursor)
+      if cursor_q != q or offset < 0:
+        abort(400)
+    results = search_index.search(q, types, offset, limit + 1)
+    next_cursor = None
+    if len(results) > limit:
+      results = results[:limit]
+      next_cursor = encode_cursor(q, None, offset + limit)
+    return json_response({
+      'success': True,
+      'results': results,
+      'next': next_cursor
+    })
+
 
   ## Error Handling
 
@@ -188,6 +632,22 @@ def create_app(test_config=None):
                       "message": "bad request"
                       }), 400
 
+  @app.errorhandler(409)
+  def conflict(error):
+      return jsonify({
+                      "success": False, 
+                      "error": 409,
+                      "message": "conflict"
+                      }), 409
+
+  @app.errorhandler(413)
+  def too_large(error):
+      return jsonify({
+                      "success": False, 
+                      "error": 413,
+                      "message": "payload too large"
+                      }), 413
+
   @app.errorhandler(404)
   def not_found(error):
       return jsonify({
@@ -196,6 +656,14 @@ def create_app(test_config=None):
                       "message": "not found"
                       }), 404
 
+  @app.errorhandler(RateLimitError)
+  def too_many_requests(error):
+      return jsonify({
+                      "success": False, 
+                      "error": 429,
+                      "message": "too many requests"
+                      }), 429, {'Retry-After': str(math.ceil(error.retry_after))}
+
   @app.errorhandler(AuthError)
   def unauthorized(AuthError):
       return jsonify({
@@ -0,0 +1,197 @@
+import asyncio
+import io
+import sys
+
+from sqlalchemy.engine.url import make_url
+
+import config
+from app import create_app
+from concurrency import run_on_event_loop, wait
+from models import db
+
+'''
+ASGI serving mode. The same Flask app, routes and requires_auth run in one
+greenlet per request on an event loop, with the database reached through an
+async driver (asyncpg for Postgres, aiosqlite for SQLite) and the JWKS fetched
+off the loop, so a worker keeps serving other requests while one waits on I/O.
+Install uvicorn and the driver, then run e.g.:
+
+    uvicorn asgi:application
+    gunicorn -k uvicorn.workers.UvicornWorker asgi:application
+'''
+
+ASYNC_DRIVERS = {
+    'postgresql': 'asyncpg',
+    'sqlite': 'aiosqlite'
+}
+
+
+def async_database_uri(uri):
+    '''
+    Returns the URL of the async driver for `uri`'s database, e.g.
+    postgresql+asyncpg:// for postgresql://
+    '''
+    if not uri:
+        return uri
+    url = make_url(uri)
+    if url.get_dialect().is_async:
+        return uri
+    backend = url.get_backend_name()
+    if backend not in ASYNC_DRIVERS:
+        raise ValueError(f'No async driver known for {backend} databases')
+    return str(url.set(drivername=f'{backend}+{ASYNC_DRIVERS[backend]}'))
+
+
+def wsgi_environ(scope, body):
+    '''
+    Builds the WSGI environ of an ASGI HTTP request whose body has been read
+    '''
+    server = scope.get('server') or ('localhost', 80)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+        'REMOTE_ADDR': scope['client'][0] if scope.get('client') else '',
+        'CONTENT_LENGTH': str(len(body)),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False
+    }
+    for name, value in scope.get('headers', ()):
+        name = name.decode('latin-1').upper().replace('-', '_')
+        if name == 'CONTENT_LENGTH':
+            continue
+        key = name if name == 'CONTENT_TYPE' else f'HTTP_{name}'
+        value = value.decode('latin-1')
+        environ[key] = f'{environ[key]},{value}' if key in environ else value
+    return environ
+
+
+class ASGIApp:
+    '''
+    ASGI application running a Flask app. Each request body is read on the
+    loop, then the WSGI app runs in a greenlet from which the database
+    driver's I/O and the sending of the response are awaited.
+    '''
+
+    def __init__(self, app):
+        self.app = app
+        self._started = False
+        self._start_lock = None
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+        elif scope['type'] == 'http':
+            await self.startup()
+            body = await self.read_body(receive)
+            await run_on_event_loop(self.handle, wsgi_environ(scope, body), send)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await self.startup()
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await run_on_event_loop(self.dispose_engines)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def startup(self):
+        '''
+        Opens a first connection to each database before serving requests:
+        SQLAlchemy initializes the dialect on the first connection while
+        holding a thread lock, which concurrent greenlets would deadlock on
+        '''
+        if self._started:
+            return
+        if self._start_lock is None:
+            self._start_lock = asyncio.Lock()
+        async with self._start_lock:
+            if not self._started:
+                await run_on_event_loop(self.connect_engines)
+                self._started = True
+
+    def engines(self):
+        binds = [None] + list(self.app.config.get('SQLALCHEMY_BINDS') or {})
+        return [(bind, db.get_engine(self.app, bind=bind)) for bind in binds]
+
+    def connect_engines(self):
+        with self.app.app_context():
+            for bind, engine in self.engines():
+                try:
+                    engine.connect().close()
+                except Exception:
+                    # A replica may be down; the health checks handle it
+                    if bind is None:
+                        raise
+
+    def dispose_engines(self):
+        with self.app.app_context():
+            for _, engine in self.engines():
+                engine.dispose()
+
+    async def read_body(self, receive):
+        chunks = []
+        more_body = True
+        while more_body:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                break
+            chunks.append(message.get('body', b''))
+            more_body = message.get('more_body', False)
+        return b''.join(chunks)
+
+    def handle(self, environ, send):
+        response = {}
+
+        def start_response(status, headers, exc_info=None):
+            if exc_info and response.get('sent'):
+                raise exc_info[1].with_traceback(exc_info[2])
+            response['status'] = int(status.split(' ', 1)[0])
+            response['headers'] = [(name.lower().encode('latin-1'), value.encode('latin-1'))
+                                   for name, value in headers]
+
+        def start():
+            if not response.get('sent'):
+                response['sent'] = True
+                wait(send({'type': 'http.response.start', 'status': response['status'],
+                           'headers': response['headers']}))
+
+        iterable = self.app(environ, start_response)
+        try:
+            for chunk in iterable:
+                if chunk:
+                    start()
+                    wait(send({'type': 'http.response.body', 'body': chunk,
+                               'more_body': True}))
+            start()
+            wait(send({'type': 'http.response.body', 'body': b''}))
+        finally:
+            if hasattr(iterable, 'close'):
+                iterable.close()
+
+
+def create_asgi_app(test_config=None):
+    '''
+    Creates the app with create_app, switched to the async driver of its
+    database and replicas, and wraps it for ASGI servers
+    '''
+    test_config = dict(test_config or {})
+    uri = test_config.get('SQLALCHEMY_DATABASE_URI', config.SQLALCHEMY_DATABASE_URI)
+    replicas = test_config.get('SQLALCHEMY_REPLICA_URIS', config.SQLALCHEMY_REPLICA_URIS)
+    test_config['SQLALCHEMY_DATABASE_URI'] = async_database_uri(uri)
+    test_config['SQLALCHEMY_REPLICA_URIS'] = [async_database_uri(replica) for replica in replicas]
+    return ASGIApp(create_app(test_config))
+
+
+application = create_asgi_app()
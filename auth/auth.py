@@ -1,9 +1,12 @@
-import json
-from flask import request, _request_ctx_stack
+from flask import Response, request, _request_ctx_stack
+from contextlib import ExitStack
 from functools import wraps
 from jose import jwt
-from urllib.request import urlopen
 import os
+from .jwks import JWKSError, get_jwks_store
+from .token_cache import token_cache
+from profiling import phase
+from ratelimit import rate_limiter
 
 # AUTH0_DOMAIN = 'fsnd5.us.auth0.com'
 # ALGORITHMS = ['RS256']
@@ -59,18 +62,21 @@ def get_token_auth_header():
     return token
 
 
-def check_permissions(permission, payload):
+def check_permissions(permission, payload, permissions=None):
     '''
     This functions checks if the decoded JWT includes the required permission,
-    otherwise, an error is raised
+    otherwise, an error is raised. `permissions` may be passed as a precomputed
+    set to avoid scanning the payload's list.
     '''
-    if 'permissions' not in payload:
-                        raise AuthError({
-                            'code': 'invalid_claims',
-                            'description': 'Permissions not included in JWT.'
-                        }, 400)
+    if permissions is None:
+        if 'permissions' not in payload:
+            raise AuthError({
+                'code': 'invalid_claims',
+                'description': 'Permissions not included in JWT.'
+            }, 400)
+        permissions = payload['permissions']
 
-    if permission not in payload['permissions']:
+    if permission not in permissions:
         raise AuthError({
             'code': 'unauthorized',
             'description': 'Permission not found.'
@@ -81,24 +87,19 @@ def verify_decode_jwt(token):
     '''
     This functions decodes the provided token, and validates it's format and values
     '''
-    jsonurl = urlopen(f'https://{AUTH0_DOMAIN}/.well-known/jwks.json')
-    jwks = json.loads(jsonurl.read())
     unverified_header = jwt.get_unverified_header(token)
-    rsa_key = {}
     if 'kid' not in unverified_header:
         raise AuthError({
             'code': 'invalid_header',
             'description': 'Authorization malformed.'
         }, 401)
-    for key in jwks['keys']:
-        if key['kid'] == unverified_header['kid']:
-            rsa_key = {
-                'kty': key['kty'],
-                'kid': key['kid'],
-                'use': key['use'],
-                'n': key['n'],
-                'e': key['e']
-            }
+    try:
+        rsa_key = get_jwks_store().get_key(unverified_header['kid'])
+    except JWKSError:
+        raise AuthError({
+            'code': 'jwks_unavailable',
+            'description': 'Unable to fetch the signing keys.'
+        }, 503)
     if rsa_key:
         try:
             payload = jwt.decode(
@@ -132,14 +133,33 @@ def verify_decode_jwt(token):
                 'description': 'Unable to find the appropriate key.'
             }, 400)
 
+def verify_request_token():
+    '''
+    This functions verifies the bearer token of the current request, going
+    through the cache of verified tokens first
+    '''
+    with phase('auth'):
+        token = get_token_auth_header()
+        verified = token_cache.get(token)
+        if verified is None:
+            verified = token_cache.put(token, verify_decode_jwt(token))
+        return verified
+
 def requires_auth(permission=''):
     def requires_auth_decorator(f):
         @wraps(f)
         def wrapper(*args, **kwargs):
-            token = get_token_auth_header()
-            payload = verify_decode_jwt(token)
-            check_permissions(permission, payload)
-            return f(payload, *args, **kwargs)
+            verified = verify_request_token()
+            if permission:
+                check_permissions(permission, verified.payload, verified.permissions)
+            _request_ctx_stack.top.current_user = verified.payload
+            with ExitStack() as stack:
+                stack.enter_context(rate_limiter.limit(verified.payload, permission))
+                response = f(verified.payload, *args, **kwargs)
+                if isinstance(response, Response) and response.is_streamed:
+                    # The request is in flight until its body is sent
+                    response.call_on_close(stack.pop_all().close)
+                return response
 
         return wrapper
     return requires_auth_decorator
\ No newline at end of file
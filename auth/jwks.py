@@ -0,0 +1,190 @@
+import json
+import logging
+import os
+import threading
+import time
+from urllib.request import urlopen
+
+from concurrency import IOLock, run_blocking
+
+logger = logging.getLogger(__name__)
+
+JWKS_CACHE_TTL = int(os.environ.get('JWKS_CACHE_TTL', 3600))
+JWKS_REFRESH_MARGIN = int(os.environ.get('JWKS_REFRESH_MARGIN', 300))
+JWKS_UNKNOWN_KID_COOLDOWN = int(os.environ.get('JWKS_UNKNOWN_KID_COOLDOWN', 30))
+JWKS_FETCH_TIMEOUT = int(os.environ.get('JWKS_FETCH_TIMEOUT', 5))
+
+
+## JWKSError Exception
+'''
+JWKSError Exception
+Raised when the key set can't be fetched and there are no cached keys to fall back to
+'''
+class JWKSError(Exception):
+    pass
+
+
+def default_jwks_url():
+    '''
+    Returns the JWKS location. JWKS_URL overrides the Auth0 domain, and may
+    point at a local file (file:///path/to/jwks.json) or a stand-in server.
+    '''
+    url = os.environ.get('JWKS_URL')
+    if url:
+        return url
+    return f"https://{os.environ.get('AUTH0_DOMAIN')}/.well-known/jwks.json"
+
+
+def parse_jwks(jwks):
+    '''
+    Extracts the RSA keys of a JWK set into a dict keyed by kid
+    '''
+    keys = {}
+    for key in jwks.get('keys', []):
+        if 'kid' not in key or key.get('kty') != 'RSA':
+            continue
+        keys[key['kid']] = {
+            'kty': key['kty'],
+            'kid': key['kid'],
+            'use': key.get('use', 'sig'),
+            'n': key['n'],
+            'e': key['e']
+        }
+    return keys
+
+
+class JWKSKeyStore:
+    '''
+    Process-wide cache of the signing keys published at a JWKS url.
+
+    Keys are held for `ttl` seconds. Once a lookup happens within
+    `refresh_margin` seconds of expiry, a single background refresh is started
+    so requests keep using the current keys instead of waiting on the fetch.
+    An unknown kid (e.g. after a key rotation) triggers one synchronous
+    refetch, shared by all concurrent callers, and at most once every
+    `unknown_kid_cooldown` seconds so bad tokens can't cause a fetch storm.
+    '''
+
+    def __init__(self, url, ttl=JWKS_CACHE_TTL,
+                 refresh_margin=JWKS_REFRESH_MARGIN,
+                 unknown_kid_cooldown=JWKS_UNKNOWN_KID_COOLDOWN,
+                 timeout=JWKS_FETCH_TIMEOUT, clock=time.monotonic):
+        self.url = url
+        self.ttl = ttl
+        self.refresh_margin = min(refresh_margin, ttl)
+        self.unknown_kid_cooldown = unknown_kid_cooldown
+        self.timeout = timeout
+        self.clock = clock
+
+        self._keys = {}
+        self._expires_at = 0
+        self._last_fetch = None
+        self._generation = 0
+        self._fetch_lock = IOLock()
+        self._refresh_thread = None
+        self.fetch_count = 0
+
+    def fetch(self):
+        '''
+        Downloads and parses the key set, without blocking the event loop
+        when served through asgi.py
+        '''
+        return parse_jwks(json.loads(run_blocking(self.download)))
+
+    def download(self):
+        with urlopen(self.url, timeout=self.timeout) as response:
+            return response.read()
+
+    def refresh(self, generation=None):
+        '''
+        Refetches the key set. Concurrent callers are collapsed into a single
+        fetch: whoever waited on the lock returns once the generation they saw
+        has been replaced.
+        '''
+        with self._fetch_lock:
+            if generation is not None and generation != self._generation:
+                return
+            if generation is not None and not self._keys and not self._cooldown_elapsed():
+                # The fetch this caller may have waited on just failed
+                raise JWKSError(f'Unable to fetch JWKS from {self.url}')
+            self._last_fetch = self.clock()
+            self.fetch_count += 1
+            try:
+                keys = self.fetch()
+            except Exception as e:
+                if not self._keys:
+                    raise JWKSError(f'Unable to fetch JWKS from {self.url}') from e
+                logger.warning('JWKS refresh failed, serving cached keys: %s', e)
+                self._expires_at = max(self._expires_at,
+                                       self._last_fetch + self.unknown_kid_cooldown)
+                return
+            self._keys = keys
+            self._expires_at = self._last_fetch + self.ttl
+            self._generation += 1
+
+    def _refresh_in_background(self, generation):
+        if self._refresh_thread is not None and self._refresh_thread.is_alive():
+            return
+        self._refresh_thread = threading.Thread(
+            target=self._background_refresh, args=(generation,), daemon=True)
+        self._refresh_thread.start()
+
+    def _background_refresh(self, generation):
+        try:
+            self.refresh(generation)
+        except JWKSError as e:
+            logger.warning('%s', e)
+
+    def get_key(self, kid):
+        '''
+        Returns the JWK for the given kid, or None if the key set doesn't
+        contain it
+        '''
+        now = self.clock()
+        generation = self._generation
+        if now >= self._expires_at:
+            self.refresh(generation)
+        elif (now >= self._expires_at - self.refresh_margin and
+              self._cooldown_elapsed()):
+            self._refresh_in_background(generation)
+
+        key = self._keys.get(kid)
+        if key is None and self._cooldown_elapsed():
+            self.refresh(self._generation)
+            key = self._keys.get(kid)
+        return key
+
+    def _cooldown_elapsed(self):
+        return (self._last_fetch is None or
+                self.clock() - self._last_fetch >= self.unknown_kid_cooldown)
+
+    def clear(self):
+        with self._fetch_lock:
+            self._keys = {}
+            self._expires_at = 0
+            self._last_fetch = None
+            self._generation += 1
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_jwks_store():
+    '''
+    Returns the process-wide key store, creating it on first use
+    '''
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                _store = JWKSKeyStore(default_jwks_url())
+    return _store
+
+
+def set_jwks_store(store):
+    '''
+    Replaces the process-wide key store, e.g. with one reading a local file
+    '''
+    global _store
+    _store = store
@@ -0,0 +1,109 @@
+import base64
+import time
+
+from jose import jwt
+
+from . import auth
+from .jwks import JWKSKeyStore, get_jwks_store, parse_jwks, set_jwks_store
+
+'''
+Stand-in for Auth0 used by the tests and the benchmarks: a local RSA key pair
+whose public half is served as the JWKS, and which mints tokens with any
+permissions, so no network access or real tenant is needed.
+'''
+
+ALL_PERMISSIONS = (
+    'get:actors', 'post:actors', 'patch:actors', 'delete:actors',
+    'get:movies', 'post:movies', 'patch:movies', 'delete:movies'
+)
+
+
+def generate_rsa_key(bits=2048):
+    '''
+    Returns (private key PEM, modulus, public exponent), using pycryptodome as
+    installed with python-jose-cryptodome, or cryptography otherwise
+    '''
+    try:
+        from Crypto.PublicKey import RSA
+    except ImportError:
+        from cryptography.hazmat.primitives import serialization
+        from cryptography.hazmat.primitives.asymmetric import rsa
+        key = rsa.generate_private_key(public_exponent=65537, key_size=bits)
+        pem = key.private_bytes(serialization.Encoding.PEM,
+                                serialization.PrivateFormat.TraditionalOpenSSL,
+                                serialization.NoEncryption())
+        numbers = key.public_key().public_numbers()
+        return pem.decode('ascii'), numbers.n, numbers.e
+    key = RSA.generate(bits)
+    return key.exportKey('PEM').decode('ascii'), key.n, key.e
+
+
+def b64_uint(value):
+    data = value.to_bytes((value.bit_length() + 7) // 8, 'big')
+    return base64.urlsafe_b64encode(data).decode('ascii').rstrip('=')
+
+
+class LocalKeyStore(JWKSKeyStore):
+    '''
+    Key store serving a key set held in memory instead of fetching it
+    '''
+
+    def __init__(self, jwks, **kwargs):
+        super().__init__('local', **kwargs)
+        self.jwks = jwks
+
+    def fetch(self):
+        return parse_jwks(self.jwks)
+
+
+class LocalAuthProvider:
+    '''
+    Mints tokens accepted by requires_auth once installed. install() points the
+    auth module at this provider's issuer, audience and keys; uninstall()
+    restores the previous settings.
+    '''
+
+    def __init__(self, domain='capstone.local', audience='casting', kid='local'):
+        self.domain = domain
+        self.audience = audience
+        self.kid = kid
+        self.private_key, modulus, exponent = generate_rsa_key()
+        self.jwks = {'keys': [{
+            'kty': 'RSA', 'kid': kid, 'use': 'sig', 'alg': 'RS256',
+            'n': b64_uint(modulus), 'e': b64_uint(exponent)
+        }]}
+        self._previous = None
+
+    def install(self):
+        if self._previous is None:
+            self._previous = (auth.AUTH0_DOMAIN, auth.API_AUDIENCE, auth.ALGORITHMS,
+                              get_jwks_store())
+        auth.AUTH0_DOMAIN = self.domain
+        auth.API_AUDIENCE = self.audience
+        auth.ALGORITHMS = ['RS256']
+        set_jwks_store(LocalKeyStore(self.jwks))
+        auth.token_cache.clear()
+        return self
+
+    def uninstall(self):
+        if self._previous is not None:
+            auth.AUTH0_DOMAIN, auth.API_AUDIENCE, auth.ALGORITHMS, store = self._previous
+            set_jwks_store(store)
+            auth.token_cache.clear()
+            self._previous = None
+
+    def token(self, permissions=ALL_PERMISSIONS, subject='local|user', expires_in=3600):
+        now = int(time.time())
+        claims = {
+            'iss': f'https://{self.domain}/',
+            'aud': self.audience,
+            'sub': subject,
+            'iat': now,
+            'exp': now + expires_in,
+            'permissions': list(permissions)
+        }
+        return jwt.encode(claims, self.private_key, algorithm='RS256',
+                          headers={'kid': self.kid})
+
+    def headers(self, permissions=ALL_PERMISSIONS, subject='local|user'):
+        return {'Authorization': f'Bearer {self.token(permissions, subject)}'}
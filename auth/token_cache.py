@@ -0,0 +1,96 @@
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+TOKEN_CACHE_SIZE = int(os.environ.get('TOKEN_CACHE_SIZE', 1024))
+TOKEN_CACHE_MAX_TTL = int(os.environ.get('TOKEN_CACHE_MAX_TTL', 3600))
+
+'''
+A verified token: the decoded payload, its permissions as a frozenset (None if
+the claim is missing) and the time at which the entry stops being valid
+'''
+VerifiedToken = namedtuple('VerifiedToken', ['payload', 'permissions', 'expires_at'])
+
+
+def token_digest(token):
+    return hashlib.sha256(token.encode('utf-8')).digest()
+
+
+class VerifiedTokenCache:
+    '''
+    Bounded LRU cache of tokens that already passed signature and claim
+    validation, keyed by a hash of the token. Entries are dropped once the
+    token's exp is reached (or after `max_ttl` seconds, whichever comes first)
+    and the least recently used entry is evicted when the cache is full.
+    '''
+
+    def __init__(self, maxsize=TOKEN_CACHE_SIZE, max_ttl=TOKEN_CACHE_MAX_TTL,
+                 clock=time.time):
+        self.maxsize = maxsize
+        self.max_ttl = max_ttl
+        self.clock = clock
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, token):
+        '''
+        Returns the VerifiedToken for the given token, or None
+        '''
+        digest = token_digest(token)
+        with self._lock:
+            entry = self._entries.get(digest)
+            if entry is None:
+                self.misses += 1
+                return None
+            if self.clock() >= entry.expires_at:
+                del self._entries[digest]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(digest)
+            self.hits += 1
+            return entry
+
+    def put(self, token, payload):
+        '''
+        Stores a verified payload and returns its VerifiedToken
+        '''
+        now = self.clock()
+        expires_at = now + self.max_ttl
+        if isinstance(payload.get('exp'), (int, float)):
+            expires_at = min(expires_at, payload['exp'])
+        permissions = payload.get('permissions')
+        if permissions is not None:
+            permissions = frozenset(permissions)
+        entry = VerifiedToken(payload, permissions, expires_at)
+        if self.maxsize <= 0 or expires_at <= now:
+            return entry
+
+        digest = token_digest(token)
+        with self._lock:
+            self._entries[digest] = entry
+            self._entries.move_to_end(digest)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+        return entry
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        return {
+            'size': len(self._entries),
+            'maxsize': self.maxsize,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions
+        }
+
+
+token_cache = VerifiedTokenCache()
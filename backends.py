@@ -0,0 +1,82 @@
+import sqlite3
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+'''
+Base classes of the stores behind the response cache, the rate limits and
+the idempotency keys, and the factory creating the store a setting names.
+'''
+
+
+class MemoryBackend:
+    '''
+    In-process LRU store of up to `maxsize` entries. Every process keeps its
+    own entries, so several gunicorn workers don't see each other's; the
+    stores offer a shared backend for when they must.
+    '''
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _store(self, key, value):
+        self._entries[key] = value
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class SQLiteBackend:
+    '''
+    Stand-in for a shared store such as Redis: a SQLite file opened by every
+    worker on the host, through one autocommit connection per thread. The
+    statements of SCHEMA create its tables.
+    '''
+    SCHEMA = ()
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        conn = self._connection()
+        for statement in self.SCHEMA:
+            conn.execute(statement)
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            self._local.conn = conn
+        return conn
+
+    @contextmanager
+    def _transaction(self):
+        conn = self._connection()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            yield conn
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+
+
+def create_backend(setting, url, backends):
+    '''
+    Creates the backend named by the `setting` config value `url`. `backends`
+    maps each accepted name to a callable creating the backend, or to None
+    for no backend; its "sqlite" entry is called with the path of a
+    "sqlite:///path/to/file.db" URL.
+    '''
+    if url.startswith('sqlite:///') and 'sqlite' in backends:
+        return backends['sqlite'](url[len('sqlite:///'):])
+    if url == 'sqlite' or url not in backends:
+        raise ValueError(f'Unknown {setting} backend: {url}')
+    backend = backends[url]
+    return backend() if backend else None
@@ -0,0 +1,295 @@
+'''
+Offline benchmarks. Starts the app with create_app on a seeded database and a
+local stand-in for Auth0, runs load scenarios through the WSGI test client and
+reports req/s and latency percentiles. Results are saved as JSON so a later run
+can be compared with them:
+
+    python -m benchmarks.run --size 10000 --requests 500
+    python -m benchmarks.run --database postgresql://localhost/capstone_bench
+    python -m benchmarks.run --compare benchmarks/results/baseline.json
+
+--server asgi runs the same scenarios against the ASGI serving mode (asgi.py),
+with --concurrency requests in flight on one event loop instead of threads:
+
+    python -m benchmarks.run --concurrency 32 --output sync.json
+    python -m benchmarks.run --concurrency 32 --server asgi --compare sync.json
+'''
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+
+from app import create_app
+from auth.local import LocalAuthProvider
+from benchmarks.scenarios import SCENARIOS
+from concurrency import run_on_event_loop
+from models import db, Actor, Movie
+from testing import ASGITestClient
+
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results')
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmarks the API offline.')
+    parser.add_argument('--database',
+                        help='database URL, dropped and recreated before seeding '
+                             '(default: a temporary SQLite file)')
+    parser.add_argument('--size', type=int, default=10000,
+                        help='number of actors and of movies seeded (default 10000)')
+    parser.add_argument('--requests', type=int, default=500,
+                        help='timed requests per scenario (default 500)')
+    parser.add_argument('--warmup', type=int, default=20,
+                        help='untimed requests per scenario (default 20)')
+    parser.add_argument('--concurrency', type=int, default=1,
+                        help='threads, or with --server asgi concurrent tasks, sending '
+                             'requests (default 1)')
+    parser.add_argument('--server', choices=('wsgi', 'asgi'), default='wsgi',
+                        help='serving mode: the WSGI app, or asgi.py on an event loop '
+                             '(default wsgi)')
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS),
+                        help=f'comma separated scenarios (default {",".join(SCENARIOS)})')
+    parser.add_argument('--cache', default='none',
+                        help='RESPONSE_CACHE setting (default none)')
+    parser.add_argument('--seed', type=int, default=0, help='random seed (default 0)')
+    parser.add_argument('--output', help='results file (default benchmarks/results/<time>.json)')
+    parser.add_argument('--compare', help='results file of a previous run to compare with')
+    parser.add_argument('--threshold', type=float, default=10.0,
+                        help='percent change in req/s or p95 reported as a regression '
+                             '(default 10)')
+    return parser.parse_args(argv)
+
+
+def seed_database(size, rng):
+    '''
+    Inserts `size` actors and `size` movies with deterministic values
+    '''
+    Actor.insert_many([{'name': f'Name {i}', 'age': rng.randint(1, 90),
+                        'gender': rng.choice('MF')} for i in range(size)])
+    Movie.insert_many([{'title': f'Title {i}',
+                        'release_date': datetime(rng.randint(1950, 2020),
+                                                 rng.randint(1, 12), rng.randint(1, 28))}
+                       for i in range(size)])
+
+
+def percentile(values, fraction):
+    '''
+    Nearest-rank percentile of sorted values
+    '''
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(round(fraction * (len(values) - 1))))]
+
+
+def measure(scenario, client, count):
+    '''
+    Sends `count` requests and returns their latencies and the number of
+    errors
+    '''
+    timings = []
+    failures = 0
+    for _ in range(count):
+        start = time.perf_counter()
+        response = scenario.request(client)
+        timings.append(time.perf_counter() - start)
+        if response.status_code >= 400:
+            failures += 1
+    return timings, failures
+
+
+def split(requests, concurrency):
+    return [requests // concurrency + (1 if i < requests % concurrency else 0)
+            for i in range(concurrency)]
+
+
+def summarize(measurements, elapsed):
+    latencies = sorted(latency for timings, _ in measurements for latency in timings)
+    return {
+        'requests': len(latencies),
+        'errors': sum(failures for _, failures in measurements),
+        'seconds': elapsed,
+        'rps': len(latencies) / elapsed if elapsed else None,
+        'mean_ms': 1000 * sum(latencies) / len(latencies) if latencies else None,
+        'p50_ms': 1000 * percentile(latencies, 0.50) if latencies else None,
+        'p95_ms': 1000 * percentile(latencies, 0.95) if latencies else None,
+        'p99_ms': 1000 * percentile(latencies, 0.99) if latencies else None
+    }
+
+
+def run_scenario(app, scenario, requests, warmup, concurrency):
+    '''
+    Sends `requests` timed requests spread over `concurrency` threads, after
+    `warmup` untimed ones, and returns the latencies and errors
+    '''
+    client = app.test_client()
+    scenario.setup(client)
+    measure(scenario, client, warmup)
+
+    measurements = []
+    lock = threading.Lock()
+
+    def worker(count):
+        measurement = measure(scenario, app.test_client(), count)
+        with lock:
+            measurements.append(measurement)
+
+    threads = [threading.Thread(target=worker, args=(count,))
+               for count in split(requests, concurrency)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return summarize(measurements, time.perf_counter() - start)
+
+
+async def run_scenario_async(application, scenario, requests, warmup, concurrency):
+    '''
+    Same as run_scenario against the ASGI app, with `concurrency` tasks
+    sharing the event loop
+    '''
+    client = ASGITestClient(application)
+
+    def prepare():
+        scenario.setup(client)
+        measure(scenario, client, warmup)
+
+    await run_on_event_loop(prepare)
+    start = time.perf_counter()
+    measurements = await asyncio.gather(*[
+        run_on_event_loop(measure, scenario, ASGITestClient(application), count)
+        for count in split(requests, concurrency)])
+    return summarize(measurements, time.perf_counter() - start)
+
+
+async def run_scenarios_async(application, scenarios, args):
+    # A single loop for every scenario, since pooled async connections
+    # belong to the loop that opened them
+    await application.startup()
+    results = {}
+    for name, scenario in scenarios:
+        results[name] = await run_scenario_async(application, scenario, args.requests,
+                                                 args.warmup, args.concurrency)
+    await run_on_event_loop(application.dispose_engines)
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+                              text=True, cwd=os.path.dirname(RESULTS_DIR)).stdout.strip()
+    except OSError:
+        return None
+
+
+def print_results(results):
+    print(f"{'scenario':<14}{'requests':>9}{'errors':>8}{'req/s':>10}"
+          f"{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}")
+    for name, result in results['scenarios'].items():
+        print(f"{name:<14}{result['requests']:>9}{result['errors']:>8}{result['rps']:>10.1f}"
+              f"{result['p50_ms']:>9.2f}{result['p95_ms']:>9.2f}{result['p99_ms']:>9.2f}")
+
+
+def compare(results, baseline, threshold):
+    '''
+    Prints the change of each scenario against the baseline and returns the
+    names of the scenarios that regressed by more than `threshold` percent
+    '''
+    regressions = []
+    print(f"\nCompared with {baseline['meta'].get('commit')} "
+          f"({baseline['meta'].get('timestamp')}):")
+    for key in ('server', 'database', 'size', 'concurrency', 'cache'):
+        if baseline['meta'].get(key) != results['meta'][key]:
+            print(f"Warning: {key} differs ({baseline['meta'].get(key)} before, "
+                  f"{results['meta'][key]} now)")
+    for name, result in results['scenarios'].items():
+        before = baseline['scenarios'].get(name)
+        if before is None:
+            continue
+        rps_change = 100 * (result['rps'] - before['rps']) / before['rps']
+        p95_change = 100 * (result['p95_ms'] - before['p95_ms']) / before['p95_ms']
+        regressed = rps_change < -threshold or p95_change > threshold
+        if regressed:
+            regressions.append(name)
+        print(f"{name:<14} req/s {rps_change:+7.1f}%   p95 {p95_change:+7.1f}%"
+              f"{'   REGRESSION' if regressed else ''}")
+    return regressions
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    names = [name for name in args.scenarios.split(',') if name]
+    unknown = [name for name in names if name not in SCENARIOS]
+    if unknown:
+        sys.exit(f'Unknown scenarios: {", ".join(unknown)}')
+
+    directory = tempfile.TemporaryDirectory()
+    database = args.database or f'sqlite:///{directory.name}/bench.db'
+    settings = {
+        'SQLALCHEMY_DATABASE_URI': database,
+        'RESPONSE_CACHE': args.cache,
+        'DEBUG': False
+    }
+    app = create_app(settings)
+    provider = LocalAuthProvider().install()
+    headers = provider.headers()
+    rng = random.Random(args.seed)
+
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        print(f'Seeding {args.size} actors and movies into {db.engine.url.get_backend_name()}...')
+        seed_database(args.size, rng)
+        dialect = db.engine.dialect.name
+
+    results = {
+        'meta': {
+            'timestamp': datetime.utcnow().isoformat(timespec='seconds'),
+            'commit': git_commit(),
+            'python': platform.python_version(),
+            'server': args.server,
+            'database': dialect,
+            'size': args.size,
+            'requests': args.requests,
+            'concurrency': args.concurrency,
+            'cache': args.cache
+        },
+        'scenarios': {}
+    }
+    scenarios = [(name, SCENARIOS[name](headers, args.size, rng)) for name in names]
+    if args.server == 'asgi':
+        from asgi import create_asgi_app
+        application = create_asgi_app(settings)
+        results['scenarios'] = asyncio.run(run_scenarios_async(application, scenarios, args))
+    else:
+        for name, scenario in scenarios:
+            results['scenarios'][name] = run_scenario(app, scenario, args.requests,
+                                                      args.warmup, args.concurrency)
+    print_results(results)
+
+    output = args.output or os.path.join(
+        RESULTS_DIR, f"{datetime.utcnow().strftime('%Y%m%d-%H%M%S')}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f'\nSaved to {output}')
+
+    provider.uninstall()
+    directory.cleanup()
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if compare(results, baseline, args.threshold):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,120 @@
+'''
+Load scenarios. Each one is a class whose request() performs one request with
+the given test client and returns the response; setup() runs once before the
+timed requests.
+'''
+
+
+class Scenario:
+    name = None
+
+    def __init__(self, headers, size, rng):
+        self.headers = headers
+        self.size = size
+        self.rng = rng
+
+    def setup(self, client):
+        pass
+
+    def request(self, client):
+        raise NotImplementedError
+
+
+class ListActors(Scenario):
+    '''
+    First page of actors with the default page size
+    '''
+    name = 'list'
+
+    def request(self, client):
+        return client.get('/actors', headers=self.headers)
+
+
+class ListActorsFields(Scenario):
+    '''
+    First page of actors, selecting only id and name
+    '''
+    name = 'list_fields'
+
+    def request(self, client):
+        return client.get('/actors?fields=id,name', headers=self.headers)
+
+
+class ListActorsGzip(Scenario):
+    '''
+    First page of actors, gzipped
+    '''
+    name = 'list_gzip'
+
+    def request(self, client):
+        return client.get('/actors', headers=dict(self.headers, **{'Accept-Encoding': 'gzip'}))
+
+
+class ListActorsColumnar(Scenario):
+    '''
+    First page of actors in the columnar JSON encoding
+    '''
+    name = 'list_columnar'
+
+    def request(self, client):
+        return client.get('/actors', headers=dict(
+            self.headers, Accept='application/vnd.capstone.columnar+json'))
+
+
+class PaginateMovies(Scenario):
+    '''
+    Walks the movies sorted by release date one page per request, following
+    the cursors and starting over after the last page
+    '''
+    name = 'paginate'
+
+    def setup(self, client):
+        self.cursor = None
+
+    def request(self, client):
+        url = '/movies?sort=-release_date&limit=100'
+        if self.cursor:
+            url += f'&cursor={self.cursor}'
+        response = client.get(url, headers=self.headers)
+        self.cursor = response.get_json()['next'] if response.status_code == 200 else None
+        return response
+
+
+class BulkInsertActors(Scenario):
+    '''
+    Inserts 100 actors per request through the bulk endpoint
+    '''
+    name = 'bulk_insert'
+
+    def request(self, client):
+        actors = [{'name': f'Bench {self.rng.random()}', 'age': self.rng.randint(1, 90),
+                   'gender': self.rng.choice('MF')} for _ in range(100)]
+        return client.post('/actors/bulk', json=actors, headers=self.headers)
+
+
+class PatchActor(Scenario):
+    '''
+    Updates a random seeded actor
+    '''
+    name = 'patch'
+
+    def request(self, client):
+        actor_id = self.rng.randint(1, self.size)
+        return client.patch(f'/actors/{actor_id}', headers=self.headers, json={
+            'name': f'Patched {actor_id}', 'age': self.rng.randint(1, 90),
+            'gender': self.rng.choice('MF')})
+
+
+class SearchCatalog(Scenario):
+    '''
+    Searches actors and movies by a name prefix
+    '''
+    name = 'search'
+
+    def request(self, client):
+        return client.get(f'/search?q=name {self.rng.randint(1, 99)}', headers=self.headers)
+
+
+SCENARIOS = {scenario.name: scenario for scenario in
+             (ListActors, ListActorsFields, ListActorsGzip, ListActorsColumnar,
+              PaginateMovies, BulkInsertActors, PatchActor, SearchCatalog)}
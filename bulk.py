@@ -0,0 +1,129 @@
+import json
+
+from flask import abort, current_app, request
+
+from export import NDJSON_MIMETYPE
+
+
+def read_records():
+    '''
+    Reads the records of a bulk request, sent either as a JSON array or as
+    NDJSON (one object per line). Lines that aren't valid JSON are returned
+    as ValueError instances so they can be reported per row.
+    '''
+    if request.mimetype == NDJSON_MIMETYPE:
+        records = []
+        for line in request.get_data(as_text=True).splitlines():
+            if not line.strip():
+                continue
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                records.append(ValueError('invalid JSON'))
+    else:
+        records = request.get_json(silent=True)
+        if not isinstance(records, list):
+            abort(400)
+
+    if len(records) > current_app.config['MAX_BULK_SIZE']:
+        abort(413)
+    return records
+
+
+def bulk_create(model, validator):
+    '''
+    Validates every record of the request up front, then inserts the valid
+    ones in a single transaction. Returns the created ids and the per-row errors.
+    '''
+    rows = []
+    errors = []
+    for index, record in enumerate(read_records()):
+        try:
+            if isinstance(record, ValueError):
+                raise record
+            rows.append(validator(record))
+        except ValueError as e:
+            errors.append({'index': index, 'message': str(e)})
+
+    created = model.insert_many(rows) if rows else []
+    return {
+        'success': not errors,
+        'created': created,
+        'errors': errors
+    }
+
+
+def parse_id(value):
+    if isinstance(value, bool) or not isinstance(value, (int, str)):
+        abort(400)
+    try:
+        return int(value)
+    except ValueError:
+        abort(400)
+
+
+def read_ids():
+    '''
+    Reads the ids of a batch request from a JSON body {"ids": [...]} or from
+    an `ids` query parameter such as ?ids=1,2,3
+    '''
+    if 'ids' in request.args:
+        ids = [part for part in request.args['ids'].split(',') if part]
+    else:
+        body = request.get_json(silent=True)
+        if not isinstance(body, dict) or not isinstance(body.get('ids'), list):
+            abort(400)
+        ids = body['ids']
+    if len(ids) > current_app.config['MAX_BULK_SIZE']:
+        abort(413)
+    return list(dict.fromkeys(parse_id(row_id) for row_id in ids))
+
+
+def batch_update(model, validator):
+    '''
+    Applies partial updates to many rows in one transaction. The body is
+    either a list of objects with an id and the fields to change, or
+    {"ids": [...], "set": {...}} to apply the same change to every id.
+    Any invalid update rejects the whole batch.
+    '''
+    body = request.get_json(silent=True)
+    if isinstance(body, dict) and 'ids' in body:
+        if not isinstance(body['ids'], list) or not isinstance(body.get('set'), dict):
+            abort(400)
+        records = [dict(body['set'], id=row_id) for row_id in body['ids']]
+    elif isinstance(body, list):
+        records = body
+    else:
+        abort(400)
+    if len(records) > current_app.config['MAX_BULK_SIZE']:
+        abort(413)
+
+    updates = {}
+    for record in records:
+        if not isinstance(record, dict) or 'id' not in record:
+            abort(400)
+        fields = {key: value for key, value in record.items() if key != 'id'}
+        try:
+            values = validator(fields, partial=True)
+        except ValueError:
+            abort(400)
+        updates.setdefault(parse_id(record['id']), {}).update(values)
+
+    updated, missing = model.update_many(updates)
+    return {
+        'success': True,
+        'updated': updated,
+        'missing': missing
+    }
+
+
+def batch_delete(model):
+    '''
+    Deletes many rows in one transaction and reports the ids that didn't exist
+    '''
+    deleted, missing = model.delete_many(read_ids())
+    return {
+        'success': True,
+        'deleted': deleted,
+        'missing': missing
+    }
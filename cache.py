@@ -0,0 +1,143 @@
+import json
+import time
+from functools import partial, wraps
+
+from flask import Response, request
+
+from backends import MemoryBackend, SQLiteBackend, create_backend
+from export import wants_ndjson
+from formats import negotiate_list_format
+from conditional import table_versions
+from models import resolve_tables
+from routing import replica_router
+
+
+class MemoryCacheBackend(MemoryBackend):
+    '''
+    Entries are keyed by the table versions in the database, so a worker
+    sees the writes made through another one all the same.
+    '''
+
+    def __init__(self, maxsize=256):
+        super().__init__(maxsize)
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, expires_at = entry
+            if time.time() >= expires_at:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            self._store(key, (value, time.time() + ttl))
+
+
+class SQLiteCacheBackend(SQLiteBackend):
+    '''
+    A response built by one worker is served by all.
+    '''
+    SCHEMA = ('CREATE TABLE IF NOT EXISTS entries '
+              '(key TEXT PRIMARY KEY, value BLOB, expires_at REAL)',)
+
+    def __init__(self, path, maxsize=256):
+        self.maxsize = maxsize
+        super().__init__(path)
+
+    def get(self, key):
+        row = self._connection().execute(
+            'SELECT value, expires_at FROM entries WHERE key = ?', (key,)).fetchone()
+        if row is None or time.time() >= row[1]:
+            return None
+        return row[0]
+
+    def set(self, key, value, ttl):
+        conn = self._connection()
+        conn.execute('INSERT OR REPLACE INTO entries VALUES (?, ?, ?)',
+                     (key, value, time.time() + ttl))
+        conn.execute('DELETE FROM entries WHERE expires_at <= ? OR key NOT IN '
+                     '(SELECT key FROM entries ORDER BY expires_at DESC LIMIT ?)',
+                     (time.time(), self.maxsize))
+
+    def clear(self):
+        self._connection().execute('DELETE FROM entries')
+
+
+class ResponseCache:
+    '''
+    Caches serialized GET responses keyed by endpoint, query parameters and
+    the versions of the tables they read, from the table_version rows every
+    worker shares. A committed write to a table bumps its version, so every
+    response built from older data stops matching in all the workers.
+    '''
+
+    def __init__(self, app=None):
+        self.backend = None
+        self.ttl = 60
+        self.hits = 0
+        self.misses = 0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        maxsize = app.config['RESPONSE_CACHE_SIZE']
+        self.backend = create_backend('RESPONSE_CACHE', app.config['RESPONSE_CACHE'], {
+            'none': None,
+            'memory': partial(MemoryCacheBackend, maxsize),
+            'sqlite': partial(SQLiteCacheBackend, maxsize=maxsize)
+        })
+        self.ttl = app.config['RESPONSE_CACHE_TTL']
+
+    def key(self, endpoint, tables, args):
+        versions = table_versions(resolve_tables(tables))
+        params = sorted(args.items(multi=True))
+        return json.dumps([endpoint, sorted((table, version) for table, (version, _)
+                                            in versions.items()), params],
+                          separators=(',', ':'))
+
+    def get(self, key):
+        value = self.backend.get(key)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    def set(self, key, value):
+        self.backend.set(key, value, self.ttl)
+
+    def cached(self, *tables):
+        '''
+        Decorator caching the JSON body of a view that reads the given tables
+        (or callables returning table names for the current request).
+        The versions are read before the view runs, so a write committed
+        while the response is built can't be hidden by it. Requests reading
+        the primary right after a write of their subject skip the cache,
+        which may hold responses built from a replica.
+        '''
+        def cached_decorator(f):
+            @wraps(f)
+            def wrapper(*args, **kwargs):
+                if self.backend is None or wants_ndjson() or negotiate_list_format() \
+                        or replica_router.in_write_window():
+                    return f(*args, **kwargs)
+                key = self.key(request.endpoint, tables, request.args)
+                body = self.get(key)
+                if body is not None:
+                    return Response(body, mimetype='application/json')
+                response = f(*args, **kwargs)
+                if (isinstance(response, Response) and response.status_code == 200
+                        and response.mimetype == 'application/json'
+                        and not response.is_streamed):
+                    self.set(key, response.get_data())
+                return response
+            return wrapper
+        return cached_decorator
+
+
+response_cache = ResponseCache()
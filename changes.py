@@ -0,0 +1,159 @@
+import time
+from datetime import datetime, timedelta
+
+from flask import current_app
+from sqlalchemy import func
+
+from concurrency import IOEvent
+from models import db, on_write, Actor, ChangeLog, Movie
+from serializer import dumps, format_datetime, get_serializer
+
+'''
+Change feed read by GET /changes. Every write through the models appends its
+inserts, updates and deletes to change_log in its own transaction, so a
+consumer keeps in sync by asking for the entries after the last sequence
+number it has seen, instead of listing the tables again.
+'''
+
+'''
+Models whose changes are in the feed, keyed by the change type
+'''
+CHANGE_TYPES = {
+    'actor': Actor,
+    'movie': Movie
+}
+
+
+def gap_cutoff():
+    return datetime.utcnow() - timedelta(seconds=current_app.config['CHANGES_GAP_TIMEOUT'])
+
+
+def read_log(since, limit=None):
+    '''
+    Returns up to `limit` change log entries after the sequence number
+    `since`, in order, ending before the first missing sequence number: the
+    transaction holding it may still commit. A gap before an entry older
+    than CHANGES_GAP_TIMEOUT seconds is skipped, as the transaction that
+    left it was rolled back.
+    '''
+    entries = db.session.query(ChangeLog).filter(ChangeLog.seq > since)\
+        .order_by(ChangeLog.seq).limit(limit).all()
+    cutoff = gap_cutoff()
+    for index, entry in enumerate(entries):
+        if entry.seq != since + 1 and entry.changed_at >= cutoff:
+            return entries[:index]
+        since = entry.seq
+    return entries
+
+
+def settled_seq():
+    '''
+    Returns the sequence number up to which the change log won't change
+    any more
+    '''
+    return db.session.query(func.max(ChangeLog.seq))\
+        .filter(ChangeLog.changed_at < gap_cutoff()).scalar() or 0
+
+
+def read_changes(since, types, limit):
+    '''
+    Returns up to `limit` changes of the given types after the sequence
+    number `since`, each with the current row of the changed actor or movie,
+    or None when it no longer exists, and the sequence number to read the
+    next ones after
+    '''
+    entries = read_log(since, limit)
+    if entries:
+        since = entries[-1].seq
+    entries = [entry for entry in entries if entry.model in types]
+    current = {}
+    for type_ in types:
+        ids = {entry.entity_id for entry in entries if entry.model == type_}
+        if ids:
+            model = CHANGE_TYPES[type_]
+            serializer = get_serializer(model)
+            rows = serializer.rows(serializer.query().filter(model.id.in_(ids)))
+            current[type_] = {row['id']: row for row in rows}
+    return [{
+        'seq': entry.seq,
+        'type': entry.model,
+        'id': entry.entity_id,
+        'action': entry.action,
+        'changed_at': format_datetime(entry.changed_at),
+        'data': current.get(entry.model, {}).get(entry.entity_id)
+    } for entry in entries], since
+
+
+def format_event(change):
+    return f"id: {change['seq']}\nevent: change\ndata: {dumps(change).decode('utf-8')}\n\n"
+
+
+class ChangeFeed:
+    '''
+    Waits for changes by reading the change log every CHANGES_POLL_INTERVAL
+    seconds. The writes of this process wake the waiters right away. The
+    database connection is returned to the pool between reads.
+    '''
+
+    def __init__(self, app=None):
+        self._changed = IOEvent()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self._changed.clear()
+        on_write(self.notify)
+
+    def notify(self, table):
+        if table == ChangeLog.__tablename__:
+            self._changed.set()
+
+    def wait(self, timeout):
+        db.session.close()
+        self._changed.wait(timeout)
+        self._changed.clear()
+
+    def poll(self, since, types, limit, timeout):
+        '''
+        Returns the changes after `since`, waiting up to `timeout` seconds
+        for one when there are none yet, and the sequence number to read the
+        next ones after
+        '''
+        deadline = time.monotonic() + timeout
+        while True:
+            changes, since = read_changes(since, types, limit)
+            remaining = deadline - time.monotonic()
+            if changes or remaining <= 0:
+                return changes, since
+            self.wait(min(current_app.config['CHANGES_POLL_INTERVAL'], remaining))
+
+    def stream(self, since, types, limit):
+        '''
+        Yields the changes after `since` as Server-Sent Events as they come,
+        with a comment every CHANGES_HEARTBEAT seconds without changes, for
+        CHANGES_STREAM_MAX_AGE seconds. Clients reconnect with the
+        Last-Event-ID header to resume.
+        '''
+        config = current_app.config
+        started = sent = time.monotonic()
+        yield f"retry: {int(config['CHANGES_POLL_INTERVAL'] * 1000)}\n\n"
+        while True:
+            # Read at least once, so a short-lived stream still sends the
+            # changes already there
+            changes, next_since = read_changes(since, types, limit)
+            for change in changes:
+                yield format_event(change)
+            if changes:
+                sent = time.monotonic()
+            elif time.monotonic() - sent >= config['CHANGES_HEARTBEAT']:
+                yield ': keep-alive\n\n'
+                sent = time.monotonic()
+            if time.monotonic() - started >= config['CHANGES_STREAM_MAX_AGE']:
+                break
+            if next_since - since < limit:
+                self.wait(config['CHANGES_POLL_INTERVAL'])
+            since = next_since
+        db.session.close()
+
+
+change_feed = ChangeFeed()
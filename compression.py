@@ -0,0 +1,142 @@
+import zlib
+
+from flask import request
+
+from formats import COLUMNAR_JSON_MIMETYPE, COLUMNAR_MSGPACK_MIMETYPE, MSGPACK_MIMETYPE
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+'''
+Content-Encoding negotiation of the responses. Bodies at least
+COMPRESSION_MIN_SIZE bytes long are compressed with brotli (when installed,
+see requirements-dev.txt) or gzip, whichever the client's Accept-Encoding
+prefers; streamed responses, such as exports, are compressed as they are
+streamed.
+'''
+
+COMPRESSIBLE_MIMETYPES = ('application/json', 'application/x-ndjson', MSGPACK_MIMETYPE,
+                          COLUMNAR_JSON_MIMETYPE, COLUMNAR_MSGPACK_MIMETYPE)
+
+
+class BrotliCompressor:
+    '''
+    brotli.Compressor with the interface of zlib's compression objects
+    '''
+
+    def __init__(self, quality):
+        self._compressor = brotli.Compressor(quality=quality)
+
+    def compress(self, data):
+        return self._compressor.process(data)
+
+    def flush(self):
+        return self._compressor.finish()
+
+
+def compressible(mimetype):
+    # Event streams must reach the client event by event
+    if mimetype == 'text/event-stream':
+        return False
+    return mimetype in COMPRESSIBLE_MIMETYPES or mimetype.startswith('text/')
+
+
+def compress_chunks(chunks, compressor):
+    try:
+        for chunk in chunks:
+            if isinstance(chunk, str):
+                chunk = chunk.encode('utf-8')
+            data = compressor.compress(chunk)
+            if data:
+                yield data
+        yield compressor.flush()
+    finally:
+        if hasattr(chunks, 'close'):
+            chunks.close()
+
+
+def etag_variants(etag):
+    '''
+    Returns `etag` and the ETags of its compressed variants, which an
+    If-None-Match header may hold
+    '''
+    return [etag] + [f'{etag}-{encoding}' for encoding in ('br', 'gzip')]
+
+
+class Compression:
+
+    def __init__(self, app=None):
+        self.enabled = False
+        self.min_size = 1024
+        self.level = 6
+        self.brotli_quality = 4
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.enabled = app.config['COMPRESSION_ENABLED']
+        self.min_size = app.config['COMPRESSION_MIN_SIZE']
+        self.level = app.config['COMPRESSION_LEVEL']
+        self.brotli_quality = app.config['COMPRESSION_BROTLI_QUALITY']
+        app.after_request(self.compress)
+
+    def encodings(self):
+        return ['br', 'gzip'] if brotli is not None else ['gzip']
+
+    def compressor(self, encoding):
+        if encoding == 'br':
+            return BrotliCompressor(self.brotli_quality)
+        # wbits 31 writes the gzip header and trailer
+        return zlib.compressobj(self.level, zlib.DEFLATED, 31)
+
+    def tag_not_modified(self, response):
+        '''
+        Gives a 304 the ETag of the variant the client holds: the one its
+        If-None-Match matched, else the one of the encoding its
+        Accept-Encoding selects
+        '''
+        etag, weak = response.get_etag()
+        if not etag or weak:
+            return response
+        response.vary.add('Accept-Encoding')
+        encoding = request.accept_encodings.best_match(self.encodings())
+        if encoding is None:
+            return response
+        variant = f'{etag}-{encoding}'
+        if variant in request.if_none_match or etag not in request.if_none_match:
+            response.set_etag(variant)
+        return response
+
+    def compress(self, response):
+        if self.enabled and response.status_code == 304:
+            return self.tag_not_modified(response)
+        if not self.enabled or response.direct_passthrough \
+                or 'Content-Encoding' in response.headers \
+                or response.status_code in (204, 206) or request.method == 'HEAD' \
+                or not compressible(response.mimetype):
+            return response
+        response.vary.add('Accept-Encoding')
+        encoding = request.accept_encodings.best_match(self.encodings())
+        if encoding is None:
+            return response
+
+        if response.is_streamed:
+            response.response = compress_chunks(response.response, self.compressor(encoding))
+            response.headers.pop('Content-Length', None)
+        else:
+            data = response.get_data()
+            if len(data) < self.min_size:
+                return response
+            compressor = self.compressor(encoding)
+            response.set_data(compressor.compress(data) + compressor.flush())
+        response.headers['Content-Encoding'] = encoding
+        # The ETag of the uncompressed body must not match the compressed one
+        etag, weak = response.get_etag()
+        if etag and not weak:
+            response.set_etag(f'{etag}-{encoding}')
+        return response
+
+
+compression = Compression()
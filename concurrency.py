@@ -0,0 +1,133 @@
+import asyncio
+import threading
+from contextvars import ContextVar
+
+from sqlalchemy.util import await_only, greenlet_spawn
+
+'''
+Helpers for code that runs either in a worker thread, when served by
+gunicorn's sync workers, or in a greenlet on the event loop, when served
+through asgi.py. In a greenlet, waiting must go through the loop: blocking the
+thread would stall every other request, including the one being waited on.
+'''
+
+_on_event_loop = ContextVar('on_event_loop', default=False)
+
+
+async def run_on_event_loop(fn, *args):
+    '''
+    Runs the blocking function fn(*args) in a greenlet whose database and
+    other I/O is awaited on the running event loop
+    '''
+    token = _on_event_loop.set(True)
+    try:
+        return await greenlet_spawn(fn, *args)
+    finally:
+        _on_event_loop.reset(token)
+
+
+def on_event_loop():
+    '''
+    Tells whether the caller runs in a greenlet started by run_on_event_loop
+    '''
+    return _on_event_loop.get()
+
+
+def wait(awaitable):
+    '''
+    Waits for an awaitable from a greenlet started by run_on_event_loop
+    '''
+    return await_only(awaitable)
+
+
+def run_blocking(fn, *args):
+    '''
+    Calls fn(*args), in the loop's default executor when on the event loop
+    so other requests keep being served meanwhile
+    '''
+    if on_event_loop():
+        return wait(asyncio.get_running_loop().run_in_executor(None, fn, *args))
+    return fn(*args)
+
+
+class IOLock:
+    '''
+    Lock that may be held across I/O. Greenlets on the event loop poll for it
+    instead of blocking, since blocking the loop's thread would also stop the
+    greenlet holding the lock.
+    '''
+    POLL_INTERVAL = 0.005
+
+    def __init__(self):
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        if on_event_loop():
+            while not self._lock.acquire(blocking=False):
+                wait(asyncio.sleep(self.POLL_INTERVAL))
+        else:
+            self._lock.acquire()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._lock.release()
+
+
+class IOEvent:
+    '''
+    Event that greenlets on the event loop wait for on the loop, so the
+    thread or greenlet setting it keeps running meanwhile
+    '''
+
+    def __init__(self):
+        self._event = threading.Event()
+        self._waiters = []
+        self._lock = threading.Lock()
+
+    def is_set(self):
+        return self._event.is_set()
+
+    def set(self):
+        with self._lock:
+            self._event.set()
+            waiters, self._waiters = self._waiters, []
+        for loop, waiter in waiters:
+            if not loop.is_closed():
+                loop.call_soon_threadsafe(waiter.set)
+
+    def clear(self):
+        self._event.clear()
+
+    def wait(self, timeout=None):
+        '''
+        Waits until the event is set or `timeout` seconds have passed, and
+        returns whether it is set
+        '''
+        if not on_event_loop():
+            return self._event.wait(timeout)
+        with self._lock:
+            if self._event.is_set():
+                return True
+            entry = (asyncio.get_running_loop(), asyncio.Event())
+            self._waiters.append(entry)
+        try:
+            wait(asyncio.wait_for(entry[1].wait(), timeout))
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            with self._lock:
+                if entry in self._waiters:
+                    self._waiters.remove(entry)
+        return self._event.is_set()
+
+
+def spawn(fn, *args):
+    '''
+    Runs fn(*args) in the background: as a task of the event loop when called
+    from it, otherwise in a daemon thread
+    '''
+    if on_event_loop():
+        return asyncio.get_running_loop().create_task(run_on_event_loop(fn, *args))
+    thread = threading.Thread(target=fn, args=args, daemon=True)
+    thread.start()
+    return thread
@@ -0,0 +1,73 @@
+import hashlib
+from datetime import datetime, timedelta
+from functools import wraps
+
+from flask import Response, request
+
+from compression import etag_variants
+from export import wants_ndjson
+from formats import negotiate_list_format
+from models import db, TableVersion, resolve_tables
+
+
+def table_versions(tables):
+    '''
+    Returns {table: (version, updated_at)} with a single primary key lookup
+    '''
+    rows = db.session.query(TableVersion.name, TableVersion.version, TableVersion.updated_at)\
+        .filter(TableVersion.name.in_(tables))
+    versions = {row.name: (row.version, row.updated_at) for row in rows}
+    return {table: versions.get(table, (0, None)) for table in tables}
+
+
+def compute_etag(endpoint, versions, args):
+    list_format = negotiate_list_format()
+    parts = [endpoint, str(wants_ndjson()), list_format.mimetype if list_format else 'json']
+    parts += [f'{table}:{version}' for table, (version, _) in sorted(versions.items())]
+    parts += [f'{key}={value}' for key, value in sorted(args.items(multi=True))]
+    return hashlib.sha1('\n'.join(parts).encode('utf-8')).hexdigest()
+
+
+def not_modified(etag, last_modified):
+    '''
+    Checks the request's validators. If-Modified-Since is only honored when
+    there is no If-None-Match, and only once the last write is more than a
+    second old, since HTTP dates can't tell apart two writes in one second.
+    '''
+    if request.if_none_match:
+        return any(request.if_none_match.contains(tag) for tag in etag_variants(etag))
+    if request.if_modified_since is None or last_modified is None:
+        return False
+    if datetime.utcnow() - last_modified < timedelta(seconds=1):
+        return False
+    since = request.if_modified_since.replace(tzinfo=None)
+    return last_modified.replace(microsecond=0) <= since
+
+
+def conditional(*tables):
+    '''
+    Decorator adding ETag and Last-Modified headers derived from the versions
+    of the tables a view reads, and answering 304 from them before the view
+    runs any query
+    '''
+    def conditional_decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            versions = table_versions(resolve_tables(tables))
+            etag = compute_etag(request.endpoint, versions, request.args)
+            dates = [updated_at for _, updated_at in versions.values() if updated_at]
+            last_modified = max(dates) if dates else None
+
+            if not_modified(etag, last_modified):
+                response = Response(status=304)
+            else:
+                response = f(*args, **kwargs)
+                if not isinstance(response, Response) or response.status_code != 200:
+                    return response
+            response.set_etag(etag)
+            response.vary.add('Accept')
+            if last_modified is not None:
+                response.last_modified = last_modified
+            return response
+        return wrapper
+    return conditional_decorator
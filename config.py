@@ -1,5 +1,7 @@
 import os
-SECRET_KEY = os.urandom(32)
+# Signs the read-your-writes markers, so every worker must share it; a
+# random key is only shared by the workers forked with --preload
+SECRET_KEY = os.environ.get('SECRET_KEY', '').encode() or os.urandom(32)
 # Grabs the folder where the script runs.
 basedir = os.path.abspath(os.path.dirname(__file__))
 
@@ -10,3 +12,110 @@ SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_PATH')
 if database_path:
     SQLALCHEMY_DATABASE_URI = database_path.replace('postgres', 'postgresql')
 SQLALCHEMY_TRACK_MODIFICATIONS = False
+
+# Read replicas, comma-separated. GET requests read from them unless the
+# same user wrote within READ_YOUR_WRITES_WINDOW seconds.
+SQLALCHEMY_REPLICA_URIS = [uri.strip().replace('postgres://', 'postgresql://')
+                           for uri in os.environ.get('DATABASE_REPLICA_URLS', '').split(',')
+                           if uri.strip()]
+READ_YOUR_WRITES_WINDOW = float(os.environ.get('READ_YOUR_WRITES_WINDOW', 5))
+REPLICA_HEALTH_CHECK_INTERVAL = float(os.environ.get('REPLICA_HEALTH_CHECK_INTERVAL', 10))
+
+# Pagination of the list endpoints
+PAGE_SIZE = int(os.environ.get('PAGE_SIZE', 50))
+MAX_PAGE_SIZE = int(os.environ.get('MAX_PAGE_SIZE', 200))
+
+# Rows fetched per round trip when streaming an export
+EXPORT_BATCH_SIZE = int(os.environ.get('EXPORT_BATCH_SIZE', 1000))
+
+# Engine of GET /search: "postgres" (full-text search), "memory" (in-process
+# prefix index), or "auto" to use Postgres when the database is Postgres
+SEARCH_ENGINE = os.environ.get('SEARCH_ENGINE', 'auto')
+
+# Largest number of records accepted by the bulk endpoints
+MAX_BULK_SIZE = int(os.environ.get('MAX_BULK_SIZE', 10000))
+
+# Cache of the list responses: "memory", "none", or a shared
+# "sqlite:///path/to/cache.db" for several workers on one host
+RESPONSE_CACHE = os.environ.get('RESPONSE_CACHE', 'memory')
+RESPONSE_CACHE_TTL = int(os.environ.get('RESPONSE_CACHE_TTL', 60))
+RESPONSE_CACHE_SIZE = int(os.environ.get('RESPONSE_CACHE_SIZE', 256))
+
+# Database connection pool, per gunicorn worker
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 5))
+DB_MAX_OVERFLOW = int(os.environ.get('DB_MAX_OVERFLOW', 10))
+DB_POOL_TIMEOUT = int(os.environ.get('DB_POOL_TIMEOUT', 30))
+DB_POOL_RECYCLE = int(os.environ.get('DB_POOL_RECYCLE', 1800))
+DB_POOL_PRE_PING = os.environ.get('DB_POOL_PRE_PING', 'true').lower() == 'true'
+# Milliseconds, 0 disables the timeout (Postgres only)
+DB_STATEMENT_TIMEOUT = int(os.environ.get('DB_STATEMENT_TIMEOUT', 0))
+
+# Exposes the /metrics endpoints
+METRICS_ENABLED = os.environ.get('METRICS_ENABLED', 'false').lower() == 'true'
+
+# Adds Server-Timing headers and allows cProfile runs of sampled requests and
+# of requests sent with X-Profile by callers holding profile:requests
+PROFILING_ENABLED = os.environ.get('PROFILING_ENABLED', 'false').lower() == 'true'
+PROFILE_SAMPLE_RATE = float(os.environ.get('PROFILE_SAMPLE_RATE', 0))
+PROFILE_DIR = os.environ.get('PROFILE_DIR')
+
+# Writes sent with "Prefer: respond-async" are journaled and answered with 202,
+# then applied by a background worker in group commits of up to
+# WRITE_BEHIND_BATCH_SIZE writes, after waiting at most WRITE_BEHIND_MAX_DELAY
+# milliseconds for a batch to fill. With WRITE_BEHIND_WORKER disabled the
+# journal is applied by `python manage.py apply_writes`. A write failing
+# WRITE_BEHIND_MAX_ATTEMPTS times in a row is marked failed.
+WRITE_BEHIND_ENABLED = os.environ.get('WRITE_BEHIND_ENABLED', 'false').lower() == 'true'
+WRITE_BEHIND_BATCH_SIZE = int(os.environ.get('WRITE_BEHIND_BATCH_SIZE', 100))
+WRITE_BEHIND_MAX_DELAY = float(os.environ.get('WRITE_BEHIND_MAX_DELAY', 10))
+WRITE_BEHIND_WORKER = os.environ.get('WRITE_BEHIND_WORKER', 'true').lower() == 'true'
+WRITE_BEHIND_MAX_ATTEMPTS = int(os.environ.get('WRITE_BEHIND_MAX_ATTEMPTS', 3))
+
+# Responses of the POST and PATCH requests sent with an Idempotency-Key header,
+# replayed when they are retried: "memory" (per process), "database" (the
+# idempotency_key table, shared by the workers) or "none"
+IDEMPOTENCY_STORE = os.environ.get('IDEMPOTENCY_STORE', 'memory')
+IDEMPOTENCY_TTL = int(os.environ.get('IDEMPOTENCY_TTL', 86400))
+IDEMPOTENCY_STORE_SIZE = int(os.environ.get('IDEMPOTENCY_STORE_SIZE', 10000))
+
+# GET /changes: longest long-poll wait, seconds between reads of the change
+# log while waiting, and for Server-Sent Events streams the seconds between
+# keep-alive comments and before the stream ends and the client reconnects
+CHANGES_MAX_WAIT = float(os.environ.get('CHANGES_MAX_WAIT', 30))
+CHANGES_POLL_INTERVAL = float(os.environ.get('CHANGES_POLL_INTERVAL', 1))
+CHANGES_HEARTBEAT = float(os.environ.get('CHANGES_HEARTBEAT', 15))
+CHANGES_STREAM_MAX_AGE = float(os.environ.get('CHANGES_STREAM_MAX_AGE', 300))
+# Seconds after which a gap in the change log sequence numbers is taken for
+# a rolled back transaction rather than one still committing
+CHANGES_GAP_TIMEOUT = float(os.environ.get('CHANGES_GAP_TIMEOUT', 5))
+# Long-polls and event streams each hold a worker thread (or a greenlet under
+# asgi.py) while they wait. CHANGES_MAX_WAITING caps how many are open at
+# once, and CHANGES_MAX_WAITING_PER_USER how many one token subject opens;
+# more get 429. They are counted in RATE_LIMIT_STORAGE, so per process with
+# "memory". 0 disables a cap.
+CHANGES_MAX_WAITING = int(os.environ.get('CHANGES_MAX_WAITING', 4))
+CHANGES_MAX_WAITING_PER_USER = int(os.environ.get('CHANGES_MAX_WAITING_PER_USER', 2))
+
+# Rate limits of each token subject, in requests per second with an optional
+# burst: RATE_LIMIT for all its requests, RATE_LIMITS_PER_PERMISSION for the
+# requests needing a permission, e.g. "get:movies=5/20,post:actors=1". 0 or
+# empty disables a limit. MAX_CONCURRENT_REQUESTS caps the requests of a
+# subject in flight. Limits are kept per process with "memory", or shared by
+# the workers of a host with "sqlite:///path/to/limits.db".
+RATE_LIMIT = float(os.environ.get('RATE_LIMIT', 0))
+RATE_LIMIT_BURST = float(os.environ.get('RATE_LIMIT_BURST', 0))
+RATE_LIMITS_PER_PERMISSION = {
+    permission.strip(): limit.strip()
+    for permission, _, limit in (item.partition('=') for item in
+                                 os.environ.get('RATE_LIMITS_PER_PERMISSION', '').split(','))
+    if limit.strip()
+}
+MAX_CONCURRENT_REQUESTS = int(os.environ.get('MAX_CONCURRENT_REQUESTS', 0))
+RATE_LIMIT_STORAGE = os.environ.get('RATE_LIMIT_STORAGE', 'memory')
+
+# Compression of the responses of at least COMPRESSION_MIN_SIZE bytes, and of
+# streamed ones, with brotli (if installed) or gzip as Accept-Encoding allows
+COMPRESSION_ENABLED = os.environ.get('COMPRESSION_ENABLED', 'true').lower() == 'true'
+COMPRESSION_MIN_SIZE = int(os.environ.get('COMPRESSION_MIN_SIZE', 1024))
+COMPRESSION_LEVEL = int(os.environ.get('COMPRESSION_LEVEL', 6))
+COMPRESSION_BROTLI_QUALITY = int(os.environ.get('COMPRESSION_BROTLI_QUALITY', 4))
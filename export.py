@@ -0,0 +1,59 @@
+from itertools import islice
+
+from flask import Response, current_app, request, stream_with_context
+
+from serializer import dumps
+
+NDJSON_MIMETYPE = 'application/x-ndjson'
+
+
+def wants_ndjson():
+    '''
+    Checks whether the client explicitly prefers newline delimited JSON, so
+    that wildcard Accept headers keep getting plain JSON
+    '''
+    accept = request.accept_mimetypes
+    return accept[NDJSON_MIMETYPE] > accept['application/json']
+
+
+def iter_batches(query):
+    '''
+    Yields the rows of `query` in id order, in lists of EXPORT_BATCH_SIZE
+    rows fetched through a server-side cursor, so only one batch is held in
+    memory at a time
+    '''
+    batch_size = current_app.config['EXPORT_BATCH_SIZE']
+    entity = query.column_descriptions[0]['entity']
+    rows = iter(query.order_by(entity.id).yield_per(batch_size))
+    while True:
+        batch = list(islice(rows, batch_size))
+        if not batch:
+            return
+        yield batch
+
+
+def generate_ndjson(serializer, query):
+    for batch in iter_batches(query):
+        yield b''.join(dumps(serializer.row(row)) + b'\n' for row in batch)
+
+
+def generate_json(key, serializer, query):
+    yield b'{"success":true,"%s":[' % key.encode('ascii')
+    separator = b''
+    for batch in iter_batches(query):
+        yield separator + dumps(serializer.rows(batch))[1:-1]
+        separator = b','
+    yield b']}'
+
+
+def export_response(key, serializer, query):
+    '''
+    Streams every row of `query`, a column query of `serializer`, as NDJSON
+    if the client accepts it and as the same document shape as the list
+    endpoints otherwise
+    '''
+    if wants_ndjson():
+        return Response(stream_with_context(generate_ndjson(serializer, query)),
+                        mimetype=NDJSON_MIMETYPE)
+    return Response(stream_with_context(generate_json(key, serializer, query)),
+                    mimetype='application/json')
@@ -0,0 +1,85 @@
+from datetime import datetime
+
+from flask import Response, request
+
+from profiling import phase
+from serializer import dumps, format_datetime
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+'''
+Encodings of the GET /actors and GET /movies pages other than JSON, selected
+through the Accept header: MessagePack, and columnar layouts where each field
+is one array of values, e.g. {"id": [1, 2], "name": ["A", "B"]}, which
+consumers load into arrays or data frames without a per-row decode.
+MessagePack needs msgpack, listed in requirements-dev.txt.
+'''
+
+MSGPACK_MIMETYPE = 'application/msgpack'
+COLUMNAR_JSON_MIMETYPE = 'application/vnd.capstone.columnar+json'
+COLUMNAR_MSGPACK_MIMETYPE = 'application/vnd.capstone.columnar+msgpack'
+
+
+def plain(value):
+    '''
+    Converts the datetimes nested in formatted records to the HTTP dates
+    the JSON responses have
+    '''
+    if isinstance(value, datetime):
+        return format_datetime(value)
+    if isinstance(value, dict):
+        return {key: plain(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [plain(item) for item in value]
+    return value
+
+
+def pack(data):
+    return msgpack.packb(data, use_bin_type=True)
+
+
+class ListFormat:
+
+    def __init__(self, mimetype, encode, columnar):
+        self.mimetype = mimetype
+        self.encode = encode
+        self.columnar = columnar
+
+
+LIST_FORMATS = [ListFormat(COLUMNAR_JSON_MIMETYPE, dumps, True)]
+if msgpack is not None:
+    LIST_FORMATS += [ListFormat(MSGPACK_MIMETYPE, pack, False),
+                     ListFormat(COLUMNAR_MSGPACK_MIMETYPE, pack, True)]
+
+
+def negotiate_list_format():
+    '''
+    Returns the format the client explicitly prefers to JSON, or None, so
+    that wildcard Accept headers keep getting plain JSON
+    '''
+    accept = request.accept_mimetypes
+    best, quality = None, accept['application/json']
+    for list_format in LIST_FORMATS:
+        if accept[list_format.mimetype] > quality:
+            best, quality = list_format, accept[list_format.mimetype]
+    return best
+
+
+def list_response(list_format, key, rows, next_cursor, serializer=None):
+    '''
+    Encodes a page in `list_format`. `rows` are the column rows of
+    `serializer`, or formatted records when there is no serializer.
+    '''
+    if serializer is not None:
+        items = serializer.column_values(rows) if list_format.columnar else serializer.rows(rows)
+    else:
+        rows = plain(rows)
+        fields = list(rows[0]) if rows else []
+        items = {field: [row[field] for row in rows] for field in fields} \
+            if list_format.columnar else rows
+    with phase('serialize'):
+        body = list_format.encode({'success': True, key: items, 'next': next_cursor})
+    return Response(body, mimetype=list_format.mimetype)
@@ -0,0 +1,21 @@
+import os
+
+# Gunicorn settings, read by `gunicorn -c gunicorn.conf.py app:app`
+
+# Threaded workers, so that the GET /changes long-polls and event streams,
+# which hold a thread while they wait, leave the other threads serving. The
+# number of workers is read from WEB_CONCURRENCY by gunicorn itself.
+worker_class = 'gthread'
+threads = int(os.environ.get('GUNICORN_THREADS', 8))
+
+
+def post_fork(server, worker):
+    '''
+    Makes each worker open its own database connections instead of sharing
+    the ones inherited from the master process (e.g. with --preload)
+    '''
+    from app import app
+    from models import db
+    from pool import dispose_engines
+
+    dispose_engines(app, db)
@@ -0,0 +1,204 @@
+import hashlib
+import json
+import time
+from datetime import datetime, timedelta
+from functools import partial, wraps
+
+from flask import Response, abort, current_app, make_response, request
+from sqlalchemy.exc import IntegrityError
+from werkzeug.exceptions import HTTPException
+
+from backends import MemoryBackend, create_backend
+from models import db, IdempotencyKey
+
+'''
+Idempotency-Key support for the write endpoints. The first request sent with
+a key reserves it, and its response is stored once the view returns; a retry
+with the same key gets the stored response back without running the view.
+Keys are scoped to the token subject, and reusing one for a different request
+is rejected with 422, or with 409 while the first request is in progress.
+'''
+
+MAX_KEY_LENGTH = 255
+
+# Seconds a key stays reserved by a request that never completes, e.g.
+# because its worker died, before a retry may run the request again
+IN_PROGRESS_TTL = 60
+
+# Response headers never replayed
+SKIPPED_HEADERS = ('Content-Length', 'Set-Cookie')
+
+
+class MemoryIdempotencyBackend(MemoryBackend):
+    '''
+    Keys are per process: a retry served by another worker runs the request
+    again, so with several workers use the database backend.
+    '''
+
+    def __init__(self, maxsize=10000):
+        super().__init__(maxsize)
+
+    def reserve(self, key, fingerprint):
+        '''
+        Returns the record stored under `key`, or None after reserving it
+        '''
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and time.time() < entry[1]:
+                return entry[0]
+            self._store(key, ({'fingerprint': fingerprint, 'status': None},
+                              time.time() + IN_PROGRESS_TTL))
+            return None
+
+    def complete(self, key, record, ttl):
+        with self._lock:
+            self._store(key, (record, time.time() + ttl))
+
+    def release(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+
+class DatabaseIdempotencyBackend:
+    '''
+    Backend storing the keys in the idempotency_key table, shared by every
+    worker. Reservations rely on the primary key, so concurrent first
+    requests can't both run the view. Expired rows are deleted as responses
+    are stored.
+    '''
+
+    def reserve(self, key, fingerprint):
+        keys = IdempotencyKey.__table__
+        now = datetime.utcnow()
+        try:
+            db.session.execute(keys.delete().where(
+                (keys.c.key == key) & (keys.c.expires_at <= now)))
+            db.session.execute(keys.insert().values(
+                key=key, fingerprint=fingerprint,
+                expires_at=now + timedelta(seconds=IN_PROGRESS_TTL)))
+            db.session.commit()
+            return None
+        except IntegrityError:
+            db.session.rollback()
+        row = db.session.query(IdempotencyKey).populate_existing().get(key)
+        if row is None:
+            # Released meanwhile, the client retries once it completes
+            return {'fingerprint': fingerprint, 'status': None}
+        return {
+            'fingerprint': row.fingerprint,
+            'status': row.status,
+            'headers': json.loads(row.headers) if row.headers else [],
+            'body': row.body
+        }
+
+    def complete(self, key, record, ttl):
+        keys = IdempotencyKey.__table__
+        now = datetime.utcnow()
+        try:
+            db.session.execute(keys.update().where(keys.c.key == key).values(
+                status=record['status'], headers=json.dumps(record['headers']),
+                body=record['body'], expires_at=now + timedelta(seconds=ttl)))
+            db.session.execute(keys.delete().where(keys.c.expires_at <= now))
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+
+    def release(self, key):
+        keys = IdempotencyKey.__table__
+        db.session.rollback()
+        db.session.execute(keys.delete().where(keys.c.key == key))
+        db.session.commit()
+
+    def clear(self):
+        db.session.execute(IdempotencyKey.__table__.delete())
+        db.session.commit()
+
+
+def request_fingerprint():
+    digest = hashlib.sha256()
+    for part in (request.method, request.path, request.query_string.decode('latin-1')):
+        digest.update(part.encode('utf-8') + b'\n')
+    digest.update(request.get_data())
+    return digest.hexdigest()
+
+
+class Idempotency:
+    '''
+    Stores the responses of the write requests sent with an Idempotency-Key
+    header for IDEMPOTENCY_TTL seconds, including the error responses of
+    abort(). Only responses below 500 are stored, so a request that failed
+    on the server can be retried with its key.
+    '''
+
+    def __init__(self, app=None):
+        self.backend = None
+        self.ttl = 86400
+        self.replays = 0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.backend = create_backend('IDEMPOTENCY_STORE', app.config['IDEMPOTENCY_STORE'], {
+            'none': None,
+            'memory': partial(MemoryIdempotencyBackend, app.config['IDEMPOTENCY_STORE_SIZE']),
+            'database': DatabaseIdempotencyBackend
+        })
+        self.ttl = app.config['IDEMPOTENCY_TTL']
+
+    def replay(self, record):
+        self.replays += 1
+        response = Response(record['body'], status=record['status'],
+                            headers=record['headers'])
+        response.headers['Idempotent-Replayed'] = 'true'
+        return response
+
+    def idempotent(self, f):
+        '''
+        Decorator for views behind requires_auth, replaying the stored
+        response of a request retried with the same Idempotency-Key
+        '''
+        @wraps(f)
+        def wrapper(payload, *args, **kwargs):
+            key = request.headers.get('Idempotency-Key')
+            if self.backend is None or key is None:
+                return f(payload, *args, **kwargs)
+            if not key or len(key) > MAX_KEY_LENGTH:
+                abort(400)
+            key = hashlib.sha256(f"{payload.get('sub')}\n{key}".encode('utf-8')).hexdigest()
+            fingerprint = request_fingerprint()
+
+            record = self.backend.reserve(key, fingerprint)
+            if record is not None:
+                if record['fingerprint'] != fingerprint:
+                    abort(422)
+                if record['status'] is None:
+                    abort(409)
+                return self.replay(record)
+
+            try:
+                response = make_response(f(payload, *args, **kwargs))
+            except HTTPException as error:
+                # An abort() is stored like the error response it turns into
+                if error.code is None or error.code >= 500:
+                    self.backend.release(key)
+                    raise
+                response = make_response(current_app.handle_http_exception(error))
+            except Exception:
+                self.backend.release(key)
+                raise
+            if response.status_code >= 500 or response.is_streamed:
+                self.backend.release(key)
+            else:
+                self.backend.complete(key, {
+                    'fingerprint': fingerprint,
+                    'status': response.status_code,
+                    'headers': [(name, value) for name, value in response.headers
+                                if name not in SKIPPED_HEADERS],
+                    'body': response.get_data()
+                }, self.ttl)
+            return response
+        return wrapper
+
+
+idempotency = Idempotency()
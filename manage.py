@@ -3,6 +3,8 @@ from flask_migrate import Migrate, MigrateCommand
 
 from app import app
 from models import db
+from stats import rebuild_counters
+from writebehind import write_behind
 
 migrate = Migrate(app, db)
 manager = Manager(app)
@@ -10,5 +12,18 @@ manager = Manager(app)
 manager.add_command('db', MigrateCommand)
 
 
+@manager.command
+def rebuild_stats():
+    '''Recomputes the counters behind GET /stats from the tables'''
+    rebuild_counters()
+
+
+@manager.command
+def apply_writes():
+    '''Applies the pending writes of the write-behind journal'''
+    while write_behind.apply_pending():
+        pass
+
+
 if __name__ == '__main__':
     manager.run()
\ No newline at end of file
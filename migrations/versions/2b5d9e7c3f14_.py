@@ -0,0 +1,28 @@
+"""add recent writes of the token subjects
+
+Revision ID: 2b5d9e7c3f14
+Revises: 6e2f8b4d19a7
+Create Date: 2026-10-18 22:51:09.630178
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '2b5d9e7c3f14'
+down_revision = '6e2f8b4d19a7'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('recent_write',
+    sa.Column('subject', sa.String(length=128), nullable=False),
+    sa.Column('written_at', sa.DateTime(), nullable=False),
+    sa.PrimaryKeyConstraint('subject')
+    )
+
+
+def downgrade():
+    op.drop_table('recent_write')
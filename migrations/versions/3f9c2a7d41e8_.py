@@ -0,0 +1,41 @@
+"""add updated_at columns and table versions
+
+Revision ID: 3f9c2a7d41e8
+Revises: b7b335d103e2
+Create Date: 2026-10-18 10:12:43.518207
+
+"""
+from datetime import datetime
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3f9c2a7d41e8'
+down_revision = 'b7b335d103e2'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('actor', sa.Column('updated_at', sa.DateTime(), nullable=True))
+    op.add_column('movie', sa.Column('updated_at', sa.DateTime(), nullable=True))
+    table_version = op.create_table('table_version',
+    sa.Column('name', sa.String(length=64), nullable=False),
+    sa.Column('version', sa.BigInteger(), nullable=False),
+    sa.Column('updated_at', sa.DateTime(), nullable=False),
+    sa.PrimaryKeyConstraint('name')
+    )
+    op.execute("UPDATE actor SET updated_at = CURRENT_TIMESTAMP")
+    op.execute("UPDATE movie SET updated_at = CURRENT_TIMESTAMP")
+    now = datetime.utcnow()
+    op.bulk_insert(table_version, [
+        {'name': 'actor', 'version': 1, 'updated_at': now},
+        {'name': 'movie', 'version': 1, 'updated_at': now}
+    ])
+
+
+def downgrade():
+    op.drop_table('table_version')
+    op.drop_column('movie', 'updated_at')
+    op.drop_column('actor', 'updated_at')
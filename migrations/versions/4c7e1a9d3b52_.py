@@ -0,0 +1,25 @@
+"""count the failed attempts at the write-behind operations
+
+Revision ID: 4c7e1a9d3b52
+Revises: 2b5d9e7c3f14
+Create Date: 2026-10-18 23:37:42.518904
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '4c7e1a9d3b52'
+down_revision = '2b5d9e7c3f14'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('write_operation',
+                  sa.Column('attempts', sa.Integer(), nullable=False, server_default='0'))
+
+
+def downgrade():
+    op.drop_column('write_operation', 'attempts')
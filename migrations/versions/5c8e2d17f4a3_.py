@@ -0,0 +1,40 @@
+"""add write-behind journal
+
+Revision ID: 5c8e2d17f4a3
+Revises: 7b3e0f6a9d42
+Create Date: 2026-10-18 17:02:31.518204
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5c8e2d17f4a3'
+down_revision = '7b3e0f6a9d42'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('write_operation',
+    sa.Column('seq', sa.Integer(), nullable=False),
+    sa.Column('id', sa.String(length=32), nullable=False),
+    sa.Column('subject', sa.String(length=128), nullable=True),
+    sa.Column('model', sa.String(length=32), nullable=False),
+    sa.Column('action', sa.String(length=16), nullable=False),
+    sa.Column('entity_id', sa.Integer(), nullable=True),
+    sa.Column('payload', sa.Text(), nullable=True),
+    sa.Column('status', sa.String(length=16), nullable=False),
+    sa.Column('result', sa.Text(), nullable=True),
+    sa.Column('created_at', sa.DateTime(), nullable=False),
+    sa.Column('applied_at', sa.DateTime(), nullable=True),
+    sa.PrimaryKeyConstraint('seq'),
+    sa.UniqueConstraint('id')
+    )
+    op.create_index('ix_write_operation_status_seq', 'write_operation', ['status', 'seq'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_write_operation_status_seq', table_name='write_operation')
+    op.drop_table('write_operation')
@@ -0,0 +1,32 @@
+"""add (column, id) indexes for the paginated sorts
+
+Revision ID: 6e2f8b4d19a7
+Revises: d3b7a9e15c60
+Create Date: 2026-10-18 22:14:37.518204
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = '6e2f8b4d19a7'
+down_revision = 'd3b7a9e15c60'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # The composite index also serves the release date range filters
+    op.drop_index('ix_movie_release_date', table_name='movie')
+    op.create_index('ix_movie_release_date_id', 'movie', ['release_date', 'id'])
+    op.create_index('ix_movie_title_id', 'movie', ['title', 'id'])
+    op.create_index('ix_actor_age_id', 'actor', ['age', 'id'])
+    op.create_index('ix_actor_name_id', 'actor', ['name', 'id'])
+
+
+def downgrade():
+    op.drop_index('ix_actor_name_id', table_name='actor')
+    op.drop_index('ix_actor_age_id', table_name='actor')
+    op.drop_index('ix_movie_title_id', table_name='movie')
+    op.drop_index('ix_movie_release_date_id', table_name='movie')
+    op.create_index('ix_movie_release_date', 'movie', ['release_date'])
@@ -0,0 +1,47 @@
+"""add stats counters
+
+Revision ID: 7b3e0f6a9d42
+Revises: e2a7d5c93b16
+Create Date: 2026-10-18 15:21:44.093617
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '7b3e0f6a9d42'
+down_revision = 'e2a7d5c93b16'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('stat_counter',
+    sa.Column('name', sa.String(length=64), nullable=False),
+    sa.Column('value', sa.BigInteger(), nullable=False),
+    sa.PrimaryKeyConstraint('name')
+    )
+
+    # Counts the existing rows, the models keep the counters up to date
+    # from then on
+    if op.get_bind().dialect.name == 'postgresql':
+        year = 'CAST(EXTRACT(YEAR FROM release_date) AS INTEGER)'
+    else:
+        year = "CAST(strftime('%Y', release_date) AS INTEGER)"
+    # Rounds ages down to the decade like models.age_bucket, including the
+    # negative ones, which integer division would round toward zero
+    decade = 'age - (age % 10 + 10) % 10'
+    for name, source in [
+        ("'actor'", 'actor'),
+        ("'actor.gender.' || coalesce(CAST(gender AS VARCHAR), 'unknown')", 'actor'),
+        (f"'actor.age.' || coalesce(CAST({decade} AS VARCHAR), 'unknown')", 'actor'),
+        ("'movie'", 'movie'),
+        (f"'movie.year.' || coalesce(CAST({year} AS VARCHAR), 'unknown')", 'movie'),
+    ]:
+        op.execute(f'INSERT INTO stat_counter (name, value) '
+                   f'SELECT {name}, count(*) FROM {source} GROUP BY 1')
+
+
+def downgrade():
+    op.drop_table('stat_counter')
@@ -0,0 +1,32 @@
+"""add casting association between movies and actors
+
+Revision ID: 8d4e61b0c2f5
+Revises: 3f9c2a7d41e8
+Create Date: 2026-10-18 11:03:27.904615
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8d4e61b0c2f5'
+down_revision = '3f9c2a7d41e8'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('casting',
+    sa.Column('movie_id', sa.Integer(), nullable=False),
+    sa.Column('actor_id', sa.Integer(), nullable=False),
+    sa.ForeignKeyConstraint(['actor_id'], ['actor.id'], ondelete='CASCADE'),
+    sa.ForeignKeyConstraint(['movie_id'], ['movie.id'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('movie_id', 'actor_id')
+    )
+    op.create_index('ix_casting_actor_id', 'casting', ['actor_id'])
+
+
+def downgrade():
+    op.drop_index('ix_casting_actor_id', table_name='casting')
+    op.drop_table('casting')
@@ -0,0 +1,28 @@
+"""drop the recent writes, carried by a signed marker instead
+
+Revision ID: 8f2d6c4a1e73
+Revises: 4c7e1a9d3b52
+Create Date: 2026-10-19 09:12:27.304816
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8f2d6c4a1e73'
+down_revision = '4c7e1a9d3b52'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.drop_table('recent_write')
+
+
+def downgrade():
+    op.create_table('recent_write',
+    sa.Column('subject', sa.String(length=128), nullable=False),
+    sa.Column('written_at', sa.DateTime(), nullable=False),
+    sa.PrimaryKeyConstraint('subject')
+    )
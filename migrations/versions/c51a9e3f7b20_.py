@@ -0,0 +1,38 @@
+"""add indexes for the list filters and sorts
+
+Revision ID: c51a9e3f7b20
+Revises: 8d4e61b0c2f5
+Create Date: 2026-10-18 11:47:05.226381
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c51a9e3f7b20'
+down_revision = '8d4e61b0c2f5'
+branch_labels = None
+depends_on = None
+
+
+def lower_prefix(column):
+    # varchar_pattern_ops lets Postgres use the index for LIKE 'prefix%'
+    # regardless of the database collation
+    if op.get_bind().dialect.name == 'postgresql':
+        return sa.text(f'lower({column}) varchar_pattern_ops')
+    return sa.text(f'lower({column})')
+
+
+def upgrade():
+    op.create_index('ix_movie_release_date', 'movie', ['release_date'])
+    op.create_index('ix_movie_title_lower', 'movie', [lower_prefix('title')])
+    op.create_index('ix_actor_gender_age', 'actor', ['gender', 'age'])
+    op.create_index('ix_actor_name_lower', 'actor', [lower_prefix('name')])
+
+
+def downgrade():
+    op.drop_index('ix_actor_name_lower', table_name='actor')
+    op.drop_index('ix_actor_gender_age', table_name='actor')
+    op.drop_index('ix_movie_title_lower', table_name='movie')
+    op.drop_index('ix_movie_release_date', table_name='movie')
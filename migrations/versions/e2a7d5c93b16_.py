@@ -0,0 +1,40 @@
+"""add full-text search vectors
+
+Revision ID: e2a7d5c93b16
+Revises: c51a9e3f7b20
+Create Date: 2026-10-18 14:02:37.518204
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = 'e2a7d5c93b16'
+down_revision = 'c51a9e3f7b20'
+branch_labels = None
+depends_on = None
+
+
+def add_search_vector(table, column):
+    # Generated columns need Postgres 12 or later
+    op.execute(f"ALTER TABLE {table} ADD COLUMN search_vector tsvector "
+               f"GENERATED ALWAYS AS (to_tsvector('simple', coalesce({column}, ''))) STORED")
+    op.create_index(f'ix_{table}_search_vector', table, ['search_vector'],
+                    postgresql_using='gin')
+
+
+def upgrade():
+    # Other databases use the in-memory search index
+    if op.get_bind().dialect.name != 'postgresql':
+        return
+    add_search_vector('actor', 'name')
+    add_search_vector('movie', 'title')
+
+
+def downgrade():
+    if op.get_bind().dialect.name != 'postgresql':
+        return
+    op.drop_index('ix_movie_search_vector', table_name='movie')
+    op.drop_column('movie', 'search_vector')
+    op.drop_index('ix_actor_search_vector', table_name='actor')
+    op.drop_column('actor', 'search_vector')
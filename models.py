@@ -1,35 +1,484 @@
-from flask_sqlalchemy import SQLAlchemy
+from collections import Counter
+from contextlib import contextmanager
+from datetime import datetime
 
-db = SQLAlchemy()
+from sqlalchemy import event
+from sqlalchemy.dialects import postgresql, sqlite
+
+from routing import RoutingSQLAlchemy, RoutingSession
+from validation import parse_release_date
+
+db = RoutingSQLAlchemy()
+
+BULK_INSERT_CHUNK_SIZE = 1000
+
+'''
+Callbacks run with a table name after a write to that table is committed,
+e.g. to wake the change feed's waiting requests
+'''
+write_listeners = []
+
+
+def on_write(listener):
+    if listener not in write_listeners:
+        write_listeners.append(listener)
+    return listener
+
+
+'''
+INSERT ... ON CONFLICT statements of the supported databases
+'''
+UPSERT_INSERTS = {
+    'postgresql': postgresql.insert,
+    'sqlite': sqlite.insert
+}
+
+
+def upsert(table, rows, key, updates):
+    '''
+    Inserts the rows, or applies `updates`, a function of the row the insert
+    proposed returning the new column values, to the existing row with the
+    same `key`. A single statement, so two transactions writing the first
+    row of a key can't both insert it.
+    '''
+    statement = UPSERT_INSERTS[db.engine.dialect.name](table).values(rows)
+    db.session.execute(statement.on_conflict_do_update(
+        index_elements=[key], set_=updates(statement.excluded)))
+
+
+def bump_version(table):
+    '''
+    Increments the version of a table within the current transaction
+    '''
+    versions = TableVersion.__table__
+    upsert(versions, [{'name': table, 'version': 1, 'updated_at': datetime.utcnow()}], 'name',
+           lambda proposed: {'version': versions.c.version + 1,
+                             'updated_at': proposed.updated_at})
+
+
+def resolve_tables(tables):
+    '''
+    Expands a list of table names in which callables are evaluated, e.g. to
+    add the tables read because of the current request's parameters
+    '''
+    names = []
+    for table in tables:
+        names.extend(table() if callable(table) else [table])
+    return names
+
+
+def adjust_counters(deltas):
+    '''
+    Adds {counter name: delta} to the stats counters within the current
+    transaction. The counters are written in name order, so concurrent
+    transactions lock their rows in the same order and can't deadlock.
+    '''
+    counters = StatCounter.__table__
+    rows = [{'name': name, 'value': deltas[name]} for name in sorted(deltas) if deltas[name]]
+    if rows:
+        upsert(counters, rows, 'name',
+               lambda proposed: {'value': counters.c.value + proposed.value})
+
+
+def count_rows(model, old_rows=(), new_rows=()):
+    '''
+    Updates the stats counters for rows (dicts of the model's STAT_FIELDS)
+    replaced by new ones; either side may be empty for inserts and deletes
+    '''
+    deltas = Counter()
+    for values in old_rows:
+        deltas.subtract(model.stat_keys(values))
+    for values in new_rows:
+        deltas.update(model.stat_keys(values))
+    adjust_counters(deltas)
+
+
+def record_change(table, action, *entities):
+    '''
+    Adds the insert, update or delete of rows, given as ids or as model
+    instances whose id is only known once flushed, to the change log entries
+    written by the next commit
+    '''
+    db.session.info.setdefault('changes', []).extend(
+        (table, action, entity) for entity in entities)
+
+
+@event.listens_for(RoutingSession, 'after_soft_rollback')
+def discard_changes(session, previous_transaction):
+    session.info.pop('changes', None)
+
+
+def write_changes(changes):
+    '''
+    Appends the recorded changes to the change log. Their sequence numbers
+    come from its primary key, so concurrent transactions don't wait for
+    each other here; the caller commits right after, which keeps the gaps
+    left by the transactions still committing short-lived.
+    '''
+    now = datetime.utcnow()
+    db.session.execute(ChangeLog.__table__.insert(), [
+        {'model': table, 'action': action, 'changed_at': now,
+         'entity_id': entity if isinstance(entity, int) else entity.id}
+        for table, action, entity in changes])
+
+
+def commit(*tables):
+    '''
+    Bumps the versions of the changed tables, writes the recorded changes to
+    the change log and commits the session, then notifies the write
+    listeners of the changed tables, and of the change log when there were
+    changes. Versions are bumped in table name order, so concurrent commits
+    lock their rows in the same order. Within group_commit the session is
+    only flushed.
+    '''
+    deferred = db.session.info.get('deferred_tables')
+    if deferred is not None:
+        deferred.extend(tables)
+        db.session.flush()
+        return
+    changes = db.session.info.pop('changes', None)
+    if changes:
+        db.session.flush()
+    tables = sorted(set(tables))
+    for table in tables:
+        bump_version(table)
+    if changes:
+        write_changes(changes)
+        tables.append(ChangeLog.__tablename__)
+    db.session.commit()
+    for table in tables:
+        for listener in write_listeners:
+            listener(table)
+
+
+@contextmanager
+def group_commit():
+    '''
+    Turns the commits of the writes made in the block into a single one at
+    its end, which bumps the version of each changed table once. Everything
+    is rolled back if the block raises.
+    '''
+    tables = db.session.info['deferred_tables'] = []
+    try:
+        try:
+            yield
+        finally:
+            db.session.info.pop('deferred_tables', None)
+        commit(*tables)
+    except Exception:
+        db.session.rollback()
+        raise
+
+
+def bulk_insert(model, rows):
+    '''
+    Inserts rows (dicts of column values) in a single transaction and returns
+    their ids. On Postgres each chunk is one multi-row INSERT ... RETURNING id,
+    elsewhere the rows go through an executemany-style bulk insert.
+    '''
+    ids = []
+    try:
+        if db.engine.dialect.name == 'postgresql':
+            table = model.__table__
+            for start in range(0, len(rows), BULK_INSERT_CHUNK_SIZE):
+                chunk = rows[start:start + BULK_INSERT_CHUNK_SIZE]
+                result = db.session.execute(
+                    table.insert().values(chunk).returning(table.c.id))
+                ids.extend(result.scalars())
+        else:
+            mappings = [dict(row) for row in rows]
+            db.session.bulk_insert_mappings(model, mappings, return_defaults=True)
+            ids = [mapping['id'] for mapping in mappings]
+        count_rows(model, new_rows=rows)
+        record_change(model.__tablename__, 'insert', *ids)
+        commit(model.__tablename__)
+    except Exception:
+        db.session.rollback()
+        raise
+    return ids
+
+def existing_ids(model, ids):
+    found = set()
+    for start in range(0, len(ids), BULK_INSERT_CHUNK_SIZE):
+        chunk = ids[start:start + BULK_INSERT_CHUNK_SIZE]
+        rows = db.session.query(model.id).filter(model.id.in_(chunk))
+        found.update(row.id for row in rows)
+    return found
+
+
+def stat_values(model, ids):
+    '''
+    Returns {id: {field: value}} of the model's STAT_FIELDS for the existing
+    ids, so it also tells which ids exist
+    '''
+    columns = [getattr(model, field) for field in model.STAT_FIELDS]
+    values = {}
+    for start in range(0, len(ids), BULK_INSERT_CHUNK_SIZE):
+        chunk = ids[start:start + BULK_INSERT_CHUNK_SIZE]
+        for row in db.session.query(model.id, *columns).filter(model.id.in_(chunk)):
+            values[row.id] = dict(zip(model.STAT_FIELDS, row[1:]))
+    return values
+
+
+def bulk_update(model, updates):
+    '''
+    Applies {id: {column: value}} updates in a single transaction. Ids sharing
+    the same values are updated by one UPDATE ... WHERE id IN statement.
+    Returns (updated ids, missing ids).
+    '''
+    try:
+        found = stat_values(model, list(updates))
+        groups = {}
+        for row_id, values in updates.items():
+            if row_id in found and values:
+                groups.setdefault(tuple(sorted(values.items())), []).append(row_id)
+        for values, ids in groups.items():
+            for start in range(0, len(ids), BULK_INSERT_CHUNK_SIZE):
+                chunk = ids[start:start + BULK_INSERT_CHUNK_SIZE]
+                model.query.filter(model.id.in_(chunk))\
+                    .update(dict(values), synchronize_session=False)
+        record_change(model.__tablename__, 'update',
+                      *[row_id for ids in groups.values() for row_id in ids])
+        changed = [row_id for row_id, values in updates.items()
+                   if row_id in found and set(values) & set(model.STAT_FIELDS)]
+        count_rows(model, old_rows=[found[row_id] for row_id in changed],
+                   new_rows=[{field: updates[row_id].get(field, value)
+                              for field, value in found[row_id].items()}
+                             for row_id in changed])
+        commit(*([model.__tablename__] if groups else []))
+    except Exception:
+        db.session.rollback()
+        raise
+    updated = [row_id for row_id in updates if row_id in found]
+    missing = [row_id for row_id in updates if row_id not in found]
+    return updated, missing
+
+
+def bulk_delete(model, ids):
+    '''
+    Deletes the given ids with DELETE ... WHERE id IN statements in a single
+    transaction. Returns (deleted ids, missing ids). The rows they were cast
+    with are logged as updated, their casting rows being deleted along.
+    '''
+    try:
+        found = stat_values(model, ids)
+        existing = [row_id for row_id in ids if row_id in found]
+        count_rows(model, old_rows=[found[row_id] for row_id in set(existing)])
+        record_change(model.__tablename__, 'delete', *dict.fromkeys(existing))
+        cast_column = casting.c[f'{model.__tablename__}_id']
+        linked_column, = [column for column in casting.c if column is not cast_column]
+        linked = {}
+        for start in range(0, len(existing), BULK_INSERT_CHUNK_SIZE):
+            chunk = existing[start:start + BULK_INSERT_CHUNK_SIZE]
+            rows = db.session.query(linked_column).filter(cast_column.in_(chunk))
+            linked.update(dict.fromkeys(sorted(row[0] for row in rows)))
+            db.session.execute(casting.delete().where(cast_column.in_(chunk)))
+            model.query.filter(model.id.in_(chunk))\
+                .delete(synchronize_session=False)
+        record_change(linked_column.name[:-len('_id')], 'update', *linked)
+        commit(*([model.__tablename__, 'casting'] if existing else []))
+    except Exception:
+        db.session.rollback()
+        raise
+    return existing, [row_id for row_id in ids if row_id not in found]
+
+class StatCounter(db.Model):
+    '''
+    Counters behind GET /stats, e.g. actor.gender.F, adjusted in the same
+    transaction as every write so the stats never need a table scan
+    '''
+    __tablename__ = 'stat_counter'
+    name = db.Column(db.String(64), primary_key=True)
+    value = db.Column(db.BigInteger, nullable=False, default=0)
+
+
+def age_bucket(age):
+    '''
+    Returns the first age of the decade an age falls in, as a string
+    '''
+    try:
+        return str(int(age) // 10 * 10)
+    except (TypeError, ValueError):
+        return 'unknown'
+
+
+def release_year(release_date):
+    if isinstance(release_date, str):
+        try:
+            release_date = parse_release_date(release_date)
+        except ValueError:
+            return 'unknown'
+    return str(release_date.year) if release_date else 'unknown'
+
+class TableVersion(db.Model):
+    '''
+    Version counter and time of the last write of each table, used to answer
+    conditional GET requests without querying the table itself
+    '''
+    __tablename__ = 'table_version'
+    name = db.Column(db.String(64), primary_key=True)
+    version = db.Column(db.BigInteger, nullable=False, default=0)
+    updated_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+class WriteOperation(db.Model):
+    '''
+    Journal of the writes accepted for later application by the write-behind
+    queue. Operations are applied in `seq` order, each in the same
+    transaction as the status change recording it.
+    '''
+    __tablename__ = 'write_operation'
+    seq = db.Column(db.Integer, primary_key=True)
+    id = db.Column(db.String(32), nullable=False, unique=True)
+    subject = db.Column(db.String(128))
+    model = db.Column(db.String(32), nullable=False)
+    action = db.Column(db.String(16), nullable=False)
+    entity_id = db.Column(db.Integer)
+    payload = db.Column(db.Text)
+    status = db.Column(db.String(16), nullable=False, default='pending')
+    result = db.Column(db.Text)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    applied_at = db.Column(db.DateTime)
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+
+    __table_args__ = (db.Index('ix_write_operation_status_seq', 'status', 'seq'),)
+
+class ChangeLog(db.Model):
+    '''
+    Inserts, updates and deletes of actors and movies, read by GET /changes.
+    Entries are written in the transaction of the change, numbered by `seq`
+    as they are inserted; a transaction still committing leaves a gap that
+    the readers wait for, see changes.read_log.
+    '''
+    __tablename__ = 'change_log'
+    seq = db.Column(db.Integer, primary_key=True)
+    model = db.Column(db.String(32), nullable=False)
+    entity_id = db.Column(db.Integer, nullable=False)
+    action = db.Column(db.String(16), nullable=False)
+    changed_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+class IdempotencyKey(db.Model):
+    '''
+    Responses of the writes sent with an Idempotency-Key header, replayed
+    when the same request is retried, for the database backed store. A row
+    without a status is a request still in progress.
+    '''
+    __tablename__ = 'idempotency_key'
+    key = db.Column(db.String(64), primary_key=True)
+    fingerprint = db.Column(db.String(64), nullable=False)
+    status = db.Column(db.Integer)
+    headers = db.Column(db.Text)
+    body = db.Column(db.LargeBinary)
+    expires_at = db.Column(db.DateTime, nullable=False, index=True)
+
+'''
+Association between movies and the actors cast in them
+'''
+casting = db.Table('casting',
+    db.Column('movie_id', db.Integer,
+              db.ForeignKey('movie.id', ondelete='CASCADE'), primary_key=True),
+    db.Column('actor_id', db.Integer,
+              db.ForeignKey('actor.id', ondelete='CASCADE'), primary_key=True),
+    db.Index('ix_casting_actor_id', 'actor_id')
+)
 
 class Movie(db.Model):
     __tablename__ = 'movie'
     id = db.Column(db.Integer, primary_key=True)
     title = db.Column(db.String(120))
     release_date = db.Column(db.DateTime)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    actors = db.relationship('Actor', secondary=casting, back_populates='movies')
+
+    # Columns returned by format() and the list endpoints
+    FIELDS = ('id', 'title', 'release_date')
+    # Columns the stats counters are derived from
+    STAT_FIELDS = ('release_date',)
 
     def __init__(self, title, release_date):
         self.title = title
         self.release_date = release_date
 
+    @staticmethod
+    def stat_keys(values):
+        return ['movie', f"movie.year.{release_year(values.get('release_date'))}"]
+
+    def stat_values(self):
+        return {field: getattr(self, field) for field in self.STAT_FIELDS}
+
     def insert(self):
         db.session.add(self)
-        db.session.commit()
+        count_rows(Movie, new_rows=[self.stat_values()])
+        record_change(self.__tablename__, 'insert', self)
+        commit(self.__tablename__)
+
+    @classmethod
+    def insert_many(cls, rows):
+        return bulk_insert(cls, rows)
+
+    @classmethod
+    def update_many(cls, updates):
+        return bulk_update(cls, updates)
+
+    @classmethod
+    def delete_many(cls, ids):
+        return bulk_delete(cls, ids)
 
     def update(self, title, release_date):
+        old_values = self.stat_values()
         self.title = title
         self.release_date = release_date
-        db.session.commit()
+        count_rows(Movie, old_rows=[old_values], new_rows=[self.stat_values()])
+        record_change(self.__tablename__, 'update', self.id)
+        commit(self.__tablename__)
 
     def delete(self):
+        tables = [self.__tablename__] + (['casting'] if self.actors else [])
+        count_rows(Movie, old_rows=[self.stat_values()])
+        record_change(self.__tablename__, 'delete', self.id)
+        # The actors lose the casting rows deleted along
+        record_change(Actor.__tablename__, 'update', *sorted(actor.id for actor in self.actors))
         db.session.delete(self)
-        db.session.commit()
+        commit(*tables)
+
+    def add_actors(self, actor_ids):
+        '''
+        Casts the given actors in this movie. Returns (cast ids, missing ids).
+        '''
+        found = existing_ids(Actor, actor_ids)
+        rows = db.session.query(casting.c.actor_id)\
+            .filter(casting.c.movie_id == self.id, casting.c.actor_id.in_(found))
+        already_cast = {row.actor_id for row in rows}
+        new_ids = [actor_id for actor_id in found if actor_id not in already_cast]
+        if new_ids:
+            db.session.execute(casting.insert(),
+                               [{'movie_id': self.id, 'actor_id': actor_id}
+                                for actor_id in new_ids])
+            record_change(self.__tablename__, 'update', self.id)
+            record_change(Actor.__tablename__, 'update', *new_ids)
+            commit('casting')
+        cast = [actor_id for actor_id in actor_ids if actor_id in found]
+        return cast, [actor_id for actor_id in actor_ids if actor_id not in found]
+
+    def remove_actor(self, actor_id):
+        '''
+        Removes an actor from this movie's cast. Returns False if the actor
+        wasn't cast in it.
+        '''
+        result = db.session.execute(casting.delete().where(
+            (casting.c.movie_id == self.id) & (casting.c.actor_id == actor_id)))
+        if result.rowcount == 0:
+            db.session.rollback()
+            return False
+        record_change(self.__tablename__, 'update', self.id)
+        record_change(Actor.__tablename__, 'update', actor_id)
+        commit('casting')
+        return True
     
-    def format(self):
-        return {
-            'title': self.title,
-            'release_date': self.release_date
-        }
+    def format(self, include=(), fields=None):
+        data = {field: getattr(self, field) for field in fields or self.FIELDS}
+        if 'actors' in include:
+            data['actors'] = [actor.format() for actor in self.actors]
+        return data
 
 class Actor(db.Model):
     __tablename__ = 'actor'
@@ -37,30 +486,82 @@ class Actor(db.Model):
     name = db.Column(db.String(120))
     age = db.Column(db.Integer)
     gender = db.Column(db.Enum('M', 'F', name='gender'))
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    movies = db.relationship('Movie', secondary=casting, back_populates='actors')
+
+    # Columns returned by format() and the list endpoints
+    FIELDS = ('id', 'name', 'age', 'gender')
+    # Columns the stats counters are derived from
+    STAT_FIELDS = ('gender', 'age')
 
     def __init__(self, name, age, gender):
         self.name = name
         self.age = age
         self.gender = gender
 
+    @staticmethod
+    def stat_keys(values):
+        return ['actor',
+                f"actor.gender.{values.get('gender') or 'unknown'}",
+                f"actor.age.{age_bucket(values.get('age'))}"]
+
+    def stat_values(self):
+        return {field: getattr(self, field) for field in self.STAT_FIELDS}
+
     def insert(self):
         db.session.add(self)
-        db.session.commit()
+        count_rows(Actor, new_rows=[self.stat_values()])
+        record_change(self.__tablename__, 'insert', self)
+        commit(self.__tablename__)
+
+    @classmethod
+    def insert_many(cls, rows):
+        return bulk_insert(cls, rows)
+
+    @classmethod
+    def update_many(cls, updates):
+        return bulk_update(cls, updates)
+
+    @classmethod
+    def delete_many(cls, ids):
+        return bulk_delete(cls, ids)
 
     def update(self, name, age, gender):
+        old_values = self.stat_values()
         self.name = name
         self.age = age
         self.gender = gender
-
-        db.session.commit()
+        count_rows(Actor, old_rows=[old_values], new_rows=[self.stat_values()])
+        record_change(self.__tablename__, 'update', self.id)
+        commit(self.__tablename__)
 
     def delete(self):
+        tables = [self.__tablename__] + (['casting'] if self.movies else [])
+        count_rows(Actor, old_rows=[self.stat_values()])
+        record_change(self.__tablename__, 'delete', self.id)
+        # The movies lose the casting rows deleted along
+        record_change(Movie.__tablename__, 'update', *sorted(movie.id for movie in self.movies))
         db.session.delete(self)
-        db.session.commit()
+        commit(*tables)
     
-    def format(self):
-        return {
-            'name': self.name,
-            'age': self.age,
-            'gender': self.gender
-        }
+    def format(self, include=(), fields=None):
+        data = {field: getattr(self, field) for field in fields or self.FIELDS}
+        if 'movies' in include:
+            data['movies'] = [movie.format() for movie in self.movies]
+        return data
+
+'''
+Indexes backing the list filters and sorts. The lower-case prefix indexes use
+varchar_pattern_ops on Postgres so LIKE 'prefix%' can use them in any locale.
+The (column, id) indexes give the order of the paginated sorts and serve their
+keyset predicates, in either direction.
+'''
+db.Index('ix_movie_release_date_id', Movie.release_date, Movie.id)
+db.Index('ix_movie_title_id', Movie.title, Movie.id)
+db.Index('ix_actor_age_id', Actor.age, Actor.id)
+db.Index('ix_actor_name_id', Actor.name, Actor.id)
+db.Index('ix_movie_title_lower', db.func.lower(Movie.title).label('title_lower'),
+         postgresql_ops={'title_lower': 'varchar_pattern_ops'})
+db.Index('ix_actor_gender_age', Actor.gender, Actor.age)
+db.Index('ix_actor_name_lower', db.func.lower(Actor.name).label('name_lower'),
+         postgresql_ops={'name_lower': 'varchar_pattern_ops'})
@@ -0,0 +1,285 @@
+import base64
+import json
+from datetime import datetime
+
+from flask import abort, current_app, request
+from sqlalchemy import and_, func, tuple_
+from sqlalchemy.orm import selectinload
+
+from models import db, Actor, Movie, casting
+
+'''
+Columns each list endpoint can be sorted by. Any sort is made total by
+falling back to the primary key, which is also what the cursor resumes from.
+'''
+SORTABLE_COLUMNS = {
+    Actor: ('id', 'name', 'age'),
+    Movie: ('id', 'title', 'release_date')
+}
+
+
+'''
+Related collections each list endpoint can expand with ?include=
+'''
+INCLUDES = {
+    Actor: {'movies': (Actor.movies, Movie)},
+    Movie: {'actors': (Movie.actors, Actor)}
+}
+
+
+def parse_include(model, args):
+    '''
+    Parses a comma separated include parameter, aborting with 400 on
+    unknown relations
+    '''
+    names = [name for name in args.get('include', '').split(',') if name]
+    for name in names:
+        if name not in INCLUDES[model]:
+            abort(400)
+    return tuple(names)
+
+
+def parse_fields(model, args):
+    '''
+    Parses a comma separated fields parameter into the requested columns, in
+    the order of the model's FIELDS, aborting with 400 on unknown columns.
+    All the columns are returned when the parameter is absent.
+    '''
+    value = args.get('fields')
+    if value is None:
+        return model.FIELDS
+    names = [name.strip() for name in value.split(',') if name.strip()]
+    if not names:
+        abort(400)
+    for name in names:
+        if name not in model.FIELDS:
+            abort(400)
+    return tuple(field for field in model.FIELDS if field in names)
+
+
+def include_related(model, query, include):
+    '''
+    Loads the included collections of a whole page with one extra SELECT ...
+    WHERE id IN per relation, instead of one query per row
+    '''
+    for name in include:
+        relationship, _ = INCLUDES[model][name]
+        query = query.options(selectinload(relationship))
+    return query
+
+
+def included_tables(model):
+    '''
+    Returns the tables read because of the current request's include parameter
+    '''
+    tables = []
+    for name in parse_include(model, request.args):
+        _, related = INCLUDES[model][name]
+        tables += [casting.name, related.__tablename__]
+    return tables
+
+
+def encode_cursor(sort, value, row_id):
+    '''
+    Encodes the position after the given row as an opaque string
+    '''
+    if isinstance(value, datetime):
+        value = value.isoformat()
+    data = json.dumps({'s': sort, 'v': value, 'id': row_id}, separators=(',', ':'))
+    return base64.urlsafe_b64encode(data.encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor):
+    '''
+    Decodes a cursor produced by encode_cursor, aborting with 400 if it is malformed
+    '''
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        data = json.loads(base64.urlsafe_b64decode(padded.encode('ascii')))
+        return data['s'], data['v'], int(data['id'])
+    except Exception:
+        abort(400)
+
+
+def parse_sort(model, sort):
+    '''
+    Parses a sort parameter such as `name` or `-release_date` into
+    (column name, descending)
+    '''
+    descending = sort.startswith('-')
+    name = sort.lstrip('-')
+    if name not in SORTABLE_COLUMNS[model]:
+        abort(400)
+    return name, descending
+
+
+def cursor_fields(model, args, default_sort='id'):
+    '''
+    Returns the columns paginate reads from the last row of a page to build
+    the next cursor, which have to be selected even if not requested
+    '''
+    name, _ = parse_sort(model, args.get('sort', default_sort))
+    return ('id',) if name == 'id' else ('id', name)
+
+
+def parse_limit(value):
+    default = current_app.config['PAGE_SIZE']
+    maximum = current_app.config['MAX_PAGE_SIZE']
+    if value is None:
+        return default
+    try:
+        limit = int(value)
+    except ValueError:
+        abort(400)
+    if limit < 1:
+        abort(400)
+    return min(limit, maximum)
+
+
+def parse_int(value):
+    try:
+        return int(value)
+    except ValueError:
+        abort(400)
+
+
+def parse_datetime(value):
+    try:
+        return datetime.fromisoformat(value)
+    except ValueError:
+        abort(400)
+
+
+def parse_cursor_value(column, value):
+    '''
+    Converts a sort value decoded from a cursor to the type of `column`,
+    aborting with 400 if it doesn't match
+    '''
+    python_type = column.type.python_type
+    if python_type is datetime:
+        if not isinstance(value, str):
+            abort(400)
+        return parse_datetime(value)
+    if not isinstance(value, python_type) or isinstance(value, bool):
+        abort(400)
+    return value
+
+
+def prefix_filter(column, prefix):
+    '''
+    Case-insensitive prefix match on lower(column), which the lower-case
+    indexes cover. Postgres turns the LIKE into an index range scan by itself;
+    other databases get the equivalent range spelled out.
+    '''
+    lowered = func.lower(column)
+    prefix = prefix.lower()
+    condition = lowered.startswith(prefix, autoescape=True)
+    if db.engine.dialect.name != 'postgresql' and prefix[-1] != chr(0x10FFFF):
+        upper_bound = prefix[:-1] + chr(ord(prefix[-1]) + 1)
+        condition = and_(lowered >= prefix, lowered < upper_bound, condition)
+    return condition
+
+
+def filter_actors(query, args):
+    '''
+    Applies the actor list filters: gender, min_age, max_age and a name prefix
+    '''
+    gender = args.get('gender')
+    if gender is not None:
+        if gender not in ('M', 'F'):
+            abort(400)
+        query = query.filter(Actor.gender == gender)
+    if args.get('min_age') is not None:
+        query = query.filter(Actor.age >= parse_int(args['min_age']))
+    if args.get('max_age') is not None:
+        query = query.filter(Actor.age <= parse_int(args['max_age']))
+    if args.get('name'):
+        query = query.filter(prefix_filter(Actor.name, args['name']))
+    return query
+
+
+def filter_movies(query, args):
+    '''
+    Applies the movie list filters: released_after, released_before (both
+    inclusive ISO dates) and a title prefix
+    '''
+    if args.get('released_after') is not None:
+        query = query.filter(Movie.release_date >= parse_datetime(args['released_after']))
+    if args.get('released_before') is not None:
+        query = query.filter(Movie.release_date <= parse_datetime(args['released_before']))
+    if args.get('title'):
+        query = query.filter(prefix_filter(Movie.title, args['title']))
+    return query
+
+
+def keyset_predicate(column, id_column, value, row_id, descending):
+    '''
+    Rows with a value strictly after (value, row_id) in ORDER BY column, id,
+    as a row comparison the (column, id) indexes serve
+    '''
+    position = tuple_(column, id_column)
+    if descending:
+        return position < tuple_(value, row_id)
+    return position > tuple_(value, row_id)
+
+
+def page_queries(model, query, args, default_sort='id'):
+    '''
+    Returns the queries selecting one page, plus one row to tell whether there
+    is a next page, to run in turn until the page is full, along with the name
+    of the sort column and the page size. A sort on another column than the
+    id puts NULLs last: the rows with a value and those without are read by
+    two queries, each ordered like the (column, id) index so that neither
+    has to sort the table.
+    '''
+    sort = args.get('sort', default_sort)
+    name, descending = parse_sort(model, sort)
+    limit = parse_limit(args.get('limit'))
+    column = getattr(model, name)
+    id_order = model.id.desc() if descending else model.id.asc()
+
+    cursor = args.get('cursor')
+    if cursor:
+        cursor_sort, value, row_id = decode_cursor(cursor)
+        if cursor_sort != sort:
+            abort(400)
+    if name == 'id':
+        if cursor:
+            query = query.filter(model.id < row_id if descending else model.id > row_id)
+        return [query.order_by(id_order).limit(limit + 1)], name, limit
+
+    order = [column.desc() if descending else column.asc(), id_order]
+    with_value = query.filter(column.isnot(None))
+    without_value = query.filter(column.is_(None))
+    if cursor:
+        if value is None:
+            with_value = None
+            without_value = without_value.filter(
+                model.id < row_id if descending else model.id > row_id)
+        else:
+            value = parse_cursor_value(column, value)
+            with_value = with_value.filter(
+                keyset_predicate(column, model.id, value, row_id, descending))
+    queries = [with_value, without_value]
+    return [query.order_by(*order).limit(limit + 1) for query in queries
+            if query is not None], name, limit
+
+
+def paginate(model, query, args, default_sort='id'):
+    '''
+    Returns one page of `query` as (rows, next cursor). The next cursor is
+    None on the last page.
+    '''
+    queries, name, limit = page_queries(model, query, args, default_sort)
+    sort = args.get('sort', default_sort)
+    rows = []
+    for query in queries:
+        rows += query.limit(limit + 1 - len(rows)).all()
+        if len(rows) > limit:
+            break
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        last = rows[-1]
+        next_cursor = encode_cursor(sort, getattr(last, name), last.id)
+    return rows, next_cursor
@@ -0,0 +1,200 @@
+import os
+import threading
+import time
+
+from sqlalchemy import event, exc
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.pool import AsyncAdaptedQueuePool, Pool, QueuePool
+
+
+class PoolMetrics:
+    '''
+    Process-wide counters of connection pool activity, including how long
+    requests waited to check a connection out
+    '''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.pools = []
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.connects = 0
+            self.checkouts = 0
+            self.checkins = 0
+            self.invalidations = 0
+            self.timeouts = 0
+            self.wait_seconds_total = 0.0
+            self.wait_seconds_max = 0.0
+
+    def record_wait(self, seconds, timed_out=False):
+        with self._lock:
+            self.wait_seconds_total += seconds
+            self.wait_seconds_max = max(self.wait_seconds_max, seconds)
+            if timed_out:
+                self.timeouts += 1
+
+    def incr(self, name):
+        with self._lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    def snapshot(self):
+        pools = [{
+            'size': pool.size(),
+            'checked_out': pool.checkedout(),
+            'overflow': pool.overflow(),
+            'idle': pool.checkedin()
+        } for pool in self.pools]
+        with self._lock:
+            return {
+                'connects': self.connects,
+                'checkouts': self.checkouts,
+                'checkins': self.checkins,
+                'invalidations': self.invalidations,
+                'timeouts': self.timeouts,
+                'wait_seconds_total': self.wait_seconds_total,
+                'wait_seconds_max': self.wait_seconds_max,
+                'pools': pools
+            }
+
+
+pool_metrics = PoolMetrics()
+
+
+class InstrumentedQueuePool(QueuePool):
+    '''
+    QueuePool that records how long each checkout waited for a connection
+    '''
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        pool_metrics.pools.append(self)
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            connection = super()._do_get()
+        except exc.TimeoutError:
+            pool_metrics.record_wait(time.perf_counter() - start, timed_out=True)
+            raise
+        pool_metrics.record_wait(time.perf_counter() - start)
+        return connection
+
+    def recreate(self):
+        pool = super().recreate()
+        if self in pool_metrics.pools:
+            pool_metrics.pools.remove(self)
+        return pool
+
+
+class InstrumentedAsyncAdaptedQueuePool(InstrumentedQueuePool, AsyncAdaptedQueuePool):
+    '''
+    InstrumentedQueuePool for async drivers, whose checkouts wait on the
+    event loop instead of blocking the thread
+    '''
+
+
+@event.listens_for(Pool, 'connect')
+def on_connect(dbapi_connection, connection_record):
+    connection_record.info['pid'] = os.getpid()
+    pool_metrics.incr('connects')
+
+
+@event.listens_for(Pool, 'checkout')
+def on_checkout(dbapi_connection, connection_record, connection_proxy):
+    '''
+    Refuses connections opened by another process, e.g. inherited from the
+    gunicorn master, so forked workers never share a socket
+    '''
+    pid = os.getpid()
+    if connection_record.info.get('pid', pid) != pid:
+        # Detached first, so invalidating the record doesn't close the
+        # parent's socket. The attribute is `connection` up to SQLAlchemy
+        # 1.4.23 and `dbapi_connection` from 1.4.24.
+        for holder in (connection_record, connection_proxy):
+            name = 'dbapi_connection' if hasattr(holder, 'dbapi_connection') else 'connection'
+            setattr(holder, name, None)
+        raise exc.DisconnectionError(
+            'Connection record belongs to pid %s, attempting to check out in pid %s'
+            % (connection_record.info['pid'], pid))
+    pool_metrics.incr('checkouts')
+
+
+@event.listens_for(Pool, 'checkin')
+def on_checkin(dbapi_connection, connection_record):
+    pool_metrics.incr('checkins')
+
+
+@event.listens_for(Pool, 'invalidate')
+def on_invalidate(dbapi_connection, connection_record, exception):
+    pool_metrics.incr('invalidations')
+
+
+def engine_options(config):
+    '''
+    Builds the create_engine options from the DB_* settings. Pool sizing only
+    applies to server databases; SQLite keeps Flask-SQLAlchemy's defaults.
+    '''
+    options = {
+        'pool_pre_ping': config['DB_POOL_PRE_PING'],
+        'pool_recycle': config['DB_POOL_RECYCLE']
+    }
+    uri = config.get('SQLALCHEMY_DATABASE_URI')
+    if not uri or make_url(uri).get_backend_name() == 'sqlite':
+        return options
+
+    is_async = make_url(uri).get_dialect().is_async
+    options.update({
+        'poolclass': InstrumentedAsyncAdaptedQueuePool if is_async else InstrumentedQueuePool,
+        'pool_size': config['DB_POOL_SIZE'],
+        'max_overflow': config['DB_MAX_OVERFLOW'],
+        'pool_timeout': config['DB_POOL_TIMEOUT']
+    })
+    if config['DB_STATEMENT_TIMEOUT'] and make_url(uri).get_backend_name() == 'postgresql':
+        if is_async:
+            options['connect_args'] = {
+                'server_settings': {'statement_timeout': str(config['DB_STATEMENT_TIMEOUT'])}
+            }
+        else:
+            options['connect_args'] = {
+                'options': f"-c statement_timeout={config['DB_STATEMENT_TIMEOUT']}"
+            }
+    return options
+
+
+def init_pool(app):
+    '''
+    Sets SQLALCHEMY_ENGINE_OPTIONS from the pool settings; options already
+    present in the config take precedence
+    '''
+    options = engine_options(app.config)
+    options.update(app.config.get('SQLALCHEMY_ENGINE_OPTIONS') or {})
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = options
+
+
+# Pools replaced in a forked worker. They stay referenced so that their
+# connections, which belong to the parent, are never closed or collected
+_inherited_pools = []
+
+
+def replace_pool(engine):
+    '''
+    Gives `engine` a new, empty pool without closing the connections of the
+    old one. engine.dispose() would close them, sending the parent's sockets
+    a termination, and dispose(close=False) only exists from SQLAlchemy
+    1.4.33.
+    '''
+    _inherited_pools.append(engine.pool)
+    engine.pool = engine.pool.recreate()
+
+
+def dispose_engines(app, db):
+    '''
+    Leaves the pooled connections inherited from the parent process, of the
+    primary and of every bind, such as the read replicas, to the parent.
+    Meant to run in a freshly forked worker, before it handles any request.
+    '''
+    binds = app.config.get('SQLALCHEMY_BINDS') or {}
+    for bind in [None] + list(binds):
+        replace_pool(db.get_engine(app, bind=bind))
@@ -0,0 +1,237 @@
+import cProfile
+import os
+import random
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+from flask import g, has_request_context, json, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+'''
+Upper bounds, in seconds, of the request latency histogram buckets
+'''
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+PROFILE_HEADER = 'X-Profile'
+PROFILE_PERMISSION = 'profile:requests'
+
+
+@contextmanager
+def phase(name):
+    '''
+    Adds the time spent in the block to the current request's `name` phase.
+    Does nothing outside requests or when instrumentation is off.
+    '''
+    phases = g.get('phases') if has_request_context() else None
+    if phases is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(phases, name, time.perf_counter() - start)
+
+
+def record(phases, name, seconds):
+    total, count = phases.get(name, (0.0, 0))
+    phases[name] = (total + seconds, count + 1)
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def on_before_execute(conn, cursor, statement, parameters, context, executemany):
+    if has_request_context() and g.get('phases') is not None:
+        conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def on_after_execute(conn, cursor, statement, parameters, context, executemany):
+    starts = conn.info.get('query_start')
+    if starts and has_request_context() and g.get('phases') is not None:
+        record(g.phases, 'db', time.perf_counter() - starts.pop())
+
+
+class TimedJSONEncoder(json.JSONEncoder):
+    '''
+    JSON encoder of jsonify timing the serialization phase
+    '''
+
+    def encode(self, o):
+        with phase('serialize'):
+            return super().encode(o)
+
+
+class RequestMetrics:
+    '''
+    Per-route latency histograms and database query totals, rendered in the
+    Prometheus text format
+    '''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.routes = {}
+
+    def observe(self, route, method, status, seconds, phases):
+        db_seconds, queries = phases.get('db', (0.0, 0))
+        with self._lock:
+            entry = self.routes.get((route, method))
+            if entry is None:
+                entry = self.routes[(route, method)] = {
+                    'buckets': [0] * len(LATENCY_BUCKETS), 'count': 0, 'sum': 0.0,
+                    'queries': 0, 'query_seconds': 0.0, 'statuses': {}}
+            for index, bound in enumerate(LATENCY_BUCKETS):
+                if seconds <= bound:
+                    entry['buckets'][index] += 1
+            entry['count'] += 1
+            entry['sum'] += seconds
+            entry['queries'] += queries
+            entry['query_seconds'] += db_seconds
+            entry['statuses'][status] = entry['statuses'].get(status, 0) + 1
+
+    def render(self, gauges=()):
+        '''
+        Returns the metrics in the Prometheus text format. `gauges` adds
+        (name, help, type, value) samples, e.g. from the connection pool.
+        '''
+        lines = [
+            '# HELP http_request_duration_seconds Request latency by route',
+            '# TYPE http_request_duration_seconds histogram'
+        ]
+        with self._lock:
+            routes = sorted(self.routes.items())
+            for (route, method), entry in routes:
+                labels = f'route="{route}",method="{method}"'
+                for bound, count in zip(LATENCY_BUCKETS, entry['buckets']):
+                    lines.append(f'http_request_duration_seconds_bucket{{{labels},le="{bound}"}} {count}')
+                lines.append(f'http_request_duration_seconds_bucket{{{labels},le="+Inf"}} {entry["count"]}')
+                lines.append(f'http_request_duration_seconds_sum{{{labels}}} {entry["sum"]}')
+                lines.append(f'http_request_duration_seconds_count{{{labels}}} {entry["count"]}')
+            lines += ['# HELP http_requests_total Requests by route and status',
+                      '# TYPE http_requests_total counter']
+            for (route, method), entry in routes:
+                for status, count in sorted(entry['statuses'].items()):
+                    lines.append(f'http_requests_total{{route="{route}",method="{method}",'
+                                 f'status="{status}"}} {count}')
+            lines += ['# HELP db_queries_total Database statements by route',
+                      '# TYPE db_queries_total counter']
+            for (route, method), entry in routes:
+                lines.append(f'db_queries_total{{route="{route}",method="{method}"}} {entry["queries"]}')
+            lines += ['# HELP db_query_seconds_total Time spent in database statements by route',
+                      '# TYPE db_query_seconds_total counter']
+            for (route, method), entry in routes:
+                lines.append(f'db_query_seconds_total{{route="{route}",method="{method}"}} '
+                             f'{entry["query_seconds"]}')
+        for name, help_text, metric_type, value in gauges:
+            lines += [f'# HELP {name} {help_text}', f'# TYPE {name} {metric_type}',
+                      f'{name} {value}']
+        return '\n'.join(lines) + '\n'
+
+
+request_metrics = RequestMetrics()
+
+
+def server_timing(phases, total):
+    entries = []
+    for name, (seconds, count) in phases.items():
+        entry = f'{name};dur={seconds * 1000:.2f}'
+        if name == 'db':
+            entry += f';desc="{count} queries"'
+        entries.append(entry)
+    entries.append(f'total;dur={total * 1000:.2f}')
+    return ', '.join(entries)
+
+
+def profile_allowed():
+    '''
+    Checks whether the caller asked for a profile with the X-Profile header
+    and holds the profile:requests permission
+    '''
+    if not request.headers.get(PROFILE_HEADER):
+        return False
+    from auth.auth import AuthError, verify_request_token
+    try:
+        verified = verify_request_token()
+    except AuthError:
+        return False
+    permissions = verified.permissions
+    if permissions is None:
+        permissions = verified.payload.get('permissions', ())
+    return PROFILE_PERMISSION in permissions
+
+
+class Profiler:
+    '''
+    Opt-in request instrumentation. With METRICS_ENABLED it feeds the
+    /metrics histograms; with PROFILING_ENABLED it also adds a Server-Timing
+    header with the auth, db and serialize phases, and runs cProfile on the
+    requests sampled by PROFILE_SAMPLE_RATE or sent with X-Profile by a caller
+    holding profile:requests. Profiles are written to PROFILE_DIR.
+    '''
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.metrics = app.config['METRICS_ENABLED']
+        self.profiling = app.config['PROFILING_ENABLED']
+        self.sample_rate = app.config['PROFILE_SAMPLE_RATE']
+        self.directory = app.config['PROFILE_DIR'] or \
+            os.path.join(tempfile.gettempdir(), 'capstone-profiles')
+        # The hooks are added once per app, so init_app can be called again
+        # to apply new settings; they do nothing while both are off
+        if app.extensions.get('profiler') is not self:
+            app.extensions['profiler'] = self
+            app.json_encoder = TimedJSONEncoder
+            app.before_request(self.start)
+            app.after_request(self.finish)
+
+    def start(self):
+        if not self.metrics and not self.profiling:
+            return
+        g.phases = {}
+        g.request_start = time.perf_counter()
+        if self.profiling and (profile_allowed() or random.random() < self.sample_rate):
+            g.profile = cProfile.Profile()
+            g.profile.enable()
+
+    def finish(self, response):
+        profile = g.pop('profile', None)
+        if profile is not None:
+            profile.disable()
+        start = g.get('request_start')
+        if start is None:
+            return response
+        total = time.perf_counter() - start
+        phases = g.pop('phases', {})
+
+        if self.metrics:
+            route = request.url_rule.rule if request.url_rule else 'unmatched'
+            request_metrics.observe(route, request.method, response.status_code,
+                                    total, phases)
+        if self.profiling:
+            response.headers['Server-Timing'] = server_timing(phases, total)
+            if profile is not None:
+                response.headers[PROFILE_HEADER] = self.dump(profile)
+        return response
+
+    def dump(self, profile):
+        '''
+        Saves a profile, readable with pstats or snakeviz, and returns its
+        file name
+        '''
+        os.makedirs(self.directory, exist_ok=True)
+        name = f"{time.strftime('%Y%m%d-%H%M%S')}-{request.endpoint or 'unmatched'}-" \
+               f"{os.getpid()}-{random.randrange(1 << 16):04x}.prof"
+        profile.dump_stats(os.path.join(self.directory, name))
+        return name
+
+
+profiler = Profiler()
@@ -0,0 +1,216 @@
+import time
+import uuid
+from contextlib import contextmanager
+
+from backends import MemoryBackend, SQLiteBackend, create_backend
+
+'''
+Admission control of the authenticated requests, applied by requires_auth
+once the token is verified and before the view runs any query: a token
+bucket per token subject, one per subject and permission, and a cap on the
+requests of a subject in flight. Requests over a limit fail fast with 429 and
+a Retry-After header.
+'''
+
+
+class RateLimitError(Exception):
+    def __init__(self, retry_after):
+        self.retry_after = retry_after
+
+
+def parse_rate(value):
+    '''
+    Parses a "rate[/burst]" limit, in requests per second and bucket size.
+    A missing or 0 burst defaults to the rate, and to at least one request.
+    '''
+    rate, _, burst = str(value).partition('/')
+    rate = float(rate)
+    burst = float(burst or 0) or max(rate, 1)
+    if rate <= 0 or burst < 1:
+        raise ValueError(f'Invalid rate limit: {value}')
+    return rate, burst
+
+
+def refill(tokens, updated_at, now, rate, burst):
+    '''
+    Takes a token from a bucket last updated at `updated_at`. Returns the
+    tokens left and the seconds to wait before retrying, 0 when admitted.
+    '''
+    tokens = min(burst, tokens + (now - updated_at) * rate)
+    if tokens >= 1:
+        return tokens - 1, 0
+    return tokens, (1 - tokens) / rate
+
+
+class MemoryRateLimitBackend(MemoryBackend):
+    '''
+    Buckets and slots are per process: with several workers a subject gets
+    each limit once per worker, so use the SQLite backend to share them.
+    '''
+
+    def __init__(self, maxsize=100000):
+        super().__init__(maxsize)
+        self._in_flight = {}
+
+    def take(self, key, rate, burst):
+        with self._lock:
+            now = time.time()
+            tokens, updated_at = self._entries.get(key, (burst, now))
+            tokens, retry_after = refill(tokens, updated_at, now, rate, burst)
+            # A forgotten bucket is full again, as it would be by now
+            self._store(key, (tokens, now))
+            return retry_after
+
+    def acquire(self, key, limit):
+        '''
+        Takes one of the `limit` slots of `key` and returns it, or None when
+        they are all taken
+        '''
+        with self._lock:
+            count = self._in_flight.get(key, 0)
+            if count >= limit:
+                return None
+            self._in_flight[key] = count + 1
+            return True
+
+    def release(self, key, slot):
+        with self._lock:
+            count = self._in_flight.get(key, 0) - 1
+            if count > 0:
+                self._in_flight[key] = count
+            else:
+                self._in_flight.pop(key, None)
+
+
+class SQLiteRateLimitBackend(SQLiteBackend):
+    '''
+    The limits hold across the workers of the host. Slots of requests in
+    flight expire after SLOT_TTL seconds, in case their worker died.
+    '''
+    SLOT_TTL = 300
+    SCHEMA = ('CREATE TABLE IF NOT EXISTS buckets '
+              '(key TEXT PRIMARY KEY, tokens REAL, updated_at REAL)',
+              'CREATE TABLE IF NOT EXISTS slots '
+              '(id TEXT PRIMARY KEY, key TEXT, expires_at REAL)',
+              'CREATE INDEX IF NOT EXISTS ix_slots_key ON slots (key)')
+
+    def take(self, key, rate, burst):
+        with self._transaction() as conn:
+            now = time.time()
+            row = conn.execute('SELECT tokens, updated_at FROM buckets WHERE key = ?',
+                               (key,)).fetchone()
+            tokens, updated_at = row if row else (burst, now)
+            tokens, retry_after = refill(tokens, updated_at, now, rate, burst)
+            conn.execute('INSERT OR REPLACE INTO buckets VALUES (?, ?, ?)', (key, tokens, now))
+            return retry_after
+
+    def acquire(self, key, limit):
+        with self._transaction() as conn:
+            now = time.time()
+            conn.execute('DELETE FROM slots WHERE key = ? AND expires_at <= ?', (key, now))
+            count = conn.execute('SELECT count(*) FROM slots WHERE key = ?', (key,)).fetchone()[0]
+            if count >= limit:
+                return None
+            slot = uuid.uuid4().hex
+            conn.execute('INSERT INTO slots VALUES (?, ?, ?)', (slot, key, now + self.SLOT_TTL))
+            return slot
+
+    def release(self, key, slot):
+        self._connection().execute('DELETE FROM slots WHERE id = ?', (slot,))
+
+
+class RateLimiter:
+    '''
+    Applies RATE_LIMIT and RATE_LIMITS_PER_PERMISSION, token buckets refilled
+    continuously, and MAX_CONCURRENT_REQUESTS to the requests of each token
+    subject, and CHANGES_MAX_WAITING and CHANGES_MAX_WAITING_PER_USER to the
+    requests waiting for changes. Limits set to 0 are disabled.
+    '''
+
+    def __init__(self, app=None):
+        self.backend = None
+        self.rate = None
+        self.permission_rates = {}
+        self.max_concurrent = 0
+        self.max_waiting = 0
+        self.max_waiting_per_subject = 0
+        self.limited = 0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        config = app.config
+        self.rate = parse_rate(f"{config['RATE_LIMIT']}/{config['RATE_LIMIT_BURST']}") \
+            if config['RATE_LIMIT'] else None
+        self.permission_rates = {permission: parse_rate(limit) for permission, limit
+                                 in config['RATE_LIMITS_PER_PERMISSION'].items()}
+        self.max_concurrent = config['MAX_CONCURRENT_REQUESTS']
+        self.max_waiting = config['CHANGES_MAX_WAITING']
+        self.max_waiting_per_subject = config['CHANGES_MAX_WAITING_PER_USER']
+        enabled = self.rate or self.permission_rates or self.max_concurrent \
+            or self.max_waiting or self.max_waiting_per_subject
+        self.backend = create_backend('RATE_LIMIT_STORAGE', config['RATE_LIMIT_STORAGE'], {
+            'memory': MemoryRateLimitBackend,
+            'sqlite': SQLiteRateLimitBackend
+        }) if enabled else None
+
+    def reject(self, retry_after):
+        self.limited += 1
+        raise RateLimitError(retry_after)
+
+    @contextmanager
+    def limit(self, payload, permission=''):
+        '''
+        Admits a request of the token `payload` needing `permission` for the
+        duration of the block, or raises RateLimitError
+        '''
+        if self.backend is None:
+            yield
+            return
+        subject = payload.get('sub')
+        buckets = []
+        if self.rate:
+            buckets.append((f'sub:{subject}', self.rate))
+        if permission in self.permission_rates:
+            buckets.append((f'permission:{subject}:{permission}', self.permission_rates[permission]))
+        for key, (rate, burst) in buckets:
+            retry_after = self.backend.take(key, rate, burst)
+            if retry_after:
+                self.reject(retry_after)
+
+        slot = None
+        if self.max_concurrent:
+            slot = self.backend.acquire(f'in_flight:{subject}', self.max_concurrent)
+            if slot is None:
+                self.reject(1)
+        try:
+            yield
+        finally:
+            if slot is not None:
+                self.backend.release(f'in_flight:{subject}', slot)
+
+    @contextmanager
+    def waiting(self, payload):
+        '''
+        Admits a request of the token `payload` waiting for changes for the
+        duration of the block, or raises RateLimitError
+        '''
+        if self.backend is None:
+            yield
+            return
+        slots = []
+        try:
+            for key, limit in ((f"waiting:{payload.get('sub')}", self.max_waiting_per_subject),
+                               ('waiting', self.max_waiting)):
+                if limit:
+                    slot = self.backend.acquire(key, limit)
+                    if slot is None:
+                        self.reject(1)
+                    slots.append((key, slot))
+            yield
+        finally:
+            for key, slot in slots:
+                self.backend.release(key, slot)
+
+
+rate_limiter = RateLimiter()
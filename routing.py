@@ -0,0 +1,219 @@
+import math
+import threading
+import time
+
+from flask import _request_ctx_stack, has_request_context, request
+from flask_sqlalchemy import SignallingSession, SQLAlchemy
+from itsdangerous import BadSignature, URLSafeSerializer
+from sqlalchemy import orm, text
+from sqlalchemy.ext.asyncio import create_async_engine
+
+READ_METHODS = ('GET', 'HEAD')
+
+# Where a response hands the read-your-writes marker to the client, and where
+# the client sends it back
+MARKER_HEADER = 'X-Read-Your-Writes'
+MARKER_COOKIE = 'read_your_writes'
+
+
+class RoutingSession(SignallingSession):
+    '''
+    Session sending the reads of GET requests to a replica and everything
+    else, including any flush, to the primary
+    '''
+
+    def __init__(self, db, **options):
+        self.db = db
+        SignallingSession.__init__(self, db, **options)
+
+    def get_bind(self, mapper=None, clause=None, **kwargs):
+        router = self.app.extensions.get('replica_router')
+        if router is not None and router.use_replica(self):
+            engine = router.replica_engine(self.db, self.app)
+            if engine is not None:
+                return engine
+        return SignallingSession.get_bind(self, mapper, clause)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+    def create_engine(self, sa_url, engine_opts):
+        '''
+        Engines of async drivers, as used by asgi.py, are created through
+        SQLAlchemy's asyncio extension. The sessions run on their sync facade,
+        whose I/O is awaited on the event loop.
+        '''
+        if sa_url.get_dialect().is_async:
+            return create_async_engine(sa_url, **engine_opts).sync_engine
+        return super().create_engine(sa_url, engine_opts)
+
+
+class Replica:
+
+    def __init__(self, bind_key):
+        self.bind_key = bind_key
+        self.healthy = True
+        self.checked_at = None
+
+
+class ReplicaRouter:
+    '''
+    Routes GET reads round-robin over the healthy replicas in
+    SQLALCHEMY_REPLICA_URIS. A replica is pinged at most once every
+    REPLICA_HEALTH_CHECK_INTERVAL seconds and skipped while the ping fails.
+    After a write, the same token subject reads from the primary for
+    READ_YOUR_WRITES_WINDOW seconds, so it sees its own changes even if the
+    replicas lag. The write's response carries a marker signed with
+    SECRET_KEY, holding the subject and the time of the write, in the
+    X-Read-Your-Writes header and a cookie; whichever worker serves a read
+    sending it back checks it without a query. The reads of one request all
+    go to the same replica.
+    '''
+
+    def __init__(self, app=None):
+        self.replicas = []
+        self.window = 0
+        self.health_check_interval = 0
+        self.reads = {'primary': 0, 'replica': 0}
+        self.serializer = None
+        self._next = 0
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        from models import on_write
+
+        binds = dict(app.config.get('SQLALCHEMY_BINDS') or {})
+        self.replicas = []
+        for index, uri in enumerate(app.config['SQLALCHEMY_REPLICA_URIS']):
+            bind_key = f'replica_{index}'
+            binds[bind_key] = uri
+            self.replicas.append(Replica(bind_key))
+        app.config['SQLALCHEMY_BINDS'] = binds
+        self.window = app.config['READ_YOUR_WRITES_WINDOW']
+        self.health_check_interval = app.config['REPLICA_HEALTH_CHECK_INTERVAL']
+        self.serializer = URLSafeSerializer(app.secret_key, salt='read-your-writes')
+        if app.extensions.get('replica_router') is not self:
+            app.extensions['replica_router'] = self
+            app.after_request(self.set_marker)
+        on_write(self.record_write)
+
+    def current_subject(self):
+        if not has_request_context():
+            return None
+        payload = getattr(_request_ctx_stack.top, 'current_user', None)
+        return payload.get('sub') if payload else None
+
+    def record_write(self, table):
+        '''
+        Notes the write of the current request's subject, so its response
+        carries the marker
+        '''
+        if not self.replicas or self.current_subject() is None:
+            return
+        context = _request_ctx_stack.top
+        context.read_primary = True
+        context.written_at = time.time()
+
+    def marker(self, subject, written_at):
+        return self.serializer.dumps([subject, written_at])
+
+    def set_marker(self, response):
+        written_at = getattr(_request_ctx_stack.top, 'written_at', None)
+        if written_at is not None:
+            marker = self.marker(self.current_subject(), written_at)
+            response.headers[MARKER_HEADER] = marker
+            response.set_cookie(MARKER_COOKIE, marker, max_age=math.ceil(self.window),
+                                httponly=True, samesite='Lax')
+        return response
+
+    def wrote_recently(self, subject):
+        '''
+        Whether the marker sent with the request is valid and says `subject`
+        wrote within the window
+        '''
+        marker = request.headers.get(MARKER_HEADER) or request.cookies.get(MARKER_COOKIE)
+        if not marker:
+            return False
+        try:
+            marked_subject, written_at = self.serializer.loads(marker)
+        except (BadSignature, TypeError, ValueError):
+            return False
+        return marked_subject == subject and \
+            isinstance(written_at, (int, float)) and time.time() - written_at < self.window
+
+    def read_primary(self):
+        '''
+        Whether the reads of the current request go to the primary because
+        its subject wrote within the window, decided once per request
+        '''
+        context = _request_ctx_stack.top
+        decided = getattr(context, 'read_primary', None)
+        if decided is not None:
+            return decided
+        subject = self.current_subject()
+        if subject is None:
+            return False
+        context.read_primary = self.wrote_recently(subject)
+        return context.read_primary
+
+    def in_write_window(self):
+        '''
+        Whether the current request reads the primary after a write of its
+        subject, e.g. to keep replica reads of other requests from serving it
+        '''
+        return bool(self.replicas) and has_request_context() and self.read_primary()
+
+    def use_replica(self, session):
+        if not self.replicas or not has_request_context():
+            return False
+        if request.method not in READ_METHODS:
+            return False
+        if session._flushing or session.new or session.dirty or session.deleted:
+            return False
+        if self.read_primary():
+            self.reads['primary'] += 1
+            return False
+        return True
+
+    def is_healthy(self, db, app, replica):
+        now = time.monotonic()
+        if replica.checked_at is not None and \
+                now - replica.checked_at < self.health_check_interval:
+            return replica.healthy
+        replica.checked_at = now
+        try:
+            with db.get_engine(app, bind=replica.bind_key).connect() as connection:
+                connection.execute(text('SELECT 1'))
+            replica.healthy = True
+        except Exception:
+            replica.healthy = False
+        return replica.healthy
+
+    def replica_engine(self, db, app):
+        '''
+        Returns the engine of the replica the current request reads, the next
+        healthy one on its first read, or None to fall back to the primary
+        '''
+        context = _request_ctx_stack.top
+        engine = getattr(context, 'replica_engine', None)
+        if engine is not None:
+            self.reads['replica'] += 1
+            return engine
+        for _ in range(len(self.replicas)):
+            with self._lock:
+                replica = self.replicas[self._next % len(self.replicas)]
+                self._next += 1
+            if self.is_healthy(db, app, replica):
+                self.reads['replica'] += 1
+                context.replica_engine = db.get_engine(app, bind=replica.bind_key)
+                return context.replica_engine
+        self.reads['primary'] += 1
+        return None
+
+
+replica_router = ReplicaRouter()
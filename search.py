@@ -0,0 +1,234 @@
+import heapq
+import re
+
+from sqlalchemy import column, func, inspect, literal, select, union_all
+
+from concurrency import IOLock
+from changes import read_log, settled_seq
+from models import db, BULK_INSERT_CHUNK_SIZE, Actor, ChangeLog, Movie
+from serializer import get_serializer
+
+'''
+Column searched in each table, keyed by the result type
+'''
+SEARCHABLE = {
+    'actor': (Actor, 'name'),
+    'movie': (Movie, 'title')
+}
+
+# Prefixes longer than this are looked up by their first characters and
+# checked against the indexed words
+MAX_PREFIX_LENGTH = 8
+
+TOKEN_RE = re.compile(r'\w+', re.UNICODE)
+
+
+def tokenize(text):
+    return TOKEN_RE.findall((text or '').lower())
+
+
+class PostgresSearchEngine:
+    '''
+    Searches the search_vector columns, generated from the searched columns
+    and indexed with GIN. Every word of the query must match the start of a
+    word, and results are ranked with ts_rank.
+    '''
+
+    def __init__(self):
+        self._has_vector = {}
+
+    def vector(self, model, name):
+        '''
+        Returns the search_vector column, or the same expression computed
+        inline (without index) when the migration hasn't been applied
+        '''
+        key = (str(db.engine.url), model.__tablename__)
+        if key not in self._has_vector:
+            columns = inspect(db.engine).get_columns(model.__tablename__)
+            self._has_vector[key] = any(c['name'] == 'search_vector' for c in columns)
+        if self._has_vector[key]:
+            return column('search_vector')
+        return func.to_tsvector('simple', func.coalesce(getattr(model, name), ''))
+
+    def search(self, tokens, types, offset, limit):
+        query = func.to_tsquery('simple', ' & '.join(f'{token}:*' for token in tokens))
+        selects = []
+        for type_ in types:
+            model, name = SEARCHABLE[type_]
+            vector = self.vector(model, name)
+            selects.append(
+                select([literal(type_).label('type'), model.id.label('id'),
+                        func.ts_rank(vector, query).label('rank')])
+                .select_from(model.__table__)
+                .where(vector.op('@@')(query)))
+        matches = union_all(*selects).subquery()
+        rows = db.session.execute(
+            select([matches.c.type, matches.c.id])
+            .order_by(matches.c.rank.desc(), matches.c.type, matches.c.id)
+            .offset(offset).limit(limit))
+        return [(row.type, row.id) for row in rows]
+
+
+class MemorySearchEngine:
+    '''
+    In-process index of the searched words by prefix, for SQLite and test
+    deployments. A search costs one dictionary lookup per query word, whatever
+    the size of the tables. The index is built on the first search, then kept
+    up to date by re-indexing the rows the writes recorded in the change log
+    since, whichever worker made them, so a search after a write costs in
+    proportion to the changed rows rather than to the tables.
+    '''
+
+    def __init__(self):
+        self._prefixes = {}
+        self._words = {}
+        self._seq = None
+        self._lock = IOLock()
+
+    def last_seq(self):
+        return db.session.query(func.max(ChangeLog.seq)).scalar() or 0
+
+    def add(self, key, text):
+        self._words[key] = tokenize(text)
+        for word in set(self._words[key]):
+            for length in range(1, min(len(word), MAX_PREFIX_LENGTH) + 1):
+                self._prefixes.setdefault(word[:length], set()).add(key)
+
+    def remove(self, key):
+        for word in set(self._words.pop(key, ())):
+            for length in range(1, min(len(word), MAX_PREFIX_LENGTH) + 1):
+                postings = self._prefixes.get(word[:length])
+                if postings is not None:
+                    postings.discard(key)
+                    if not postings:
+                        del self._prefixes[word[:length]]
+
+    def build(self):
+        # Changes after the settled ones may be missing from the rows read,
+        # so catch_up applies them again
+        seq = settled_seq()
+        for type_, (model, name) in SEARCHABLE.items():
+            for row_id, text in db.session.query(model.id, getattr(model, name)):
+                self.add((type_, row_id), text)
+        self._seq = seq
+
+    def catch_up(self):
+        '''
+        Re-indexes the rows changed after the last change applied
+        '''
+        entries = read_log(self._seq)
+        ids = {}
+        for entry in entries:
+            if entry.model in SEARCHABLE:
+                ids.setdefault(entry.model, set()).add(entry.entity_id)
+        for type_, row_ids in ids.items():
+            model, name = SEARCHABLE[type_]
+            row_ids = sorted(row_ids)
+            for start in range(0, len(row_ids), BULK_INSERT_CHUNK_SIZE):
+                chunk = row_ids[start:start + BULK_INSERT_CHUNK_SIZE]
+                texts = dict(db.session.query(model.id, getattr(model, name))
+                             .filter(model.id.in_(chunk)))
+                for row_id in chunk:
+                    self.remove((type_, row_id))
+                    if row_id in texts:
+                        self.add((type_, row_id), texts[row_id])
+        if entries:
+            self._seq = entries[-1].seq
+
+    def refresh(self):
+        seq = self.last_seq()
+        if seq != self._seq:
+            with self._lock:
+                if self._seq is None:
+                    self.build()
+                if seq > self._seq:
+                    self.catch_up()
+
+    def score(self, key, tokens):
+        '''
+        Returns the rank of a candidate, or None if a query word matches no
+        word of it. Whole words rank above prefixes.
+        '''
+        words = self._words[key]
+        score = 0.0
+        for token in tokens:
+            if token in words:
+                score += 1.0
+            elif any(word.startswith(token) for word in words):
+                score += 0.5
+            else:
+                return None
+        return score / len(words)
+
+    def search(self, tokens, types, offset, limit):
+        self.refresh()
+        # Held while the index is read, as catch_up updates it in place
+        with self._lock:
+            candidates = None
+            for token in sorted(tokens, key=len, reverse=True):
+                postings = self._prefixes.get(token[:MAX_PREFIX_LENGTH], set())
+                candidates = postings if candidates is None else candidates & postings
+            ranked = []
+            for key in candidates or ():
+                if key[0] not in types:
+                    continue
+                score = self.score(key, tokens)
+                if score is not None:
+                    ranked.append((-score, key[0], key[1]))
+        page = heapq.nsmallest(offset + limit, ranked)[offset:]
+        return [(type_, row_id) for _, type_, row_id in page]
+
+
+def create_search_engine(name, database_uri):
+    '''
+    Creates the engine named by SEARCH_ENGINE: "postgres", "memory", or
+    "auto" to pick Postgres full-text search when the database supports it
+    '''
+    if name == 'auto':
+        name = 'postgres' if database_uri and database_uri.startswith('postgres') \
+            else 'memory'
+    if name == 'postgres':
+        return PostgresSearchEngine()
+    if name == 'memory':
+        return MemorySearchEngine()
+    raise ValueError(f'Unknown SEARCH_ENGINE: {name}')
+
+
+class Search:
+    '''
+    Ranks the actors and movies matching a query with the configured engine,
+    then loads the matching rows of a page with one query per type
+    '''
+
+    def __init__(self, app=None):
+        self.engine = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.engine = create_search_engine(app.config['SEARCH_ENGINE'],
+                                           app.config.get('SQLALCHEMY_DATABASE_URI'))
+
+    def search(self, q, types, offset, limit):
+        '''
+        Returns up to `limit` results from `offset` on, as dicts with the
+        result type and the columns of the row
+        '''
+        tokens = tokenize(q)
+        if not tokens or not types:
+            return []
+        matches = self.engine.search(tokens, types, offset, limit)
+
+        rows = {}
+        for type_ in types:
+            model, _ = SEARCHABLE[type_]
+            ids = [row_id for match_type, row_id in matches if match_type == type_]
+            if ids:
+                serializer = get_serializer(model)
+                query = serializer.query().filter(model.id.in_(ids))
+                for row in query:
+                    rows[(type_, row.id)] = dict(type=type_, **serializer.row(row))
+        return [rows[match] for match in matches if match in rows]
+
+
+search_index = Search()
@@ -0,0 +1,57 @@
+from collections import Counter
+
+from models import db, Actor, Movie, StatCounter, adjust_counters, commit
+
+STAT_MODELS = (Actor, Movie)
+
+# Rows read per round trip when rebuilding the counters
+REBUILD_BATCH_SIZE = 1000
+
+
+def is_decade(bucket):
+    return bucket.lstrip('-').isdigit()
+
+
+def read_stats():
+    '''
+    Returns the stats from the counters, whose number depends on the distinct
+    genders, age decades and release years, not on the number of rows
+    '''
+    counters = dict(db.session.query(StatCounter.name, StatCounter.value))
+
+    def group(prefix):
+        return {name[len(prefix):]: value for name, value in sorted(counters.items())
+                if name.startswith(prefix) and value}
+
+    ages = group('actor.age.')
+    by_age = {}
+    for bucket in sorted(ages, key=lambda bucket: int(bucket) if is_decade(bucket) else 1000):
+        label = f'{bucket}-{int(bucket) + 9}' if is_decade(bucket) else bucket
+        by_age[label] = ages[bucket]
+
+    return {
+        'actors': {
+            'total': counters.get('actor', 0),
+            'by_gender': group('actor.gender.'),
+            'by_age': by_age
+        },
+        'movies': {
+            'total': counters.get('movie', 0),
+            'by_release_year': group('movie.year.')
+        }
+    }
+
+
+def rebuild_counters():
+    '''
+    Recomputes every counter with one scan of each table, e.g. for a
+    database written without going through the models
+    '''
+    deltas = Counter()
+    for model in STAT_MODELS:
+        columns = [getattr(model, field) for field in model.STAT_FIELDS]
+        for row in db.session.query(*columns).yield_per(REBUILD_BATCH_SIZE):
+            deltas.update(model.stat_keys(dict(zip(model.STAT_FIELDS, row))))
+    StatCounter.query.delete()
+    adjust_counters(deltas)
+    commit()
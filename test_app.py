@@ -1,35 +1,53 @@
 import os
+import asyncio
+import gzip
+import importlib.util
 import unittest
 import json
-from flask_sqlalchemy import SQLAlchemy
-from app import app
-from models import db, Movie, Actor
-from datetime import datetime
+import random
+import tempfile
+import time
+from unittest import mock
+from flask import Response, abort, jsonify, request, _request_ctx_stack
+from itsdangerous import URLSafeSerializer
+from sqlalchemy import create_engine, event
+from sqlalchemy.exc import IntegrityError
+from werkzeug.exceptions import BadRequest
+from app import app, create_app
+from models import db, bump_version, group_commit, Movie, Actor, ChangeLog, TableVersion, \
+    WriteOperation
+from pagination import filter_actors, filter_movies, page_queries, parse_fields, \
+    cursor_fields, encode_cursor
+from pool import InstrumentedQueuePool, InstrumentedAsyncAdaptedQueuePool, engine_options, \
+    dispose_engines, replace_pool
+from routing import MARKER_COOKIE, MARKER_HEADER, replica_router
+from serializer import dumps, format_datetime, get_serializer
+from search import search_index, MemorySearchEngine
+from stats import read_stats, rebuild_counters
+from profiling import profiler, request_metrics
+from auth.auth import AuthError, check_permissions, verify_decode_jwt
+from auth.jwks import JWKSKeyStore, JWKSError
+from auth.local import LocalAuthProvider
+from auth.token_cache import VerifiedTokenCache
+from backends import create_backend
+from cache import MemoryCacheBackend, SQLiteCacheBackend, response_cache
+from testing import DatabaseTestCase, ASGITestClient
+from asgi import async_database_uri, create_asgi_app
+from concurrency import run_on_event_loop
+from writebehind import write_behind
+from idempotency import idempotency, DatabaseIdempotencyBackend
+from ratelimit import rate_limiter, SQLiteRateLimitBackend
+from formats import COLUMNAR_JSON_MIMETYPE, MSGPACK_MIMETYPE
+from datetime import datetime, timedelta
 
 
-class CapstoneTestCase(unittest.TestCase):
+class CapstoneTestCase(DatabaseTestCase):
     """This class represents the trivia test case"""
 
     def setUp(self):
-        """Define test variables and initialize app."""
-        os.system('sh setup.sh')
-        self.app = app()
-        self.client = self.app.test_client
-        self.database_path = os.environ.get('DATABASE_TEST_PATH')
-        # setup_db(self.app, self.database_path)
-        self.app.config["SQLALCHEMY_DATABASE_URI"] = self.database_path
-        self.app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
-        db.app = self.app
-        db.init_app(self.app)
-        db.create_all()
-
-        # binds the app to the current context
-        with self.app.app_context():
-            self.db = SQLAlchemy()
-            self.db.init_app(self.app)
-            # create all tables
-            self.db.create_all()
-        
+        """Define test variables and start the test's transaction."""
+        super().setUp()
+
         self.actor = {
             'name': 'Leonardo Dicaprio',
             'age': '46',
@@ -52,15 +70,6 @@ class CapstoneTestCase(unittest.TestCase):
             'release_date': datetime.now()
         }
 
-        self.director_headers = {'Content-Type': 'application/json',
-                                 'Authorization': os.environ.get('DIRECTOR_TOKEN')}
-        self.producer_headers = {'Content-Type': 'application/json',
-                                 'Authorization': os.environ.get('PRODUCER_TOKEN')}
-    
-    def tearDown(self):
-        """Executed after reach test"""
-        pass
-
     def test_get_actors(self):
         """
         This function tests retrieving actors successfully.
@@ -79,8 +88,214 @@ class CapstoneTestCase(unittest.TestCase):
         data = json.loads(res.data)
         self.assertEqual(res.status_code, 200)
         self.assertTrue(data['success'])
-        self.assertTrue(len(data['actors']))    
+        self.assertTrue(len(data['movies']))
     
+    def walk_pages(self, path):
+        """
+        This function follows the cursors of a list endpoint to its last
+        page and returns the ids of every page.
+        """
+        pages, url = [], path
+        while True:
+            res = self.client().get(url, headers=self.producer_headers)
+            data = json.loads(res.data)
+            self.assertEqual(res.status_code, 200)
+            key = 'actors' if 'actors' in data else 'movies'
+            pages.append([row['id'] for row in data[key]])
+            if data['next'] is None:
+                return pages
+            url = f"{path}&cursor={data['next']}"
+
+    def expected_order(self, model, name, descending):
+        """
+        This function orders the rows like the list endpoints do: by the
+        sort column with NULLs last, then by id.
+        """
+        rows = [(getattr(row, name), row.id) for row in model.query]
+        present = sorted((row for row in rows if row[0] is not None), reverse=descending)
+        missing = sorted((row for row in rows if row[0] is None), reverse=descending)
+        return [row_id for _, row_id in present + missing]
+
+    def test_get_actors_paginated(self):
+        """
+        This function tests paging through actors with a cursor, ascending
+        and descending, with ties and NULL ages.
+        """
+        Actor.insert_many([{'name': f'Paged {i}', 'age': [30, 47, None][i % 3], 'gender': 'MF'[i % 2]}
+                           for i in range(10)])
+        for sort in ('age', '-age', 'name', '-id'):
+            pages = self.walk_pages(f'/actors?limit=3&sort={sort}')
+            self.assertEqual(len(pages), 4)
+            self.assertTrue(all(len(page) == 3 for page in pages[:-1]))
+            self.assertEqual(sum(pages, []),
+                             self.expected_order(Actor, sort.lstrip('-'), sort.startswith('-')))
+
+    def test_get_movies_paginated_by_date(self):
+        """
+        This function tests paging through movies sorted by release date,
+        with ties and NULL dates.
+        """
+        Movie.insert_many([{'title': f'Paged {i}',
+                            'release_date': [datetime(2010, 7, 16), None, datetime(2001, 1, 1)][i % 3]}
+                           for i in range(7)])
+        for sort in ('release_date', '-release_date'):
+            pages = self.walk_pages(f'/movies?limit=2&sort={sort}')
+            self.assertEqual(len(pages), 5)
+            self.assertEqual(sum(pages, []),
+                             self.expected_order(Movie, 'release_date', sort.startswith('-')))
+
+    def test_get_movies_filtered(self):
+        """
+        This function tests filtering movies by release date and title prefix.
+        """
+        for query, titles in (('released_after=2000-01-01&title=Incep', ['Inception']),
+                              ('released_before=2000-01-01', ['Titanic']),
+                              ('released_before=2000-01-01&title=incep', [])):
+            res = self.client().get(f'/movies?{query}', headers=self.producer_headers)
+            data = json.loads(res.data)
+            self.assertEqual(res.status_code, 200)
+            self.assertEqual([movie['title'] for movie in data['movies']], titles)
+
+    def test_get_movies_sparse_fields(self):
+        """
+        This function tests requesting only some columns of the movies.
+        """
+        res = self.client().get('/movies?fields=id,title', headers=self.producer_headers)
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(all(set(movie) == {'id', 'title'} for movie in data['movies']))
+
+        res = self.client().get('/movies?fields=budget', headers=self.producer_headers)
+        self.assertEqual(res.status_code, 400)
+
+    def test_search(self):
+        """
+        This function tests searching actors and movies.
+        """
+        for query, results in (('q=leo', [('actor', 'Leonardo Dicaprio')]),
+                               ('q=incep', [('movie', 'Inception')]),
+                               ('q=titanic&type=actor', [])):
+            res = self.client().get(f'/search?{query}', headers=self.producer_headers)
+            data = json.loads(res.data)
+            self.assertEqual(res.status_code, 200)
+            self.assertEqual([(result['type'], result.get('name') or result.get('title'))
+                              for result in data['results']], results)
+
+        res = self.client().get('/search?q=leo&type=director', headers=self.producer_headers)
+        self.assertEqual(res.status_code, 400)
+
+    def test_400_search_negative_offset(self):
+        """
+        This function tests a search cursor with a negative offset is rejected.
+        """
+        cursor = encode_cursor('leo', None, -1)
+        res = self.client().get(f'/search?q=leo&cursor={cursor}', headers=self.producer_headers)
+        self.assertEqual(res.status_code, 400)
+        cursor = encode_cursor('leo', None, 0)
+        res = self.client().get(f'/search?q=leo&cursor={cursor}', headers=self.producer_headers)
+        self.assertEqual(res.status_code, 200)
+
+    def test_get_stats(self):
+        """
+        This function tests reading the actor and movie stats.
+        """
+        res = self.client().get('/stats', headers=self.producer_headers)
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(sum(data['stats']['actors']['by_gender'].values()),
+                         data['stats']['actors']['total'])
+
+    def test_400_get_actors_invalid_cursor(self):
+        """
+        This function tests requesting actors with a malformed cursor or filter.
+        """
+        res = self.client().get('/actors?cursor=invalid', headers=self.producer_headers)
+        self.assertEqual(res.status_code, 400)
+        res = self.client().get('/actors?min_age=old', headers=self.producer_headers)
+        self.assertEqual(res.status_code, 400)
+
+    def test_400_cursor_value_of_wrong_type(self):
+        """
+        This function tests a cursor whose sort value doesn't match the type
+        of the sort column is rejected.
+        """
+        for path, sort, value in (('/actors', 'age', 'old'), ('/actors', 'age', True),
+                                  ('/actors', 'name', 42), ('/movies', 'release_date', 'soon'),
+                                  ('/movies', 'release_date', 2010), ('/movies', 'title', [])):
+            cursor = encode_cursor(sort, value, 1)
+            res = self.client().get(f'{path}?sort={sort}&cursor={cursor}',
+                                    headers=self.producer_headers)
+            self.assertEqual(res.status_code, 400)
+        cursor = encode_cursor('age', 40, 1)
+        res = self.client().get(f'/actors?sort=age&cursor={cursor}', headers=self.producer_headers)
+        self.assertEqual(res.status_code, 200)
+
+    def test_export_actors_ndjson(self):
+        """
+        This function tests streaming all actors as NDJSON.
+        """
+        headers = dict(self.producer_headers, Accept='application/x-ndjson')
+        res = self.client().get('/actors/export', headers=headers)
+        lines = res.data.decode('utf-8').splitlines()
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.mimetype, 'application/x-ndjson')
+        self.assertTrue(all('name' in json.loads(line) for line in lines))
+
+    def test_export_movies_json(self):
+        """
+        This function tests streaming all movies as a JSON document.
+        """
+        res = self.client().get('/movies/export', headers=self.producer_headers)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(data['success'])
+        self.assertIn('movies', data)
+
+    def test_get_actors_after_update(self):
+        """
+        This function tests that a cached actors list reflects a later update.
+        """
+        self.client().get('/actors', headers=self.producer_headers)
+        self.client().patch("/actors/1", json=self.updated_actor, headers=self.producer_headers)
+        res = self.client().get('/actors', headers=self.producer_headers)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertIn(int(self.updated_actor['age']), [actor['age'] for actor in data['actors']])
+
+    def test_get_actors_after_update_by_another_worker(self):
+        """
+        This function tests that a cached actors list reflects an update
+        committed by another worker, whose write listeners don't run here.
+        """
+        self.client().get('/actors', headers=self.producer_headers)
+        db.session.execute(Actor.__table__.update().where(Actor.id == 1).values(age=99))
+        bump_version(Actor.__tablename__)
+        db.session.commit()
+        res = self.client().get('/actors', headers=self.producer_headers)
+        data = json.loads(res.data)
+
+        self.assertIn(99, [actor['age'] for actor in data['actors']])
+
+    def test_304_get_movies_not_modified(self):
+        """
+        This function tests revalidating the movies list with its ETag.
+        """
+        res = self.client().get('/movies', headers=self.producer_headers)
+        etag = res.headers['ETag']
+
+        headers = dict(self.producer_headers, **{'If-None-Match': etag})
+        res = self.client().get('/movies', headers=headers)
+        self.assertEqual(res.status_code, 304)
+        self.assertEqual(res.data, b'')
+
+        self.client().post("/movies", json=self.movie, headers=self.producer_headers)
+        res = self.client().get('/movies', headers=headers)
+        self.assertEqual(res.status_code, 200)
+        self.assertNotEqual(res.headers['ETag'], etag)
+
     def test_404_delete_unavailable_actor(self):
         """
         This function tests deleting an unavailable actor.
@@ -121,6 +336,33 @@ class CapstoneTestCase(unittest.TestCase):
     #     self.assertEqual(res.status_code, 200)
     #     self.assertTrue(data['success'])
 
+    def test_bulk_add_actors(self):
+        """
+        This function tests inserting many actors, one of them invalid.
+        """
+        actors = [self.actor, self.updated_actor, {'name': 'No Gender', 'age': 30}]
+        res = self.client().post("/actors/bulk", json=actors, headers=self.producer_headers)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertFalse(data['success'])
+        self.assertEqual(len(data['created']), 2)
+        self.assertEqual(data['errors'][0]['index'], 2)
+
+    def test_bulk_add_movies_ndjson(self):
+        """
+        This function tests inserting many movies sent as NDJSON.
+        """
+        lines = [json.dumps({'title': 'Inception', 'release_date': '2010-07-16'}),
+                 json.dumps({'title': 'Tenet', 'release_date': '2020-08-26'})]
+        headers = dict(self.producer_headers, **{'Content-Type': 'application/x-ndjson'})
+        res = self.client().post("/movies/bulk", data='\n'.join(lines), headers=headers)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(data['success'])
+        self.assertEqual(len(data['created']), 2)
+
     def test_400_add_actor(self):
         """
         This function tests inserting a actor with empty data.
@@ -193,6 +435,72 @@ class CapstoneTestCase(unittest.TestCase):
         self.assertTrue(data['success'])
         self.assertFalse(deleted_movie)
 
+    def test_batch_update_actors(self):
+        """
+        This function tests updating many actors and reporting missing ids.
+        """
+        res = self.client().patch("/actors/batch",
+                                  json={'ids': [1, 999], 'set': {'age': 48}},
+                                  headers=self.producer_headers)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(data['success'])
+        self.assertIn(999, data['missing'])
+
+    def test_400_batch_update_movies(self):
+        """
+        This function tests rejecting a batch with an invalid update.
+        """
+        res = self.client().patch("/movies/batch",
+                                  json=[{'id': 1, 'release_date': 'not a date'}],
+                                  headers=self.producer_headers)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 400)
+        self.assertFalse(data['success'])
+
+    def test_batch_delete_movies(self):
+        """
+        This function tests deleting many movies and reporting missing ids.
+        """
+        res = self.client().delete("/movies/batch", json={'ids': [998, 999]},
+                                   headers=self.producer_headers)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['deleted'], [])
+        self.assertEqual(data['missing'], [998, 999])
+
+    def test_cast_actor_in_movie(self):
+        """
+        This function tests casting an actor and listing movies with their cast.
+        """
+        res = self.client().post("/movies/2/actors", json={'actor_ids': [1, 999]},
+                                 headers=self.producer_headers)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['missing'], [999])
+
+        res = self.client().get('/movies?include=actors', headers=self.producer_headers)
+        data = json.loads(res.data)
+        movie = [movie for movie in data['movies'] if movie['id'] == 2][0]
+        self.assertIn(1, [actor['id'] for actor in movie['actors']])
+
+        res = self.client().delete("/movies/2/actors/1", headers=self.producer_headers)
+        self.assertEqual(res.status_code, 200)
+
+    def test_404_remove_uncast_actor(self):
+        """
+        This function tests removing an actor that isn't cast in the movie.
+        """
+        res = self.client().delete("/movies/2/actors/999", headers=self.producer_headers)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 404)
+        self.assertFalse(data['success'])
+
     def test_404_patch_actor(self):
         """
         This function tests updating a non-existing actor successfully.
@@ -235,6 +543,1400 @@ class CapstoneTestCase(unittest.TestCase):
         self.assertEqual(res.status_code, 403)
         self.assertEqual(data['message']['code'], 'unauthorized')
 
+
+class JWKSKeyStoreTestCase(unittest.TestCase):
+    """This class represents the JWKS key store test case"""
+
+    def setUp(self):
+        self.now = 0
+        self.jwks_file = tempfile.NamedTemporaryFile('w', suffix='.json', delete=False)
+        self.write_keys('key-1')
+        self.store = JWKSKeyStore(f'file://{self.jwks_file.name}', ttl=60,
+                                  refresh_margin=0, unknown_kid_cooldown=10,
+                                  clock=lambda: self.now)
+
+    def tearDown(self):
+        os.unlink(self.jwks_file.name)
+
+    def write_keys(self, *kids):
+        with open(self.jwks_file.name, 'w') as f:
+            json.dump({'keys': [{'kty': 'RSA', 'kid': kid, 'use': 'sig',
+                                 'n': 'n', 'e': 'AQAB'} for kid in kids]}, f)
+
+    def test_keys_are_cached_until_ttl(self):
+        """
+        This function tests that the key set is fetched once per ttl.
+        """
+        self.assertEqual(self.store.get_key('key-1')['kid'], 'key-1')
+        self.now = 30
+        self.store.get_key('key-1')
+        self.assertEqual(self.store.fetch_count, 1)
+
+        self.now = 61
+        self.store.get_key('key-1')
+        self.assertEqual(self.store.fetch_count, 2)
+
+    def test_unknown_kid_refetch_with_cooldown(self):
+        """
+        This function tests that a rotated key is picked up, and that unknown
+        kids don't refetch more than once per cooldown.
+        """
+        self.store.get_key('key-1')
+        self.write_keys('key-1', 'key-2')
+        self.now = 5
+        self.assertIsNone(self.store.get_key('key-2'))
+        self.assertEqual(self.store.fetch_count, 1)
+
+        self.now = 11
+        self.assertEqual(self.store.get_key('key-2')['kid'], 'key-2')
+        self.assertIsNone(self.store.get_key('bogus'))
+        self.assertEqual(self.store.fetch_count, 2)
+
+    def test_stale_keys_served_when_fetch_fails(self):
+        """
+        This function tests that cached keys survive a failed refresh.
+        """
+        self.store.get_key('key-1')
+        os.unlink(self.jwks_file.name)
+        self.now = 61
+        self.assertEqual(self.store.get_key('key-1')['kid'], 'key-1')
+        self.write_keys('key-1')
+
+    def test_fetch_failure_without_keys(self):
+        """
+        This function tests that an unreachable key set raises JWKSError.
+        """
+        store = JWKSKeyStore('file:///nonexistent/jwks.json')
+        with self.assertRaises(JWKSError):
+            store.get_key('key-1')
+
+    def test_concurrent_lookups_on_event_loop(self):
+        """
+        This function tests that lookups waiting on the first fetch from the
+        event loop share it.
+        """
+        async def lookup():
+            return await asyncio.gather(*[run_on_event_loop(self.store.get_key, 'key-1')
+                                          for _ in range(5)])
+
+        keys = asyncio.run(lookup())
+        self.assertEqual([key['kid'] for key in keys], ['key-1'] * 5)
+        self.assertEqual(self.store.fetch_count, 1)
+
+
+class VerifiedTokenCacheTestCase(unittest.TestCase):
+    """This class represents the verified token cache test case"""
+
+    def setUp(self):
+        self.now = 1000
+        self.cache = VerifiedTokenCache(maxsize=2, max_ttl=600,
+                                        clock=lambda: self.now)
+        self.payload = {'sub': 'user', 'exp': 1100,
+                        'permissions': ['get:actors', 'get:movies']}
+
+    def test_hit_until_exp(self):
+        """
+        This function tests that a cached token is served until its exp.
+        """
+        self.assertIsNone(self.cache.get('token'))
+        self.cache.put('token', self.payload)
+        entry = self.cache.get('token')
+        self.assertEqual(entry.payload, self.payload)
+        self.assertEqual(entry.permissions, frozenset(self.payload['permissions']))
+
+        self.now = 1100
+        self.assertIsNone(self.cache.get('token'))
+        self.assertEqual(self.cache.hits, 1)
+        self.assertEqual(self.cache.misses, 2)
+
+    def test_lru_eviction(self):
+        """
+        This function tests that the least recently used token is evicted.
+        """
+        self.cache.put('a', self.payload)
+        self.cache.put('b', self.payload)
+        self.cache.get('a')
+        self.cache.put('c', self.payload)
+
+        self.assertIsNone(self.cache.get('b'))
+        self.assertIsNotNone(self.cache.get('a'))
+        self.assertEqual(self.cache.evictions, 1)
+
+    def test_check_permissions_with_cached_set(self):
+        """
+        This function tests checking permissions against a cached entry.
+        """
+        entry = self.cache.put('token', self.payload)
+        self.assertTrue(check_permissions('get:actors', entry.payload, entry.permissions))
+        with self.assertRaises(AuthError) as ctx:
+            check_permissions('post:movies', entry.payload, entry.permissions)
+        self.assertEqual(ctx.exception.status_code, 403)
+
+        entry = self.cache.put('other', {'sub': 'user', 'exp': 1100})
+        with self.assertRaises(AuthError) as ctx:
+            check_permissions('get:actors', entry.payload, entry.permissions)
+        self.assertEqual(ctx.exception.status_code, 400)
+
+
+class ResponseCacheBackendTestCase(unittest.TestCase):
+    """This class represents the response cache backends test case"""
+
+    def test_memory_backend_lru(self):
+        """
+        This function tests that the memory backend evicts the oldest entry.
+        """
+        backend = MemoryCacheBackend(maxsize=2)
+        backend.set('a', b'1', 60)
+        backend.set('b', b'2', 60)
+        backend.get('a')
+        backend.set('c', b'3', 60)
+
+        self.assertEqual(backend.get('a'), b'1')
+        self.assertIsNone(backend.get('b'))
+
+    def test_sqlite_backend_shared_entries(self):
+        """
+        This function tests that two workers opening the same SQLite backend
+        see each other's entries.
+        """
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'cache.db')
+            worker_1 = SQLiteCacheBackend(path)
+            worker_2 = SQLiteCacheBackend(path)
+
+            worker_1.set('key', b'body', 60)
+            self.assertEqual(worker_2.get('key'), b'body')
+
+    def test_create_backend(self):
+        """
+        This function tests creating the backend a setting names.
+        """
+        backends = {'none': None, 'memory': MemoryCacheBackend, 'sqlite': SQLiteCacheBackend}
+        with tempfile.TemporaryDirectory() as directory:
+            backend = create_backend('RESPONSE_CACHE', f'sqlite:///{directory}/cache.db', backends)
+            self.assertEqual(backend.path, f'{directory}/cache.db')
+        self.assertIsInstance(create_backend('RESPONSE_CACHE', 'memory', backends),
+                              MemoryCacheBackend)
+        self.assertIsNone(create_backend('RESPONSE_CACHE', 'none', backends))
+        with self.assertRaisesRegex(ValueError, 'RESPONSE_CACHE'):
+            create_backend('RESPONSE_CACHE', 'redis://localhost', backends)
+
+
+class ForkedWorkerPoolTestCase(unittest.TestCase):
+    """This class represents the test case of the connections a forked
+    worker inherits from its parent, faking the worker's pid"""
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.engine = create_engine(f'sqlite:///{self.directory.name}/pool.db',
+                                    poolclass=InstrumentedQueuePool)
+        self.addCleanup(self.engine.dispose)
+        connection = self.engine.raw_connection()
+        self.inherited = connection.connection
+        connection.close()
+        parent = os.getpid()
+        self.fork = mock.patch.object(os, 'getpid', lambda: parent + 1)
+
+    def assertOpen(self, dbapi_connection):
+        self.assertEqual(dbapi_connection.execute('SELECT 1').fetchone(), (1,))
+
+    def test_checkout_leaves_parent_connection_open(self):
+        """
+        This function tests a worker checking out an inherited connection
+        gets a new one and leaves the parent's open.
+        """
+        with self.fork:
+            connection = self.engine.raw_connection()
+            self.assertIsNot(connection.connection, self.inherited)
+            connection.close()
+        self.assertOpen(self.inherited)
+
+    def test_replace_pool_leaves_parent_connection_open(self):
+        """
+        This function tests replacing the pool after a fork doesn't close
+        the connections of the old one.
+        """
+        pool = self.engine.pool
+        with self.fork:
+            replace_pool(self.engine)
+            self.assertIsNot(self.engine.pool, pool)
+            connection = self.engine.raw_connection()
+            self.assertIsNot(connection.connection, self.inherited)
+            connection.close()
+        self.assertOpen(self.inherited)
+
+
+class PoolOptionsTestCase(unittest.TestCase):
+    """This class represents the connection pool settings test case"""
+
+    def setUp(self):
+        self.config = dict(app.config, DB_POOL_SIZE=3, DB_MAX_OVERFLOW=2,
+                           DB_POOL_TIMEOUT=5, DB_POOL_RECYCLE=600,
+                           DB_POOL_PRE_PING=True, DB_STATEMENT_TIMEOUT=2000)
+
+    def test_postgres_pool_options(self):
+        """
+        This function tests the pool options built for Postgres.
+        """
+        self.config['SQLALCHEMY_DATABASE_URI'] = 'postgresql://localhost/capstone'
+        options = engine_options(self.config)
+
+        self.assertIs(options['poolclass'], InstrumentedQueuePool)
+        self.assertEqual(options['pool_size'], 3)
+        self.assertEqual(options['max_overflow'], 2)
+        self.assertTrue(options['pool_pre_ping'])
+        self.assertEqual(options['connect_args'], {'options': '-c statement_timeout=2000'})
+
+    def test_sqlite_pool_options(self):
+        """
+        This function tests that SQLite only gets pre-ping and recycle.
+        """
+        self.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///capstone.db'
+        options = engine_options(self.config)
+
+        self.assertEqual(options, {'pool_pre_ping': True, 'pool_recycle': 600})
+
+    def test_asyncpg_pool_options(self):
+        """
+        This function tests the pool options built for the async Postgres driver.
+        """
+        self.config['SQLALCHEMY_DATABASE_URI'] = 'postgresql+asyncpg://localhost/capstone'
+        options = engine_options(self.config)
+
+        self.assertIs(options['poolclass'], InstrumentedAsyncAdaptedQueuePool)
+        self.assertEqual(options['connect_args'],
+                         {'server_settings': {'statement_timeout': '2000'}})
+
+
+class QueryPlanTestCase(unittest.TestCase):
+    """This class checks the list filters are served by the indexes, using
+    EXPLAIN on a seeded database (SQLite unless DATABASE_PLAN_PATH is set)"""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.directory = tempfile.TemporaryDirectory()
+        database_path = os.environ.get('DATABASE_PLAN_PATH',
+                                       f'sqlite:///{cls.directory.name}/plans.db')
+        cls.app = create_app({'SQLALCHEMY_DATABASE_URI': database_path,
+                              'RESPONSE_CACHE': 'none'})
+        seed_size = int(os.environ.get('QUERY_PLAN_SEED_SIZE', 5000))
+        rng = random.Random(0)
+
+        with cls.app.app_context():
+            db.drop_all()
+            db.create_all()
+            Actor.insert_many([{'name': f'Name {i}',
+                                'age': rng.randint(1, 90) if i % 10 else None,
+                                'gender': rng.choice('MF')} for i in range(seed_size)])
+            Movie.insert_many([{'title': f'Title {i}',
+                                'release_date': datetime(rng.randint(1950, 2020), 1, 1)
+                                if i % 10 else None}
+                               for i in range(seed_size)])
+            with db.engine.connect() as connection:
+                connection.exec_driver_sql('ANALYZE')
+
+    @classmethod
+    def tearDownClass(cls):
+        with cls.app.app_context():
+            db.drop_all()
+        cls.directory.cleanup()
+
+    def explain(self, query):
+        """
+        Runs the query, capturing the SQL sent to the database, and returns
+        the plan of that SQL.
+        """
+        captured = []
+
+        def capture(conn, cursor, statement, parameters, context, executemany):
+            captured.append((statement, parameters))
+
+        event.listen(db.engine, 'before_cursor_execute', capture)
+        try:
+            query.all()
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', capture)
+
+        statement, parameters = captured[-1]
+        prefix = 'EXPLAIN ' if db.engine.dialect.name == 'postgresql' else 'EXPLAIN QUERY PLAN '
+        with db.engine.connect() as connection:
+            rows = connection.exec_driver_sql(prefix + statement, parameters)
+            return '\n'.join(str(row[-1]) for row in rows)
+
+    def plans(self, path):
+        model, filters = (Actor, filter_actors) if path.startswith('/actors') \
+            else (Movie, filter_movies)
+        with self.app.test_request_context(path):
+            queries, _, _ = page_queries(model, filters(model.query, request.args), request.args)
+            return [self.explain(query) for query in queries]
+
+    def assertUsesIndex(self, path, index):
+        for plan in self.plans(path):
+            self.assertIn(index, plan, plan)
+
+    def assertSortsByIndex(self, path, index):
+        for plan in self.plans(path):
+            self.assertIn(index, plan, plan)
+            self.assertNotIn('TEMP B-TREE', plan, plan)
+            self.assertNotIn('Sort', plan, plan)
+
+    def test_gender_age_filter_uses_index(self):
+        """
+        This function tests filtering actors by gender and age range.
+        """
+        self.assertUsesIndex('/actors?gender=F&min_age=30&max_age=32', 'ix_actor_gender_age')
+
+    def test_name_prefix_uses_index(self):
+        """
+        This function tests filtering actors by name prefix.
+        """
+        self.assertUsesIndex('/actors?name=name%20123', 'ix_actor_name_lower')
+
+    def test_release_date_range_uses_index(self):
+        """
+        This function tests filtering and sorting movies by release date.
+        """
+        self.assertUsesIndex('/movies?released_after=2001-01-01&released_before=2001-12-31',
+                             'ix_movie_release_date')
+        self.assertUsesIndex('/movies?released_after=2019-01-01&sort=release_date',
+                             'ix_movie_release_date')
+
+    def test_paginated_sorts_use_index_order(self):
+        """
+        This function tests every page of a sort, with the rows with a value
+        and those with NULLs, is read in the order of a (column, id) index.
+        """
+        for path, index, value in (('/movies?sort={}release_date', 'ix_movie_release_date_id',
+                                    datetime(2000, 1, 1)),
+                                   ('/movies?sort={}title', 'ix_movie_title_id', 'Title 500'),
+                                   ('/actors?sort={}age', 'ix_actor_age_id', 40),
+                                   ('/actors?sort={}name', 'ix_actor_name_id', 'Name 500')):
+            for direction in ('', '-'):
+                sort = path.split('=')[-1].format(direction)
+                path_with_sort = path.format(direction)
+                self.assertSortsByIndex(path_with_sort, index)
+                for cursor in (encode_cursor(sort, value, 2500), encode_cursor(sort, None, 2500)):
+                    self.assertSortsByIndex(f'{path_with_sort}&cursor={cursor}', index)
+
+    def test_title_prefix_uses_index(self):
+        """
+        This function tests filtering movies by title prefix.
+        """
+        self.assertUsesIndex('/movies?title=Title%20123', 'ix_movie_title_lower')
+
+class ReplicaRoutingTestCase(DatabaseTestCase):
+    """This class represents the read replica routing test case, with a
+    SQLite file standing in for the replica of the test database"""
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.directory = tempfile.TemporaryDirectory()
+        cls.replica_uri = f'sqlite:///{cls.directory.name}/replica.db'
+        engine = create_engine(cls.replica_uri)
+        db.Model.metadata.create_all(engine)
+        engine.execute(Actor.__table__.insert(), {'name': 'Replica', 'age': 30, 'gender': 'F'})
+        engine.dispose()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.directory.cleanup()
+
+    def setUp(self):
+        super().setUp()
+        self.configure(SQLALCHEMY_REPLICA_URIS=[self.replica_uri],
+                       SQLALCHEMY_BINDS=self.app.config['SQLALCHEMY_BINDS'],
+                       READ_YOUR_WRITES_WINDOW=60)
+        replica_router.init_app(self.app)
+        self.addCleanup(lambda: db.get_engine(self.app, bind='replica_0').dispose())
+
+    def read_names(self, method='GET', subject='user-1', marker=None):
+        headers = {MARKER_HEADER: marker} if marker else {}
+        with self.app.test_request_context('/actors', method=method, headers=headers):
+            _request_ctx_stack.top.current_user = {'sub': subject}
+            return [actor.name for actor in Actor.query.order_by(Actor.id)]
+
+    def write(self, subject):
+        """
+        Writes an actor as `subject` and returns the marker of the response
+        """
+        with self.app.test_request_context('/actors', method='POST'):
+            _request_ctx_stack.top.current_user = {'sub': subject}
+            Actor('Written', 40, 'M').insert()
+            response = self.app.process_response(Response())
+        self.assertIn(MARKER_COOKIE, response.headers['Set-Cookie'])
+        return response.headers[MARKER_HEADER]
+
+    def test_get_reads_replica(self):
+        """
+        This function tests that GET requests read from the replica and other
+        requests from the primary.
+        """
+        self.assertEqual(self.read_names(), ['Replica'])
+        self.assertEqual(self.read_names(method='POST'), ['Leonardo Dicaprio'])
+
+    def test_read_your_writes(self):
+        """
+        This function tests that a user sending back the marker of a write
+        reads from the primary, on any worker and without a query, while
+        other users keep reading from the replica.
+        """
+        marker = self.write('user-1')
+
+        statements = []
+        listener = lambda *args: statements.append(args[2])
+        event.listen(db.engine, 'before_cursor_execute', listener)
+        try:
+            names = self.read_names(subject='user-1', marker=marker)
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', listener)
+        self.assertEqual(names, ['Leonardo Dicaprio', 'Written'])
+        self.assertEqual(len(statements), 1)
+        self.assertEqual(self.read_names(subject='user-1'), ['Replica'])
+        self.assertEqual(self.read_names(subject='user-2', marker=marker), ['Replica'])
+
+    def test_read_your_writes_marker_checked(self):
+        """
+        This function tests that expired and tampered markers are ignored.
+        """
+        expired = replica_router.marker('user-1', time.time() - 61)
+        forged = URLSafeSerializer('other key', salt='read-your-writes')\
+            .dumps(['user-1', time.time()])
+
+        self.assertEqual(self.read_names(marker=expired), ['Replica'])
+        self.assertEqual(self.read_names(marker=forged), ['Replica'])
+        self.assertEqual(self.read_names(marker='garbage'), ['Replica'])
+
+    def test_read_your_writes_skips_response_cache(self):
+        """
+        This function tests that reads right after a write of the same user
+        neither use nor fill the response cache.
+        """
+        response_cache.backend = MemoryCacheBackend()
+        view = response_cache.cached(Actor.__tablename__)(
+            lambda: Response(b'{}', mimetype='application/json'))
+        marker = replica_router.marker('user-3', time.time())
+
+        for subject, cached in (('user-3', False), ('user-5', True)):
+            with self.app.test_request_context('/actors', headers={MARKER_HEADER: marker}):
+                _request_ctx_stack.top.current_user = {'sub': subject}
+                view()
+            self.assertEqual(bool(response_cache.backend._entries), cached)
+
+    def test_unhealthy_replica_falls_back_to_primary(self):
+        """
+        This function tests that reads go to the primary while the replica is
+        unreachable.
+        """
+        replica_router.replicas[0].bind_key = 'missing'
+        self.app.config['SQLALCHEMY_BINDS']['missing'] = \
+            f'sqlite:///{self.directory.name}/missing/replica.db'
+
+        self.assertEqual(self.read_names(), ['Leonardo Dicaprio'])
+        self.assertFalse(replica_router.replicas[0].healthy)
+
+    def test_dispose_engines_includes_replicas(self):
+        """
+        This function tests that a forked worker drops the pooled connections
+        of the replicas along with the primary's.
+        """
+        engines = [db.get_engine(self.app), db.get_engine(self.app, bind='replica_0')]
+        pools = [engine.pool for engine in engines]
+        dispose_engines(self.app, db)
+        for engine, pool in zip(engines, pools):
+            self.assertIsNot(engine.pool, pool)
+
+class SerializerTestCase(DatabaseTestCase):
+    """This class represents the fast path serializer test case"""
+
+    def setUp(self):
+        super().setUp()
+        self.ids = Movie.insert_many([
+            {'title': 'Caf\u00e9 "Noir"', 'release_date': datetime(2001, 2, 3, 4, 5, 6)},
+            {'title': 'Untitled', 'release_date': None}
+        ])
+
+    def test_rows_match_format(self):
+        """
+        This function tests that serializing column tuples gives the same
+        JSON as format() and jsonify.
+        """
+        serializer = get_serializer(Movie)
+        rows = serializer.query().order_by(Movie.id).all()
+        movies = Movie.query.order_by(Movie.id).all()
+        expected = json.loads(self.app.json_encoder().encode(
+            [movie.format() for movie in movies]))
+
+        self.assertEqual(json.loads(dumps(serializer.rows(rows))), expected)
+
+    def test_sparse_fields(self):
+        """
+        This function tests that only the requested fields are selected and
+        returned, plus the columns the cursor needs.
+        """
+        with self.app.test_request_context('/movies?fields=title&sort=release_date'):
+            fields = parse_fields(Movie, request.args)
+            serializer = get_serializer(Movie, fields, cursor_fields(Movie, request.args))
+            rows = serializer.query().filter(Movie.id.in_(self.ids)).order_by(Movie.id).all()
+
+            self.assertEqual(fields, ('title',))
+            self.assertEqual(serializer.selected, ('title', 'id', 'release_date'))
+            self.assertEqual(serializer.rows(rows), [{'title': 'Caf\u00e9 "Noir"'},
+                                                     {'title': 'Untitled'}])
+
+    def test_unknown_field(self):
+        """
+        This function tests that unknown fields are rejected.
+        """
+        with self.app.test_request_context('/movies?fields=title,budget'):
+            with self.assertRaises(BadRequest):
+                parse_fields(Movie, request.args)
+
+    def test_format_datetime(self):
+        """
+        This function tests that datetimes are formatted as HTTP dates.
+        """
+        self.assertEqual(format_datetime(datetime(2021, 4, 5, 6, 7, 8)),
+                         'Mon, 05 Apr 2021 06:07:08 GMT')
+        self.assertIsNone(format_datetime(None))
+
+class MemorySearchTestCase(DatabaseTestCase):
+    """This class represents the in-memory search engine test case, next to
+    the seeded 'Leonardo Dicaprio'"""
+
+    def setUp(self):
+        super().setUp()
+        search_index.engine = MemorySearchEngine()
+        self.leo, = Actor.insert_many([{'name': 'Leo', 'age': 30, 'gender': 'M'}])
+        self.departed, = Movie.insert_many([{'title': 'The Departed', 'release_date': None}])
+
+    def search(self, q, types=('actor', 'movie'), offset=0, limit=10):
+        return [(result['type'], result['id'])
+                for result in search_index.search(q, types, offset, limit)]
+
+    def test_prefix_search_ranks_whole_words_first(self):
+        """
+        This function tests that every query word must prefix a word and
+        that whole words rank first.
+        """
+        self.assertEqual(self.search('leo'), [('actor', self.leo), ('actor', 1)])
+        self.assertEqual(self.search('leo dic'), [('actor', 1)])
+        self.assertEqual(self.search('the depa', types=('movie',)), [('movie', self.departed)])
+        self.assertEqual(self.search('leo', offset=1, limit=1), [('actor', 1)])
+
+    def test_index_follows_writes(self):
+        """
+        This function tests that rows written after the index was built are
+        found.
+        """
+        self.assertEqual(self.search('leopold'), [])
+        actor = Actor('Leopold', 20, 'M')
+        actor.insert()
+        self.assertEqual(self.search('leopold'), [('actor', actor.id)])
+
+    def test_index_updated_incrementally(self):
+        """
+        This function tests that after the first search only the changed
+        rows are read again, and that updates and deletes are applied.
+        """
+        self.search('leo')
+        Actor.query.get(self.leo).update('Leon', 30, 'M')
+        Actor.query.get(1).delete()
+        Movie.update_many({self.departed: {'title': 'Leo Returns'}})
+
+        statements = []
+
+        def capture(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+
+        event.listen(db.engine, 'before_cursor_execute', capture)
+        try:
+            results = self.search('leo')
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', capture)
+
+        self.assertEqual(results, [('actor', self.leo), ('movie', self.departed)])
+        self.assertEqual(self.search('dicaprio'), [])
+        reads = [statement for statement in statements if 'FROM actor' in statement]
+        self.assertTrue(reads and all('IN' in statement for statement in reads), reads)
+
+class StatsCountersTestCase(DatabaseTestCase):
+    """This class represents the incrementally maintained stats test case,
+    starting from empty tables"""
+
+    def setUp(self):
+        super().setUp()
+        Actor.delete_many([actor.id for actor in Actor.query])
+        Movie.delete_many([movie.id for movie in Movie.query])
+
+    def test_counters_follow_writes(self):
+        """
+        This function tests that inserts, updates and deletes keep the
+        counters equal to a full recount.
+        """
+        a, b, c = Actor.insert_many([{'name': 'A', 'age': 34, 'gender': 'M'},
+                                     {'name': 'B', 'age': 7, 'gender': 'F'},
+                                     {'name': 'C', 'age': 38, 'gender': 'F'}])
+        movie = Movie('M', datetime(2021, 5, 1))
+        movie.insert()
+        Actor.query.get(a).update('A', 41, 'F')
+        Actor.update_many({b: {'age': 70}, c: {'name': 'D'}})
+        Actor.delete_many([c])
+        movie.delete()
+
+        stats = read_stats()
+        self.assertEqual(stats['actors'], {'total': 2, 'by_gender': {'F': 2},
+                                           'by_age': {'40-49': 1, '70-79': 1}})
+        self.assertEqual(stats['movies'], {'total': 0, 'by_release_year': {}})
+        rebuild_counters()
+        self.assertEqual(read_stats(), stats)
+
+    def test_counters_upserted_in_name_order(self):
+        """
+        This function tests that new and existing counters are written by one
+        upsert in name order, and that negative ages fall in the decade below.
+        """
+        actor, = Actor.insert_many([{'name': 'A', 'age': 34, 'gender': 'M'}])
+        statements = []
+
+        def capture(conn, cursor, statement, parameters, context, executemany):
+            if 'stat_counter' in statement:
+                statements.append(parameters)
+
+        event.listen(db.engine, 'before_cursor_execute', capture)
+        try:
+            Actor.query.get(actor).update('A', -5, 'F')
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', capture)
+
+        self.assertEqual(len(statements), 1)
+        names = [value for value in statements[0] if str(value).startswith('actor.')]
+        self.assertEqual(names, sorted(names))
+        self.assertEqual(read_stats()['actors']['by_age'], {'-10--1': 1})
+        rebuild_counters()
+        self.assertEqual(read_stats()['actors']['by_age'], {'-10--1': 1})
+
+class ProfilingTestCase(DatabaseTestCase):
+    """This class represents the request instrumentation test case"""
+
+    def setUp(self):
+        super().setUp()
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+        self.configure(METRICS_ENABLED=True, PROFILING_ENABLED=True,
+                       PROFILE_SAMPLE_RATE=1.0, PROFILE_DIR=self.directory)
+        profiler.init_app(self.app)
+        request_metrics.reset()
+
+    def test_server_timing_and_profile(self):
+        """
+        This function tests the Server-Timing header and the sampled profile.
+        """
+        res = self.client().get('/actors')
+
+        self.assertEqual(res.status_code, 401)
+        self.assertIn('auth;dur=', res.headers['Server-Timing'])
+        self.assertIn('total;dur=', res.headers['Server-Timing'])
+        self.assertTrue(os.path.exists(os.path.join(self.directory, res.headers['X-Profile'])))
+
+    def test_prometheus_metrics(self):
+        """
+        This function tests the latency histogram of the /metrics endpoint.
+        """
+        client = self.client()
+        client.get('/')
+        res = client.get('/metrics')
+        text = res.data.decode()
+
+        self.assertEqual(res.status_code, 200)
+        self.assertIn('http_request_duration_seconds_count{route="/",method="GET"} 1', text)
+        self.assertIn('http_request_duration_seconds_bucket{route="/",method="GET",le="+Inf"} 1',
+                      text)
+        self.assertIn('db_pool_checkouts_total', text)
+
+class LocalAuthProviderTestCase(unittest.TestCase):
+    """This class represents the local stand-in for Auth0 test case"""
+
+    def setUp(self):
+        self.provider = LocalAuthProvider().install()
+
+    def tearDown(self):
+        self.provider.uninstall()
+
+    def test_minted_token_is_verified(self):
+        """
+        This function tests that minted tokens pass verification with the
+        requested permissions.
+        """
+        payload = verify_decode_jwt(self.provider.token(['get:actors'], subject='tester'))
+
+        self.assertEqual(payload['sub'], 'tester')
+        self.assertEqual(payload['permissions'], ['get:actors'])
+
+    def test_expired_token(self):
+        """
+        This function tests that an expired minted token is rejected.
+        """
+        with self.assertRaises(AuthError) as error:
+            verify_decode_jwt(self.provider.token(expires_in=-60))
+        self.assertEqual(error.exception.status_code, 401)
+
+@unittest.skipUnless(importlib.util.find_spec('aiosqlite'), 'aiosqlite is not installed')
+class ASGITestCase(unittest.TestCase):
+    """This class represents the ASGI serving mode test case"""
+
+    @classmethod
+    def setUpClass(cls):
+        # The async driver commits on its own connections, so these requests
+        # can't run in the shared rolled-back test database; the schema of
+        # their database is still built once per class
+        cls.directory = tempfile.TemporaryDirectory()
+        cls.database_uri = f'sqlite:///{cls.directory.name}/asgi.db'
+        engine = create_engine(cls.database_uri)
+        db.Model.metadata.create_all(engine)
+        engine.dispose()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.directory.cleanup()
+
+    def setUp(self):
+        self.application = create_asgi_app({
+            'SQLALCHEMY_DATABASE_URI': self.database_uri,
+            'RESPONSE_CACHE': 'none'
+        })
+        self.provider = LocalAuthProvider().install()
+        self.headers = self.provider.headers()
+
+    def tearDown(self):
+        self.provider.uninstall()
+
+    def run_requests(self, *requests):
+        """
+        Sends the (method, url, body) requests concurrently and returns their
+        responses.
+        """
+        client = ASGITestClient(self.application)
+
+        async def run():
+            await self.application.startup()
+            responses = await asyncio.gather(*[
+                client.request(method, url, headers=self.headers, json=body)
+                for method, url, body in requests])
+            await run_on_event_loop(self.application.dispose_engines)
+            return responses
+
+        return asyncio.run(run())
+
+    def test_async_database_uri(self):
+        """
+        This function tests the mapping of database URLs to async drivers.
+        """
+        self.assertEqual(async_database_uri('postgresql://user@localhost/capstone'),
+                         'postgresql+asyncpg://user@localhost/capstone')
+        self.assertEqual(async_database_uri('sqlite:///capstone.db'),
+                         'sqlite+aiosqlite:///capstone.db')
+        self.assertEqual(self.application.app.config['SQLALCHEMY_DATABASE_URI'],
+                         f'sqlite+aiosqlite:///{self.directory.name}/asgi.db')
+
+    def test_concurrent_requests(self):
+        """
+        This function tests serving concurrent reads and writes through the
+        ASGI app, with the same authorization as the WSGI app.
+        """
+        actor = {'name': 'Leonardo Dicaprio', 'age': 47, 'gender': 'M'}
+        responses = self.run_requests(
+            ('POST', '/actors/bulk', [actor, actor]),
+            *[('GET', f'/actors?min_age={age}', None) for age in range(10)])
+
+        self.assertEqual(responses[0].status_code, 200)
+        self.assertEqual(len(responses[0].get_json()['created']), 2)
+        self.assertTrue(all(response.status_code == 200 for response in responses[1:]))
+
+        self.headers = self.provider.headers(['get:movies'])
+        response, = self.run_requests(('GET', '/actors', None))
+        self.assertEqual(response.status_code, 403)
+
+class ChangeFeedTestCase(DatabaseTestCase):
+    """This class represents the change feed test case"""
+
+    def changes(self, query='', headers=None):
+        res = self.client().get(f'/changes?{query}', headers=headers or self.producer_headers)
+        self.assertEqual(res.status_code, 200)
+        return res.get_json()
+
+    def test_changes_since(self):
+        """
+        This function tests reading the changes after a sequence number, in
+        order and with the current rows.
+        """
+        seeded = self.changes()
+        self.assertEqual([(change['type'], change['action']) for change in seeded['changes']],
+                         [('actor', 'insert'), ('movie', 'insert'), ('movie', 'insert')])
+
+        self.client().post('/actors', headers=self.producer_headers,
+                           json={'name': 'Kate Winslet', 'age': 46, 'gender': 'F'})
+        self.client().patch('/movies/1', headers=self.producer_headers,
+                            json={'title': 'Titanic 3D', 'release_date': '2012-04-04'})
+        self.client().delete('/actors/1', headers=self.producer_headers)
+
+        data = self.changes(f"since={seeded['next']}")
+        changes = data['changes']
+        self.assertEqual([(change['type'], change['id'], change['action']) for change in changes],
+                         [('actor', 2, 'insert'), ('movie', 1, 'update'), ('actor', 1, 'delete')])
+        self.assertEqual(changes[0]['data']['name'], 'Kate Winslet')
+        self.assertEqual(changes[1]['data']['title'], 'Titanic 3D')
+        self.assertIsNone(changes[2]['data'])
+        self.assertEqual(data['next'], changes[-1]['seq'])
+        self.assertEqual(self.changes(f"since={data['next']}&type=movie")['changes'], [])
+
+    def test_long_poll_times_out(self):
+        """
+        This function tests a long-poll without changes returns an empty
+        page after waiting.
+        """
+        since = self.changes()['next']
+        data = self.changes(f'since={since}&wait=0.05')
+        self.assertEqual(data['changes'], [])
+        self.assertEqual(data['next'], since)
+
+    def test_event_stream(self):
+        """
+        This function tests streaming the changes as Server-Sent Events,
+        resuming after Last-Event-ID.
+        """
+        self.configure(CHANGES_STREAM_MAX_AGE=0.01, CHANGES_POLL_INTERVAL=0.01)
+        headers = dict(self.producer_headers, **{'Accept': 'text/event-stream',
+                                                 'Last-Event-ID': '1'})
+        res = self.client().get('/changes', headers=headers)
+        self.assertEqual(res.mimetype, 'text/event-stream')
+        events = [event for event in res.get_data(as_text=True).split('\n\n')
+                  if event.startswith('id:')]
+        self.assertEqual([event.split('\n')[0] for event in events], ['id: 2', 'id: 3'])
+        self.assertEqual(json.loads(events[0].split('data: ')[1])['data']['title'], 'Titanic')
+
+    def test_rolled_back_writes_are_not_logged(self):
+        """
+        This function tests the changes of a rolled back transaction are
+        left out of the change log.
+        """
+        count = ChangeLog.query.count()
+        with self.assertRaises(RuntimeError):
+            with group_commit():
+                Actor('Kate Winslet', 46, 'F').insert()
+                raise RuntimeError
+        Actor.query.get(1).update('Leo', 47, 'M')
+        self.assertEqual(ChangeLog.query.count(), count + 1)
+
+    def test_deletes_log_cascaded_casting_changes(self):
+        """
+        This function tests deleting a row logs the rows it was cast with as
+        updated, one by one and in bulk.
+        """
+        kate, cameron = Actor.insert_many([{'name': 'Kate Winslet', 'age': 46, 'gender': 'F'},
+                                           {'name': 'James Cameron', 'age': 67, 'gender': 'M'}])
+        Movie.query.get(1).add_actors([1, kate, cameron])
+        Movie.query.get(2).add_actors([1, kate])
+        since = self.changes()['next']
+
+        Actor.query.get(1).delete()
+        Actor.delete_many([kate])
+        Movie.query.get(1).delete()
+
+        changes = self.changes(f'since={since}')['changes']
+        self.assertEqual([(change['type'], change['id'], change['action']) for change in changes],
+                         [('actor', 1, 'delete'), ('movie', 1, 'update'), ('movie', 2, 'update'),
+                          ('actor', kate, 'delete'), ('movie', 1, 'update'),
+                          ('movie', 2, 'update'), ('movie', 1, 'delete'),
+                          ('actor', cameron, 'update')])
+
+    def test_changes_wait_for_gaps(self):
+        """
+        This function tests the feed stops before a missing sequence number
+        until it is committed, or has been missing for CHANGES_GAP_TIMEOUT,
+        and that writes don't bump a shared change log version.
+        """
+        self.configure(CHANGES_GAP_TIMEOUT=60)
+        since = self.changes()['next']
+        Actor.query.get(1).update('Leo', 47, 'M')
+        self.assertIsNone(TableVersion.query.get(ChangeLog.__tablename__))
+
+        def log(seq, changed_at=None):
+            db.session.add(ChangeLog(seq=seq, model='actor', entity_id=1, action='update',
+                                     changed_at=changed_at or datetime.utcnow()))
+            db.session.commit()
+
+        log(since + 3)
+        data = self.changes(f'since={since}')
+        self.assertEqual([change['seq'] for change in data['changes']], [since + 1])
+        self.assertEqual(data['next'], since + 1)
+        log(since + 2)
+        data = self.changes(f"since={data['next']}")
+        self.assertEqual([change['seq'] for change in data['changes']], [since + 2, since + 3])
+
+        log(since + 5, datetime.utcnow() - timedelta(seconds=120))
+        data = self.changes(f"since={data['next']}&type=movie")
+        self.assertEqual(data['changes'], [])
+        self.assertEqual(data['next'], since + 5)
+
+    def test_400_non_finite_wait(self):
+        """
+        This function tests a long-poll wait of nan or inf is rejected.
+        """
+        for wait in ('nan', 'inf', '-inf'):
+            res = self.client().get(f'/changes?wait={wait}', headers=self.producer_headers)
+            self.assertEqual(res.status_code, 400)
+
+    def test_403_changes_without_permission(self):
+        """
+        This function tests reading movie changes requires get:movies.
+        """
+        headers = self.database.provider.headers(['get:actors'])
+        res = self.client().get('/changes?type=movie', headers=headers)
+        self.assertEqual(res.status_code, 403)
+        res = self.client().get('/changes?type=actor', headers=headers)
+        self.assertEqual(res.status_code, 200)
+
+
+class CompressionTestCase(DatabaseTestCase):
+    """This class represents the response compression and list encodings
+    test case"""
+
+    def setUp(self):
+        super().setUp()
+        Actor.insert_many([{'name': f'Actor {i}', 'age': 20 + i, 'gender': 'MF'[i % 2]}
+                           for i in range(50)])
+
+    def get(self, path, **headers):
+        return self.client().get(path, headers=dict(self.producer_headers, **headers))
+
+    def test_gzip_list(self):
+        """
+        This function tests large responses are gzipped when accepted, and
+        small ones are sent as they are.
+        """
+        plain = self.get('/actors')
+        self.assertNotIn('Content-Encoding', plain.headers)
+        res = self.get('/actors', **{'Accept-Encoding': 'gzip'})
+        self.assertEqual(res.headers['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', res.headers['Vary'])
+        self.assertLess(len(res.data), len(plain.data))
+        self.assertEqual(json.loads(gzip.decompress(res.data)), plain.get_json())
+
+        res = self.get('/movies', **{'Accept-Encoding': 'gzip'})
+        self.assertNotIn('Content-Encoding', res.headers)
+
+    @unittest.skipUnless(importlib.util.find_spec('brotli'), 'brotli is not installed')
+    def test_brotli_list(self):
+        """
+        This function tests brotli is preferred when the client accepts it.
+        """
+        import brotli
+        plain = self.get('/actors')
+        res = self.get('/actors', **{'Accept-Encoding': 'gzip, deflate, br'})
+        self.assertEqual(res.headers['Content-Encoding'], 'br')
+        self.assertEqual(json.loads(brotli.decompress(res.data)), plain.get_json())
+
+    def test_gzip_streamed_export(self):
+        """
+        This function tests exports are compressed as they are streamed.
+        """
+        plain = self.get('/actors/export')
+        res = self.get('/actors/export', **{'Accept-Encoding': 'gzip'})
+        self.assertEqual(res.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(json.loads(gzip.decompress(res.data)), plain.get_json())
+
+    def test_304_with_compressed_etag(self):
+        """
+        This function tests the ETag of a compressed response validates it,
+        and that the 304 carries the ETag of the variant the client holds.
+        """
+        res = self.get('/actors', **{'Accept-Encoding': 'gzip'})
+        etag = res.headers['ETag']
+        self.assertTrue(etag.endswith('-gzip"'))
+        res = self.get('/actors', **{'Accept-Encoding': 'gzip', 'If-None-Match': etag})
+        self.assertEqual(res.status_code, 304)
+        self.assertEqual(res.headers['ETag'], etag)
+
+        plain = self.get('/actors').headers['ETag']
+        res = self.get('/actors', **{'Accept-Encoding': 'gzip', 'If-None-Match': plain})
+        self.assertEqual(res.status_code, 304)
+        self.assertEqual(res.headers['ETag'], plain)
+
+    def test_columnar_list(self):
+        """
+        This function tests the columnar encoding holds the same page as
+        the JSON one, one array per field.
+        """
+        plain = self.get('/actors?limit=20').get_json()
+        res = self.get('/actors?limit=20', Accept=COLUMNAR_JSON_MIMETYPE)
+        self.assertEqual(res.mimetype, COLUMNAR_JSON_MIMETYPE)
+        data = res.get_json(force=True)
+        self.assertEqual(data['next'], plain['next'])
+        self.assertEqual(data['actors']['name'], [actor['name'] for actor in plain['actors']])
+        self.assertEqual(list(data['actors']), list(Actor.FIELDS))
+
+        self.assertEqual(self.get('/actors', Accept='*/*').mimetype, 'application/json')
+
+    @unittest.skipUnless(importlib.util.find_spec('msgpack'), 'msgpack is not installed')
+    def test_msgpack_list(self):
+        """
+        This function tests the MessagePack encoding of the list endpoints,
+        with and without related records.
+        """
+        import msgpack
+        for path in ('/movies', '/movies?include=actors'):
+            plain = self.get(path).get_json()
+            res = self.get(path, Accept=MSGPACK_MIMETYPE)
+            self.assertEqual(res.mimetype, MSGPACK_MIMETYPE)
+            self.assertEqual(msgpack.unpackb(res.data), plain)
+
+
+class RateLimitTestCase(DatabaseTestCase):
+    """This class represents the rate limits and admission control test case"""
+
+    def limit(self, **config):
+        self.configure(**config)
+        rate_limiter.init_app(self.app)
+
+    def get(self, path, headers=None):
+        return self.client().get(path, headers=headers or self.director_headers)
+
+    def test_429_over_subject_rate(self):
+        """
+        This function tests a subject over its rate gets 429 with
+        Retry-After, without slowing down other subjects.
+        """
+        self.limit(RATE_LIMIT=0.01, RATE_LIMIT_BURST=2)
+        self.assertEqual(self.get('/actors').status_code, 200)
+        self.assertEqual(self.get('/movies').status_code, 200)
+
+        res = self.get('/actors')
+        self.assertEqual(res.status_code, 429)
+        self.assertGreaterEqual(int(res.headers['Retry-After']), 1)
+        self.assertEqual(res.get_json()['error'], 429)
+        headers = self.database.provider.headers(subject='local|other')
+        self.assertEqual(self.get('/actors', headers).status_code, 200)
+
+    def test_429_before_database_work(self):
+        """
+        This function tests rejected requests don't query the database.
+        """
+        self.limit(RATE_LIMITS_PER_PERMISSION={'get:movies': '0.01/1'})
+        self.assertEqual(self.get('/movies').status_code, 200)
+
+        statements = []
+        listener = lambda *args: statements.append(args[2])
+        event.listen(db.engine, 'before_cursor_execute', listener)
+        try:
+            res = self.get('/movies')
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', listener)
+        self.assertEqual(res.status_code, 429)
+        self.assertEqual(statements, [])
+        self.assertEqual(self.get('/actors').status_code, 200)
+
+    def test_429_over_concurrency_cap(self):
+        """
+        This function tests the cap on the requests of a subject in flight.
+        """
+        self.limit(MAX_CONCURRENT_REQUESTS=1)
+        slot = rate_limiter.backend.acquire('in_flight:local|user', 1)
+        self.assertEqual(self.get('/actors').status_code, 429)
+        rate_limiter.backend.release('in_flight:local|user', slot)
+        self.assertEqual(self.get('/actors').status_code, 200)
+        self.assertEqual(self.get('/actors').status_code, 200)
+
+    def test_streamed_response_holds_slot(self):
+        """
+        This function tests a streamed export stays in flight until its body
+        has been sent.
+        """
+        self.limit(MAX_CONCURRENT_REQUESTS=1)
+        res = self.client().get('/actors/export', headers=self.director_headers,
+                                buffered=False)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(self.get('/movies').status_code, 429)
+        res.get_data()
+        res.close()
+        self.assertEqual(self.get('/movies').status_code, 200)
+
+    def test_429_over_waiting_cap(self):
+        """
+        This function tests the cap on the event streams and long-polls of a
+        subject, which leaves requests that don't wait alone.
+        """
+        self.limit(CHANGES_MAX_WAITING_PER_USER=1)
+        stream = dict(self.director_headers, Accept='text/event-stream')
+        res = self.client().get('/changes', headers=stream, buffered=False)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(self.get('/changes', stream).status_code, 429)
+        self.assertEqual(self.get('/changes?wait=1').status_code, 429)
+        self.assertEqual(self.get('/changes').status_code, 200)
+        headers = self.database.provider.headers(subject='local|other')
+        self.assertEqual(self.get('/changes?wait=0.1', headers).status_code, 200)
+        res.close()
+        self.assertEqual(self.get('/changes?wait=0.1').status_code, 200)
+
+    def test_sqlite_backend_shared_buckets(self):
+        """
+        This function tests the SQLite backend shares buckets and slots
+        between processes.
+        """
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'limits.db')
+            first, second = SQLiteRateLimitBackend(path), SQLiteRateLimitBackend(path)
+            self.assertEqual(first.take('sub:a', 0.01, 1), 0)
+            self.assertGreater(second.take('sub:a', 0.01, 1), 0)
+            slot = first.acquire('in_flight:a', 1)
+            self.assertIsNone(second.acquire('in_flight:a', 1))
+            first.release('in_flight:a', slot)
+            self.assertIsNotNone(second.acquire('in_flight:a', 1))
+
+
+class IdempotencyTestCase(DatabaseTestCase):
+    """This class represents the Idempotency-Key test case"""
+
+    actor = {'name': 'Kate Winslet', 'age': 46, 'gender': 'F'}
+
+    def post_actor(self, key, actor=None, headers=None):
+        headers = dict(headers or self.producer_headers, **{'Idempotency-Key': key})
+        return self.client().post('/actors', headers=headers, json=actor or self.actor)
+
+    def count_actors(self):
+        return Actor.query.filter_by(name='Kate Winslet').count()
+
+    def test_retry_replays_response(self, backend=None):
+        """
+        This function tests a retried write returns the first response
+        without writing again.
+        """
+        if backend is not None:
+            idempotency.backend = backend
+        first = self.post_actor('retry-1')
+        self.assertEqual(first.status_code, 200)
+
+        statements = []
+        listener = lambda *args: statements.append(args[2])
+        event.listen(db.engine, 'before_cursor_execute', listener)
+        try:
+            retry = self.post_actor('retry-1')
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', listener)
+
+        self.assertEqual(retry.status_code, 200)
+        self.assertEqual(retry.headers['Idempotent-Replayed'], 'true')
+        self.assertEqual(retry.get_json(), first.get_json())
+        self.assertFalse(any('actor' in statement for statement in statements))
+        self.assertEqual(self.count_actors(), 1)
+
+    def test_retry_replays_response_from_database(self):
+        """
+        This function tests replaying responses stored in the database.
+        """
+        self.test_retry_replays_response(DatabaseIdempotencyBackend())
+
+    def test_key_is_scoped_to_subject(self):
+        """
+        This function tests another user's key doesn't replay responses.
+        """
+        self.post_actor('shared')
+        headers = dict(self.database.provider.headers(subject='local|other'),
+                       **{'Content-Type': 'application/json'})
+        res = self.post_actor('shared', headers=headers)
+        self.assertNotIn('Idempotent-Replayed', res.headers)
+        self.assertEqual(self.count_actors(), 2)
+
+    def test_422_key_reused_for_other_request(self):
+        """
+        This function tests a key can't be reused for a different body.
+        """
+        self.post_actor('reused')
+        res = self.post_actor('reused', dict(self.actor, age=47))
+        self.assertEqual(res.status_code, 422)
+        self.assertEqual(self.count_actors(), 1)
+
+    def test_retry_replays_client_error(self):
+        """
+        This function tests a 4xx is replayed whether the view returned it
+        or raised it with abort().
+        """
+        error = {'success': False, 'error': 400, 'message': 'bad request'}
+        views = {
+            'returned': lambda payload: (jsonify(error), 400),
+            'raised': lambda payload: abort(400)
+        }
+        for name, view in views.items():
+            view = idempotency.idempotent(view)
+            responses = []
+            for _ in range(2):
+                with self.app.test_request_context('/actors', method='POST', json=self.actor,
+                                                   headers={'Idempotency-Key': name}):
+                    responses.append(view({'sub': 'local|user'}))
+            first, retry = responses
+            self.assertEqual(first.status_code, 400)
+            self.assertEqual(retry.status_code, 400)
+            self.assertEqual(retry.headers['Idempotent-Replayed'], 'true')
+            self.assertEqual(retry.get_json(), first.get_json())
+
+        first = self.post_actor('invalid', {'name': 'Kate Winslet'})
+        retry = self.post_actor('invalid', {'name': 'Kate Winslet'})
+        self.assertEqual(first.status_code, 400)
+        self.assertEqual(retry.headers['Idempotent-Replayed'], 'true')
+
+    def test_database_backend_reservations(self):
+        """
+        This function tests the database backend reserves keys, reports them
+        in progress and replays completed ones.
+        """
+        backend = DatabaseIdempotencyBackend()
+        self.assertIsNone(backend.reserve('key', 'fingerprint'))
+        self.assertIsNone(backend.reserve('key', 'fingerprint')['status'])
+        backend.complete('key', {'status': 201, 'headers': [('Content-Type', 'application/json')],
+                                 'body': b'{}'}, 60)
+        record = backend.reserve('key', 'fingerprint')
+        self.assertEqual((record['status'], record['body']), (201, b'{}'))
+        backend.release('key')
+        self.assertIsNone(backend.reserve('key', 'fingerprint'))
+
+
+class WriteBehindTestCase(DatabaseTestCase):
+    """This class represents the write-behind mode test case, applying the
+    journal from the test instead of the background worker"""
+
+    def setUp(self):
+        super().setUp()
+        self.configure(WRITE_BEHIND_ENABLED=True, WRITE_BEHIND_WORKER=False)
+        self.producer_headers['Prefer'] = 'respond-async'
+
+    def operation(self, operation_id, headers=None):
+        res = self.client().get(f'/operations/{operation_id}',
+                                headers=headers or self.producer_headers)
+        return res.status_code, res.get_json().get('operation')
+
+    def test_writes_are_applied_in_order(self):
+        """
+        This function tests accepting writes with 202 and applying them in
+        the order they were accepted.
+        """
+        res = self.client().post('/actors', headers=self.producer_headers,
+                                 json={'name': 'Kate Winslet', 'age': 46, 'gender': 'F'})
+        self.assertEqual(res.status_code, 202)
+        created = res.get_json()['operation']
+        self.assertTrue(res.headers['Location'].endswith(f'/operations/{created}'))
+        self.assertEqual(self.operation(created)[1]['status'], 'pending')
+
+        res = self.client().delete('/movies/2', headers=self.producer_headers)
+        deleted = res.get_json()['operation']
+        res = self.client().patch('/movies/2', headers=self.producer_headers,
+                                  json={'title': 'Inception', 'release_date': '2010-07-16'})
+        self.assertEqual(res.status_code, 202)
+        updated = res.get_json()['operation']
+        self.assertEqual(Movie.query.get(2).title, 'Inception')
+
+        self.assertEqual(write_behind.apply_pending(), 3)
+        self.assertEqual(write_behind.apply_pending(), 0)
+
+        status, operation = self.operation(created)
+        self.assertEqual(operation['status'], 'applied')
+        self.assertEqual(Actor.query.get(operation['result']['id']).name, 'Kate Winslet')
+        self.assertEqual(self.operation(deleted)[1]['status'], 'applied')
+        self.assertIsNone(Movie.query.get(2))
+        status, operation = self.operation(updated)
+        self.assertEqual(operation['status'], 'failed')
+        self.assertEqual(operation['result']['error'], 404)
+
+    def test_group_commit(self):
+        """
+        This function tests a batch of writes is committed once, bumping the
+        version of the table once.
+        """
+        version = TableVersion.query.get(Actor.__tablename__).version
+        for age in range(5):
+            res = self.client().post('/actors', headers=self.producer_headers,
+                                     json={'name': 'Kate Winslet', 'age': age, 'gender': 'F'})
+            self.assertEqual(res.status_code, 202)
+
+        self.assertEqual(write_behind.apply_pending(limit=10), 5)
+        db.session.expire_all()
+        self.assertEqual(TableVersion.query.get(Actor.__tablename__).version, version + 1)
+        self.assertEqual(Actor.query.filter_by(name='Kate Winslet').count(), 5)
+
+    def test_failing_operation_is_retried_then_failed(self):
+        """
+        This function tests an operation that keeps failing holds back the
+        later ones on the same entity, but not the others, until it is
+        marked failed after the last attempt.
+        """
+        self.configure(WRITE_BEHIND_MAX_ATTEMPTS=2)
+        db.session.add(WriteOperation(id='broken', subject='local|user', model='actor',
+                                      action='update', entity_id=1, payload='{',
+                                      status='pending'))
+        db.session.commit()
+        res = self.client().delete('/actors/1', headers=self.producer_headers)
+        deleted = res.get_json()['operation']
+        res = self.client().post('/actors', headers=self.producer_headers,
+                                 json={'name': 'Kate Winslet', 'age': 46, 'gender': 'F'})
+        created = res.get_json()['operation']
+        res = self.client().delete('/movies/2', headers=self.producer_headers)
+        movie_deleted = res.get_json()['operation']
+
+        self.assertEqual(write_behind.apply_pending(), 2)
+        self.assertEqual(self.operation(deleted)[1]['status'], 'pending')
+        self.assertIsNotNone(Actor.query.get(1))
+        self.assertEqual(self.operation(created)[1]['status'], 'applied')
+        self.assertEqual(self.operation(movie_deleted)[1]['status'], 'applied')
+        self.assertIsNone(Movie.query.get(2))
+
+        self.assertEqual(write_behind.apply_pending(), 2)
+        broken = WriteOperation.query.filter_by(id='broken').one()
+        self.assertEqual((broken.status, broken.attempts), ('failed', 2))
+        self.assertEqual(json.loads(broken.result)['error'], 500)
+        self.assertEqual(self.operation(deleted)[1]['status'], 'applied')
+        self.assertIsNone(Actor.query.get(1))
+
+    def test_failed_group_commit_is_rolled_back(self):
+        """
+        This function tests the session is usable again after the commit at
+        the end of a group commit failed.
+        """
+        with self.assertRaises(IntegrityError):
+            with group_commit():
+                Actor('Kate Winslet', 46, 'F').insert()
+                db.session.add(TableVersion(name=Movie.__tablename__, version=0))
+        self.assertEqual(Actor.query.count(), 1)
+
+    def test_400_invalid_write(self):
+        """
+        This function tests writes are validated before being accepted.
+        """
+        res = self.client().post('/actors', headers=self.producer_headers,
+                                 json={'name': 'Kate Winslet', 'age': 'old'})
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(write_behind.apply_pending(), 0)
+
+    def test_404_operation_of_other_subject(self):
+        """
+        This function tests an operation is only reported to its submitter.
+        """
+        res = self.client().delete('/actors/1', headers=self.producer_headers)
+        operation_id = res.get_json()['operation']
+        headers = self.database.provider.headers(subject='local|other')
+        self.assertEqual(self.operation(operation_id, headers)[0], 404)
+
+    def test_synchronous_without_preference(self):
+        """
+        This function tests writes without "Prefer: respond-async" are
+        applied right away.
+        """
+        del self.producer_headers['Prefer']
+        res = self.client().delete('/actors/1', headers=self.producer_headers)
+        self.assertEqual(res.status_code, 200)
+        self.assertIsNone(Actor.query.get(1))
+
+
 # Make the tests conveniently executable
 if __name__ == "__main__":
     unittest.main()
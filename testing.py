@@ -0,0 +1,290 @@
+import atexit
+import json
+import os
+import tempfile
+import unittest
+from datetime import datetime
+
+from sqlalchemy import create_engine, event, text
+from sqlalchemy.engine.url import make_url
+
+from app import create_app
+from auth.local import ALL_PERMISSIONS, LocalAuthProvider
+from cache import response_cache
+from changes import change_feed
+from concurrency import wait
+from idempotency import idempotency
+from ratelimit import rate_limiter
+from models import db, Actor, Movie
+from profiling import profiler
+from routing import replica_router
+from search import search_index
+from serializer import dumps
+from writebehind import write_behind
+
+'''
+Test fixtures. The schema is built and seeded once per test process; every
+test then runs inside a transaction that is rolled back when it ends, and
+tokens are minted by a local stand-in for Auth0. Under pytest-xdist each
+worker uses its own database, so the suite can run in parallel:
+
+    pytest -n 4 test_app.py
+'''
+
+DIRECTOR_PERMISSIONS = (
+    'get:actors', 'post:actors', 'patch:actors', 'delete:actors',
+    'get:movies', 'patch:movies'
+)
+PRODUCER_PERMISSIONS = ALL_PERMISSIONS
+
+# Rows every test starts with, with ids 1, 2, ... in order
+SEED_ACTORS = [
+    {'name': 'Leonardo Dicaprio', 'age': 47, 'gender': 'M'}
+]
+SEED_MOVIES = [
+    {'title': 'Titanic', 'release_date': datetime(1997, 12, 19)},
+    {'title': 'Inception', 'release_date': datetime(2010, 7, 16)}
+]
+
+
+def worker_id():
+    '''
+    Name of the pytest-xdist worker running the tests, or "main"
+    '''
+    return os.environ.get('PYTEST_XDIST_WORKER', 'main')
+
+
+def worker_database_url(url, worker):
+    '''
+    Suffixes the database name of `url` with the worker name, so parallel
+    workers never share a database
+    '''
+    url = make_url(url)
+    if worker == 'main' or not url.database or url.database == ':memory:':
+        return url
+    if url.get_backend_name() == 'sqlite':
+        root, extension = os.path.splitext(url.database)
+        return url.set(database=f'{root}_{worker}{extension}')
+    return url.set(database=f'{url.database}_{worker}')
+
+
+def create_database(url):
+    '''
+    Creates the Postgres database of `url` if it doesn't exist yet. SQLite
+    creates its files on first use.
+    '''
+    if url.get_backend_name() != 'postgresql':
+        return
+    engine = create_engine(url.set(database='postgres'), isolation_level='AUTOCOMMIT')
+    try:
+        with engine.connect() as connection:
+            exists = connection.execute(text('SELECT 1 FROM pg_database WHERE datname = :name'),
+                                        {'name': url.database}).scalar()
+            if not exists:
+                connection.execute(text(f'CREATE DATABASE "{url.database}"'))
+    finally:
+        engine.dispose()
+
+
+def enable_sqlite_savepoints(engine):
+    '''
+    pysqlite manages transactions itself and breaks SAVEPOINT; hand them
+    back to SQLAlchemy
+    '''
+    @event.listens_for(engine, 'connect')
+    def on_connect(dbapi_connection, connection_record):
+        dbapi_connection.isolation_level = None
+
+    @event.listens_for(engine, 'begin')
+    def on_begin(connection):
+        connection.exec_driver_sql('BEGIN')
+
+
+class TestDatabase:
+    '''
+    App and database shared by the tests of one process. setup() builds the
+    schema and seeds it once; begin() and end() wrap a test in a transaction
+    and a savepoint, restarted whenever the code under test commits or rolls
+    back, so nothing a test writes outlives it.
+    '''
+
+    def __init__(self, url=None, config=None):
+        self.directory = None
+        if url is None:
+            self.directory = tempfile.TemporaryDirectory()
+            url = f'sqlite:///{self.directory.name}/test.db'
+        self.url = worker_database_url(url, worker_id())
+        # Rolled back tests leave gaps in the Postgres change log sequence,
+        # which the change feed need not wait for
+        self.config = dict({'CHANGES_GAP_TIMEOUT': 0}, **(config or {}),
+                           SQLALCHEMY_DATABASE_URI=str(self.url), TESTING=True)
+        self.app = None
+        self.provider = None
+
+    def setup(self):
+        create_database(self.url)
+        self.app = create_app(self.config)
+        self.provider = LocalAuthProvider()
+        with self.app.app_context():
+            if self.url.get_backend_name() == 'sqlite':
+                enable_sqlite_savepoints(db.engine)
+            db.drop_all()
+            db.create_all()
+            Actor.insert_many(SEED_ACTORS)
+            Movie.insert_many(SEED_MOVIES)
+        return self
+
+    def begin(self):
+        # State kept by the extensions outside the database would outlive the
+        # rollback, and other tests may have re-initialized them for their app
+        replica_router.init_app(self.app)
+        response_cache.init_app(self.app)
+        search_index.init_app(self.app)
+        idempotency.init_app(self.app)
+        rate_limiter.init_app(self.app)
+        write_behind.init_app(self.app)
+        profiler.init_app(self.app)
+        change_feed.init_app(self.app)
+        self.provider.install()
+
+        self.context = self.app.app_context()
+        self.context.push()
+        self.connection = db.engine.connect()
+        self.transaction = self.connection.begin()
+        self.savepoint = self.connection.begin_nested()
+        self.session, db.session = db.session, db.create_scoped_session(
+            {'bind': self.connection, 'binds': {}})
+
+        @event.listens_for(db.session.session_factory, 'after_transaction_end')
+        def restart_savepoint(session, transaction):
+            if not self.savepoint.is_active:
+                self.savepoint = self.connection.begin_nested()
+
+    def end(self):
+        db.session.remove()
+        db.session = self.session
+        self.transaction.rollback()
+        self.connection.close()
+        self.context.pop()
+        self.provider.uninstall()
+
+    def teardown(self):
+        if self.app is not None:
+            with self.app.app_context():
+                db.engine.dispose()
+        if self.directory is not None:
+            self.directory.cleanup()
+
+
+_test_database = None
+
+
+def get_test_database():
+    '''
+    Returns the process-wide test database, set up on first use from
+    DATABASE_TEST_PATH, or a temporary SQLite file when it isn't set
+    '''
+    global _test_database
+    if _test_database is None:
+        _test_database = TestDatabase(os.environ.get('DATABASE_TEST_PATH')).setup()
+        atexit.register(_test_database.teardown)
+    return _test_database
+
+
+class DatabaseTestCase(unittest.TestCase):
+    '''
+    Test case running each test in a rolled back transaction on the seeded
+    test database, with `client` and producer and director `headers`
+    '''
+
+    @classmethod
+    def setUpClass(cls):
+        cls.database = get_test_database()
+        cls.app = cls.database.app
+
+    def setUp(self):
+        self.database.begin()
+        self.addCleanup(self.database.end)
+        self.client = self.app.test_client
+        self.producer_headers = dict(self.database.provider.headers(PRODUCER_PERMISSIONS),
+                                     **{'Content-Type': 'application/json'})
+        self.director_headers = dict(self.database.provider.headers(DIRECTOR_PERMISSIONS),
+                                     **{'Content-Type': 'application/json'})
+
+    def configure(self, **config):
+        '''
+        Updates the app's config for the current test only. Extensions
+        reading it are initialized again by the next test's begin().
+        '''
+        saved = {key: self.app.config[key] for key in config}
+        self.app.config.update(config)
+        self.addCleanup(self.app.config.update, saved)
+
+
+class ASGIResponse:
+
+    def __init__(self, status_code, headers, data):
+        self.status_code = status_code
+        self.headers = headers
+        self.data = data
+
+    def get_json(self):
+        return json.loads(self.data)
+
+
+class ASGITestClient:
+    '''
+    Client calling an ASGI app directly. request() is a coroutine; get(),
+    post(), patch() and delete() mirror Flask's test client for code running
+    under concurrency.run_on_event_loop, such as the benchmark scenarios.
+    '''
+
+    def __init__(self, app):
+        self.app = app
+
+    async def request(self, method, url, headers=None, json=None, data=None):
+        headers = dict(headers or {})
+        if json is not None:
+            data = dumps(json)
+            headers.setdefault('Content-Type', 'application/json')
+        body = data.encode('utf-8') if isinstance(data, str) else data or b''
+        path, _, query_string = url.partition('?')
+        scope = {
+            'type': 'http', 'http_version': '1.1', 'method': method, 'scheme': 'http',
+            'path': path, 'root_path': '', 'query_string': query_string.encode('latin-1'),
+            'headers': [(name.lower().encode('latin-1'), str(value).encode('latin-1'))
+                        for name, value in headers.items()],
+            'client': ('127.0.0.1', 0), 'server': ('localhost', 80)
+        }
+        messages = [{'type': 'http.request', 'body': body, 'more_body': False}]
+        sent = []
+
+        async def receive():
+            if messages:
+                return messages.pop()
+            return {'type': 'http.disconnect'}
+
+        async def send(message):
+            sent.append(message)
+
+        await self.app(scope, receive, send)
+        start = sent[0]
+        return ASGIResponse(start['status'],
+                            {name.decode('latin-1'): value.decode('latin-1')
+                             for name, value in start['headers']},
+                            b''.join(message.get('body', b'') for message in sent[1:]))
+
+    def open(self, method, url, **kwargs):
+        return wait(self.request(method, url, **kwargs))
+
+    def get(self, url, **kwargs):
+        return self.open('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.open('POST', url, **kwargs)
+
+    def patch(self, url, **kwargs):
+        return self.open('PATCH', url, **kwargs)
+
+    def delete(self, url, **kwargs):
+        return self.open('DELETE', url, **kwargs)
@@ -0,0 +1,91 @@
+from datetime import datetime
+from email.utils import parsedate_to_datetime
+
+'''
+Validation of actor and movie request bodies. Each validator returns the
+column values to write, or raises ValueError describing the first problem.
+'''
+
+
+def parse_release_date(value):
+    '''
+    Accepts ISO 8601 dates as well as the RFC 1123 format the API returns,
+    e.g. "Sat, 01 May 2021 12:35:19 GMT"
+    '''
+    if isinstance(value, datetime):
+        return value
+    if not isinstance(value, str):
+        raise ValueError('release_date must be a date string')
+    try:
+        return datetime.fromisoformat(value)
+    except ValueError:
+        pass
+    try:
+        return parsedate_to_datetime(value).replace(tzinfo=None)
+    except (TypeError, ValueError):
+        raise ValueError(f'invalid release_date: {value}')
+
+
+def validate_name(value, field):
+    if not isinstance(value, str) or not value.strip():
+        raise ValueError(f'{field} must be a non-empty string')
+    if len(value) > 120:
+        raise ValueError(f'{field} must be at most 120 characters')
+    return value
+
+
+def validate_age(value):
+    if isinstance(value, bool):
+        raise ValueError('age must be an integer')
+    try:
+        age = int(value)
+    except (TypeError, ValueError):
+        raise ValueError('age must be an integer')
+    if age < 0:
+        raise ValueError('age must not be negative')
+    return age
+
+
+def validate_gender(value):
+    if value not in ('M', 'F'):
+        raise ValueError('gender must be "M" or "F"')
+    return value
+
+
+ACTOR_VALIDATORS = {
+    'name': lambda value: validate_name(value, 'name'),
+    'age': validate_age,
+    'gender': validate_gender
+}
+
+MOVIE_VALIDATORS = {
+    'title': lambda value: validate_name(value, 'title'),
+    'release_date': parse_release_date
+}
+
+
+def validate(validators, data, partial=False):
+    if not isinstance(data, dict):
+        raise ValueError('expected a JSON object')
+    values = {}
+    for field, validator in validators.items():
+        if field not in data:
+            if partial:
+                continue
+            raise ValueError(f'{field} is required')
+        values[field] = validator(data[field])
+    return values
+
+
+def validate_actor(data, partial=False):
+    '''
+    Validates an actor body. With partial=True, missing fields are skipped
+    '''
+    return validate(ACTOR_VALIDATORS, data, partial)
+
+
+def validate_movie(data, partial=False):
+    '''
+    Validates a movie body. With partial=True, missing fields are skipped
+    '''
+    return validate(MOVIE_VALIDATORS, data, partial)
@@ -0,0 +1,280 @@
+import json
+import os
+import threading
+import uuid
+from datetime import datetime
+
+from flask import current_app, request
+
+from concurrency import IOEvent, spawn
+from models import db, group_commit, Actor, Movie, WriteOperation
+from routing import replica_router
+from validation import validate_actor, validate_movie
+
+'''
+Write-behind mode of the single actor and movie writes. When enabled through
+WRITE_BEHIND_ENABLED, a write sent with "Prefer: respond-async" is validated,
+journaled in write_operation and answered with 202 and the operation id; a
+background worker then applies the journaled writes in group commits of up to
+WRITE_BEHIND_BATCH_SIZE operations, waiting at most WRITE_BEHIND_MAX_DELAY
+milliseconds for a batch to fill. GET /operations/<id> reports the outcome.
+
+Operations are applied in the order they were accepted: every applier claims
+them by ascending seq, in the transaction applying them, so an operation is
+applied exactly once and never before an earlier one on the same entity. An
+operation whose application raises is retried, and the later ones on the same
+entity wait, until it failed WRITE_BEHIND_MAX_ATTEMPTS times; it is then
+marked failed. The operations on other entities are applied meanwhile.
+'''
+
+WRITABLE = {
+    Actor.__tablename__: (Actor, validate_actor),
+    Movie.__tablename__: (Movie, validate_movie)
+}
+
+
+class OperationError(Exception):
+    def __init__(self, error, status_code):
+        self.error = error
+        self.status_code = status_code
+
+
+def encode_values(values):
+    return json.dumps(values, default=lambda value: value.isoformat())
+
+
+class WriteBehindQueue:
+    '''
+    Accepts writes into the journal and applies them from a worker started
+    on the first write accepted by each process, in a daemon thread or, when
+    served through asgi.py, in a task of the event loop. With
+    WRITE_BEHIND_WORKER disabled, the journal is applied by
+    `python manage.py apply_writes` instead.
+    '''
+
+    # Seconds the idle worker waits before looking for operations accepted
+    # by other processes
+    IDLE_INTERVAL = 5
+
+    def __init__(self, app=None):
+        self.app = None
+        self._queued = 0
+        self._pending = IOEvent()
+        self._full = IOEvent()
+        self._generation = 0
+        self._worker = None
+        self._worker_pid = None
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        with self._lock:
+            # A worker serving the previous app stops at its next wake up
+            self._generation += 1
+            self._worker = self._worker_pid = None
+        self.app = app
+        app.extensions['write_behind'] = self
+
+    def accepts(self):
+        '''
+        Tells whether the current write request asked to be applied later
+        and write-behind is enabled
+        '''
+        prefer = request.headers.get('Prefer', '')
+        return current_app.config['WRITE_BEHIND_ENABLED'] and \
+            any(token.strip() == 'respond-async' for token in prefer.split(','))
+
+    def submit(self, model, action, entity_id=None, values=None, subject=None):
+        '''
+        Journals a write, committed before returning so it survives a crash,
+        and wakes the worker. Returns the operation.
+        '''
+        operation = WriteOperation(
+            id=uuid.uuid4().hex, subject=subject, model=model.__tablename__,
+            action=action, entity_id=entity_id,
+            payload=encode_values(values) if values is not None else None,
+            status='pending')
+        db.session.add(operation)
+        db.session.commit()
+        # Polls of the operation read from the primary, like reads following
+        # a write
+        replica_router.record_write(WriteOperation.__tablename__)
+        if current_app.config['WRITE_BEHIND_WORKER']:
+            self.notify()
+        return operation
+
+    def notify(self):
+        with self._lock:
+            self._queued += 1
+            if self._worker_pid != os.getpid():
+                # First write of this process, or of a fork of it
+                self._worker_pid = os.getpid()
+                self._worker = spawn(self.run, self._generation)
+        self._pending.set()
+        if self._queued >= current_app.config['WRITE_BEHIND_BATCH_SIZE']:
+            self._full.set()
+
+    def run(self, generation):
+        with self.app.app_context():
+            max_delay = self.app.config['WRITE_BEHIND_MAX_DELAY'] / 1000
+            while generation == self._generation:
+                if self._pending.wait(self.IDLE_INTERVAL):
+                    self._full.wait(max_delay)
+                    with self._lock:
+                        self._queued = 0
+                        self._pending.clear()
+                        self._full.clear()
+                try:
+                    while self.apply_pending():
+                        pass
+                except Exception:
+                    self.app.logger.exception('Applying the write-behind journal failed')
+                finally:
+                    db.session.remove()
+
+    def apply_pending(self, limit=None):
+        '''
+        Applies the pending operations in group commits of up to `limit`
+        operations and returns the number of them done. If a batch fails, its
+        operations are retried one by one so only the faulty ones fail. An
+        operation failing with attempts left is left pending, with the later
+        ones on the same entity, for the caller to try again later.
+        '''
+        limit = limit or current_app.config['WRITE_BEHIND_BATCH_SIZE']
+        # Entities whose next operation must wait for a failed one
+        blocked = set()
+        done = last_seq = 0
+        while True:
+            rows = db.session.query(WriteOperation.seq, WriteOperation.model,
+                                    WriteOperation.entity_id)\
+                .filter(WriteOperation.status == 'pending', WriteOperation.seq > last_seq)\
+                .order_by(WriteOperation.seq).limit(limit).all()
+            if not rows:
+                return done
+            last_seq = rows[-1].seq
+            rows = [row for row in rows if (row.model, row.entity_id) not in blocked]
+            try:
+                with group_commit():
+                    for row in rows:
+                        self.apply(row.seq)
+            except Exception:
+                done += self.apply_each(rows, blocked)
+            else:
+                done += len(rows)
+
+    def apply_each(self, rows, blocked):
+        '''
+        Applies the operations one by one, skipping those on `blocked`
+        entities and adding the entities of the ones failing with attempts
+        left, and returns the number of them done
+        '''
+        done = 0
+        for row in rows:
+            if (row.model, row.entity_id) in blocked:
+                continue
+            try:
+                with group_commit():
+                    self.apply(row.seq)
+            except Exception:
+                current_app.logger.exception(f'Write operation {row.seq} failed')
+                if not self.record_failure(row.seq):
+                    # A create holds back no later operation
+                    if row.entity_id is not None:
+                        blocked.add((row.model, row.entity_id))
+                    continue
+            done += 1
+        return done
+
+    def record_failure(self, seq):
+        '''
+        Counts a failed attempt at a pending operation and marks it failed
+        after WRITE_BEHIND_MAX_ATTEMPTS of them. Returns whether the
+        operations after it can be applied.
+        '''
+        operations = WriteOperation.__table__
+        with group_commit():
+            result = db.session.execute(
+                operations.update()
+                .where((operations.c.seq == seq) & (operations.c.status == 'pending'))
+                .values(attempts=operations.c.attempts + 1))
+            if result.rowcount == 0:
+                # Another applier got to it first
+                return True
+            attempts = db.session.query(WriteOperation.attempts).filter_by(seq=seq).scalar()
+            if attempts < current_app.config['WRITE_BEHIND_MAX_ATTEMPTS']:
+                return False
+            self.apply(seq, OperationError('internal server error', 500))
+        return True
+
+    def claim(self, seq):
+        '''
+        Marks a pending operation applied in the current transaction. Returns
+        the operation, or None if another applier claimed it first.
+        '''
+        operations = WriteOperation.__table__
+        result = db.session.execute(
+            operations.update()
+            .where((operations.c.seq == seq) & (operations.c.status == 'pending'))
+            .values(status='applied', applied_at=datetime.utcnow()))
+        if result.rowcount == 0:
+            return None
+        return db.session.query(WriteOperation).populate_existing().get(seq)
+
+    def apply(self, seq, error=None):
+        '''
+        Claims an operation and applies it, or records `error` as its outcome
+        '''
+        operation = self.claim(seq)
+        if operation is None:
+            return
+        try:
+            if error is not None:
+                raise error
+            operation.entity_id = self.execute(operation)
+            operation.result = json.dumps({'id': operation.entity_id})
+        except OperationError as e:
+            operation.status = 'failed'
+            operation.result = json.dumps({'error': e.status_code, 'message': e.error})
+
+    def execute(self, operation):
+        model, validator = WRITABLE[operation.model]
+        values = validator(json.loads(operation.payload)) if operation.payload else {}
+        if operation.action == 'create':
+            entity = model(**values)
+            entity.insert()
+            return entity.id
+        entity = db.session.query(model).get(operation.entity_id)
+        if entity is None:
+            raise OperationError('not found', 404)
+        if operation.action == 'update':
+            entity.update(**values)
+        else:
+            entity.delete()
+        return operation.entity_id
+
+    def status(self, operation_id, subject):
+        '''
+        Returns the operation with the given id submitted by `subject`, or
+        None
+        '''
+        operation = WriteOperation.query.filter_by(id=operation_id).one_or_none()
+        if operation is None or operation.subject != subject:
+            return None
+        return operation
+
+
+def format_operation(operation):
+    return {
+        'id': operation.id,
+        'status': operation.status,
+        'type': operation.model,
+        'action': operation.action,
+        'entity_id': operation.entity_id,
+        'created_at': operation.created_at,
+        'applied_at': operation.applied_at,
+        'result': json.loads(operation.result) if operation.result else None
+    }
+
+
+write_behind = WriteBehindQueue()